@@ -88,7 +88,8 @@ class Attacker(ch.nn.Module):
                 random_start=False, random_restarts=False, do_tqdm=False,
                 targeted=False, custom_loss=None, should_normalize=True,
                 orig_input=None, use_best=True, return_image=True,
-                est_grad=None, mixed_precision=False):
+                est_grad=None, mixed_precision=False, num_threads=None,
+                batch_restarts=False, restart_batch_size=None):
         """
         Implementation of forward (finds adversarial examples). Note that
         this does **not** perform inference and should not be called
@@ -105,8 +106,15 @@ class Attacker(ch.nn.Module):
             step_size (float) : step size for adversarial attacks.
             iterations (int): number of steps for adversarial attacks.
             random_start (bool) : if True, start the attack with a random step.
-            random_restarts (bool) : if True, do many random restarts and
-                take the worst attack (in terms of loss) per input.
+            random_restarts (int) : if nonzero, do that many random restarts and
+                take the worst attack per input.
+            batch_restarts (bool) : if True, stack the random restarts along
+                the batch dimension and run them as one attack, instead of one
+                attack per restart; the worst attack per input is then the one
+                with the highest (lowest, if targeted) loss.
+            restart_batch_size (int|None) : memory budget for batched restarts;
+                the stacked :samp:`random_restarts * N` inputs are attacked in
+                chunks of at most this many inputs. By default, all at once.
             do_tqdm (bool) : if True, show a tqdm progress bar for the attack.
             targeted (bool) : if True (False), minimize (maximize) the loss.
             custom_loss (function|None) : if provided, used instead of the
@@ -128,7 +136,9 @@ class Attacker(ch.nn.Module):
                 'fourier')
             est_grad (tuple|None) : If not None (default), then these are
                 :samp:`(query_radius [R], num_queries [N])` to use for estimating the
-                gradient instead of autograd. We use the spherical gradient
+                gradient instead of autograd, optionally followed by the number of
+                antithetic pairs to evaluate per chunk (see
+                :func:`delphi.utils.helpers.calc_est_grad`). We use the spherical gradient
                 estimator, shown below, along with antithetic sampling [#f1]_
                 to reduce variance:
                 :math:`\\nabla_x f(x) \\approx \\sum_{i=0}^N f(x + R\\cdot
@@ -136,6 +146,11 @@ class Attacker(ch.nn.Module):
                 :math:`\delta_i` are randomly sampled from the unit ball.
             mixed_precision (bool) : if True, use mixed-precision calculations
                 to compute the adversarial examples / do the inference.
+            num_threads (int|None) : if not None, the number of intra-op
+                threads to use for attacks on CPU inputs (see
+                :samp:`torch.set_num_threads`); by default, PyTorch's setting
+                is used. The attack runs on the device of :samp:`x`, and the
+                model must be on the same device.
         Returns:
             An adversarial example for x (i.e. within a feasible set
             determined by `eps` and `constraint`, but classified as:
@@ -148,7 +163,8 @@ class Attacker(ch.nn.Module):
         # Can provide a different input to make the feasible set around
         # instead of the initial point
         if orig_input is None: orig_input = x.detach()
-        orig_input = orig_input.cuda()
+        # the attack runs on x's device, without transfers between steps
+        orig_input, target = orig_input.to(x.device), target.to(x.device)
 
         # Multiplier for gradient ascent [untargeted] or descent [targeted]
         m = -1 if targeted else 1
@@ -164,16 +180,19 @@ class Attacker(ch.nn.Module):
             Uses custom loss (if provided) otherwise the criterion
             '''
             if should_normalize:
-                inp = self.normalize(inp.cuda())
+                inp = self.normalize(inp)
             
-            output = self.model(inp.cuda())
+            output = self.model(inp)
             if custom_loss:
-                return custom_loss(self.model, inp.cuda(), target.cuda())
+                return custom_loss(self.model, inp, target)
 
-            return criterion(output, target.cuda()), output
+            return criterion(output, target), output
 
         # Main function for making adversarial examples
-        def get_adv_examples(x):
+        def get_adv_examples(x, target=target, step=step, return_loss=False):
+            # When return_loss is True, also returns the loss of each 
+            # returned example, so that callers don't need another 
+            # forward pass to compare them
             # Random start (to escape certain types of gradient masking)
             if random_start:
                 x = step.random_perturb(x)
@@ -186,16 +205,18 @@ class Attacker(ch.nn.Module):
             best_loss = None
             best_x = None
 
-            # A function that updates the best loss and best input
+            # A function that updates the best loss and best input. The 
+            # buffers are allocated on the first call, and then updated in 
+            # place on the input's device, without boolean indexing (which 
+            # synchronizes with the host on GPUs)
             def replace_best(loss, bloss, x, bx):
                 if bloss is None:
                     bx = x.clone().detach()
                     bloss = loss.clone().detach()
                 else:
-                    if x.is_cuda: import pdb; pdb.set_trace()
                     replace = m * bloss < m * loss
-                    bx[replace] = x[replace].clone().detach()
-                    bloss[replace] = loss[replace]
+                    bx.copy_(ch.where(replace.view(-1, *([1] * (x.dim() - 1))), x, bx))
+                    bloss.copy_(ch.where(replace, loss, bloss))
 
                 return bloss, bx
 
@@ -223,7 +244,7 @@ class Attacker(ch.nn.Module):
                     grad = None
 
                 with ch.no_grad():
-                    args = [losses, best_loss, x.cpu(), best_x]
+                    args = [losses, best_loss, x.detach(), best_x]
                     best_loss, best_x = replace_best(*args) if use_best else (losses, x)
 
                     x = step.step(x, grad)
@@ -231,36 +252,74 @@ class Attacker(ch.nn.Module):
                     if do_tqdm: iterator.set_description("Current loss: {l}".format(l=loss))
 
             # Save computation (don't compute last loss) if not use_best
-            if not use_best:
+            if not use_best and not return_loss:
                 ret = x.clone().detach()
                 return step.to_image(ret) if return_image else ret
 
-            losses, _ = calc_loss(step.to_image(x), target)
-            args = [losses, best_loss, x.cpu(), best_x]
+            with ch.no_grad():
+                losses, _ = calc_loss(step.to_image(x), target)
+            if not use_best:
+                ret = x.clone().detach()
+                return (step.to_image(ret) if return_image else ret), losses.detach()
+            args = [losses, best_loss, x.detach(), best_x]
             best_loss, best_x = replace_best(*args)
-            return step.to_image(best_x) if return_image else best_x
-
-        # Random restarts: repeat the attack and find the worst-case
-        # example for each input in the batch
-        if random_restarts:
-            to_ret = None
-
-            orig_cpy = x.clone().detach()
-            for _ in range(random_restarts):
-                adv = get_adv_examples(orig_cpy)
+            ret = step.to_image(best_x) if return_image else best_x
+            return (ret, best_loss) if return_loss else ret
 
-                if to_ret is None:
-                    to_ret = adv.detach()
-
-                _, output = calc_loss(adv, target)
-                corr, = accuracy(output.cpu(), target, topk=(1,), exact=True)
-                corr = corr.byte()
-                misclass = ~corr
-                to_ret[misclass] = adv[misclass]
-
-            adv_ret = to_ret
-        else:
-            adv_ret = get_adv_examples(x)
+        def get_batched_restarts(x):
+            '''
+            Runs the random restarts as one attack on the inputs repeated 
+            random_restarts times, in chunks of at most restart_batch_size 
+            inputs, and picks the worst restart per input, from the losses 
+            that the attack already computed.
+            '''
+            B, rest = x.size(0), x.shape[1:]
+            xs = x.detach().repeat(random_restarts, *([1] * len(rest)))
+            targets = target.repeat(random_restarts, *([1] * (target.dim() - 1)))
+            orig_inputs = orig_input.repeat(random_restarts, *([1] * (orig_input.dim() - 1)))
+            chunk_size = restart_batch_size or xs.size(0)
+            advs, losses = [], []
+            for i in range(0, xs.size(0), chunk_size):
+                chunk_step = step_class(eps=eps, orig_input=orig_inputs[i:i + chunk_size], step_size=step_size)
+                adv, loss = get_adv_examples(xs[i:i + chunk_size], target=targets[i:i + chunk_size], 
+                                            step=chunk_step, return_loss=True)
+                advs.append(adv.detach())
+                losses.append(loss)
+
+            # per-input reduction over the restarts
+            advs, losses = ch.cat(advs), ch.cat(losses)
+            worst = (m * losses.view(random_restarts, B)).argmax(0)
+            return advs.view(random_restarts, B, *advs.shape[1:])[worst, ch.arange(B, device=worst.device)]
+
+        num_threads_ = ch.get_num_threads()
+        if num_threads is not None and x.device.type == 'cpu':
+            ch.set_num_threads(num_threads)
+        try:
+            # Random restarts: repeat the attack and find the worst-case
+            # example for each input in the batch
+            if random_restarts and batch_restarts:
+                adv_ret = get_batched_restarts(x)
+            elif random_restarts:
+                to_ret = None
+
+                orig_cpy = x.clone().detach()
+                for _ in range(random_restarts):
+                    adv = get_adv_examples(orig_cpy)
+
+                    if to_ret is None:
+                        to_ret = adv.detach()
+
+                    with ch.no_grad():
+                        _, output = calc_loss(adv, target)
+                    corr, = accuracy(output, target, topk=(1,), exact=True)
+                    misclass = ~corr.bool()
+                    to_ret = ch.where(misclass.view(-1, *([1] * (adv.dim() - 1))), adv.detach(), to_ret)
+
+                adv_ret = to_ret
+            else:
+                adv_ret = get_adv_examples(x)
+        finally:
+            ch.set_num_threads(num_threads_)
 
         return adv_ret
 
@@ -343,6 +402,8 @@ class AttackerModel(delphi):
                 'random_start': self.args.random_start,
 #                'custom_loss': self.adv_criterion,
                 'random_restarts': self.args.random_restarts,
+                'batch_restarts': bool(self.args.batch_restarts),
+                'restart_batch_size': self.args.restart_batch_size,
                 'use_best': bool(self.args.use_best)
             }
             assert target is not None
@@ -381,8 +442,10 @@ class AttackerModel(delphi):
         '''
         *INTERNAL FUNCTION* used for both train 
         '''
-        # unpack input and target
-        inp, targ = inp.cuda(), targ.cuda()
+        # unpack input and target, and move them to the model's device
+        inp, targ = batch
+        device = next(self.model.parameters()).device
+        inp, targ = inp.to(device), targ.to(device)
         model_logits = self.model(inp)
 
         # AttackerModel returns both output and final input
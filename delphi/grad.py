@@ -5,10 +5,12 @@ Gradients for truncated and untruncated latent variable models.
 import torch as ch
 from torch import sigmoid as sig
 from torch.nn import Softmax
-from torch.distributions import Gumbel, MultivariateNormal, Bernoulli
+from torch.distributions import Gumbel, MultivariateNormal, Bernoulli, Normal
 import math
 
-from .utils.helpers import logistic, censored_sample_nll
+from .oracle import _intervals
+from .samplers import RejectionSampler
+from .utils.helpers import logistic, censored_sample_nll, truncated_normal_moments
 
 softmax = Softmax(dim=1)
 
@@ -107,7 +109,8 @@ class TruncatedMSE(ch.autograd.Function):
                 phi, 
                 noise_var, 
                 num_samples=10, 
-                eps=1e-5):
+                eps=1e-5, 
+                sampler=None):
         """
         Args: 
             pred (torch.Tensor): size (batch_size, 1) matrix for regression model predictions
@@ -116,11 +119,16 @@ class TruncatedMSE(ch.autograd.Function):
             noise_var (float): noise distribution variance parameter
             num_samples (int): number of samples to generate per sample in batch in rejection sampling procedure
             eps (float): denominator error constant to avoid divide by zero errors
+            sampler (delphi.samplers.RejectionSampler): sampler for the conditional noise distribution; default rejection sampling with num_samples samples
         """
-        stacked = pred[None, ...].repeat(num_samples, 1, 1)
-        noised = stacked + math.sqrt(noise_var) * ch.randn(stacked.size())        
-        filtered = phi(noised)
-        z = (filtered * noised).sum(dim=0) / (filtered.sum(dim=0) + eps)
+        intervals = _intervals(phi, pred)
+        if intervals is not None: 
+            # closed-form conditional mean for interval truncation sets
+            z, = truncated_normal_moments(pred, ch.as_tensor(noise_var).sqrt(), intervals, order=1)
+        else: 
+            sampler = sampler if sampler is not None else RejectionSampler(num_samples)
+            samples = sampler(pred, phi, Normal(ch.zeros(1), ch.as_tensor(noise_var).sqrt().flatten()))
+            z = samples.weighted_sum(lambda noise, pred: pred[None, ...] + noise, pred) / (samples.total_weight + eps)
         out = -.5 * (z.pow(2) + z * pred)
         ctx.save_for_backward(pred, targ, z)
         return (-.5 * targ.pow(2) + targ * pred - out).mean(0)
@@ -129,7 +137,7 @@ class TruncatedMSE(ch.autograd.Function):
     def backward(ctx, 
                 grad_output):
         pred, targ, z = ctx.saved_tensors
-        return (z - targ) / pred.size(0), targ / pred.size(0), None, None, None, None
+        return (z - targ) / pred.size(0), targ / pred.size(0), None, None, None, None, None
 
 
 class TruncatedUnknownVarianceMSE(ch.autograd.Function):
@@ -138,7 +146,7 @@ class TruncatedUnknownVarianceMSE(ch.autograd.Function):
     with unknown noise variance.
     """
     @staticmethod
-    def forward(ctx, pred, targ, lambda_, phi, num_samples=10, eps=1e-5):
+    def forward(ctx, pred, targ, lambda_, phi, num_samples=10, eps=1e-5, sampler=None):
         """
         Args: 
             pred (torch.Tensor): size (batch_size, 1) matrix for regression model predictions
@@ -147,15 +155,19 @@ class TruncatedUnknownVarianceMSE(ch.autograd.Function):
             phi (oracle.oracle): dependent variable membership oracle
             num_samples (int): number of samples to generate per sample in batch in rejection sampling procedure
             eps (float): denominator error constant to avoid divide by zero errors
+            sampler (delphi.samplers.RejectionSampler): sampler for the conditional noise distribution; default rejection sampling with num_samples samples
         """
         sigma = ch.sqrt(lambda_.inverse())
-        stacked = pred[..., None].repeat(1, num_samples, 1)
-
-        noised = stacked + sigma * ch.randn(stacked.size())
-        filtered = phi(noised)
-        out = noised * filtered
-        z = out.sum(dim=1) / (filtered.sum(dim=1) + eps)
-        z_2 = out.pow(2).sum(dim=1) / (filtered.sum(dim=1) + eps)
+        intervals = _intervals(phi, pred)
+        if intervals is not None: 
+            # closed-form conditional moments for interval truncation sets
+            z, z_2 = truncated_normal_moments(pred, sigma, intervals)
+        else: 
+            sampler = sampler if sampler is not None else RejectionSampler(num_samples)
+            samples = sampler(pred, phi, Normal(ch.zeros(1), sigma.flatten()))
+            norm = samples.total_weight + eps
+            z = samples.weighted_sum(lambda noise, pred: pred[None, ...] + noise, pred) / norm
+            z_2 = samples.weighted_sum(lambda noise, pred: (pred[None, ...] + noise).pow(2), pred) / norm
         nll = -0.5 * lambda_ * targ.pow(2)  + lambda_ * targ * pred
         const = -0.5 * lambda_ * z_2 + z * pred * lambda_
 
@@ -171,7 +183,7 @@ class TruncatedUnknownVarianceMSE(ch.autograd.Function):
         factor
         """
         lambda_grad = .5 * (targ.pow(2) - z_2)
-        return lambda_ * (z - targ) / pred.size(0), targ / pred.size(0), lambda_grad / pred.size(0), None, None, None
+        return lambda_ * (z - targ) / pred.size(0), targ / pred.size(0), lambda_grad / pred.size(0), None, None, None, None
 
 def Test(mu, phi, c_gamma, alpha, T): 
   """
@@ -207,7 +219,7 @@ class SwitchGrad(ch.autograd.Function):
     with known noise variance.
     """
     @staticmethod
-    def forward(ctx, pred, targ, phi, c_gamma, alpha, T, noise_var, num_samples=10, eps=1e-5):
+    def forward(ctx, pred, targ, phi, c_gamma, alpha, T, noise_var, num_samples=10, eps=1e-5, sampler=None):
         """
         Args: 
             pred (torch.Tensor): size (batch_size, d) matrix for regression model predictions
@@ -219,9 +231,8 @@ class SwitchGrad(ch.autograd.Function):
             noise_var (float): noise distribution variance parameter
             num_samples (int): number of samples to generate per sample in batch in rejection sampling procedure
             eps (float): denominator error constant to avoid divide by zero errors
+            sampler (delphi.samplers.RejectionSampler): sampler for the conditional noise distribution; default rejection sampling with num_samples samples
         """
-        # make num_samples copies of pred, N x B x 1
-        stacked = pred[None, ...].repeat(num_samples, 1, 1)
         '''
         test whether to use censor-aware or censor-oblivious function 
         for computing gradient
@@ -229,13 +240,11 @@ class SwitchGrad(ch.autograd.Function):
         M = ch.distributions.MultivariateNormal(ch.zeros(pred[0].size(0)), noise_var) 
         result = Test(pred, phi, c_gamma, alpha, T)
 
-        # add random noise to each copy
-        noised = stacked + M.sample(stacked.size()[:-1])
-        
-        # filter out copies where pred is in bounds
-        filtered = phi(noised)
+        # add random noise to num_samples copies of pred, N x B x d, and filter out copies that are not in bounds
+        sampler = sampler if sampler is not None else RejectionSampler(num_samples)
+        samples = sampler(pred, phi, M)
         # average across truncated indices
-        z_ = (filtered * noised).sum(dim=0) / (filtered.sum(dim=0) + eps)
+        z_ = samples.weighted_sum(lambda noise, pred: pred[None, ...] + noise, pred) / (samples.total_weight + eps)
 
         """
         result and result_inv are masks, so that you keep the noised 
@@ -260,7 +269,7 @@ class TruncatedBCE(ch.autograd.Function):
     Truncated binary cross entropy gradient for truncated binary classification tasks. 
     """
     @staticmethod
-    def forward(ctx, pred, targ, phi, num_samples=10, eps=1e-5):
+    def forward(ctx, pred, targ, phi, num_samples=10, eps=1e-5, sampler=None):
         """
         Args: 
             pred (torch.Tensor): size (batch_size, 1) matrix for regression model predictions
@@ -268,36 +277,34 @@ class TruncatedBCE(ch.autograd.Function):
             phi (oracle.oracle): dependent variable membership oracle
             num_samples (int): number of samples to generate per sample in batch in rejection sampling procedure
             eps (float): denominator error constant to avoid divide by zero errors
+            sampler (delphi.samplers.RejectionSampler): sampler for the conditional noise distribution; default rejection sampling with num_samples samples
         """
         ctx.save_for_backward()
         bce_loss = ch.nn.BCEWithLogitsLoss()
         
-        stacked = pred[None, ...].repeat(num_samples, 1, 1)
-        rand_noise = logistic.sample(stacked.size())
-        # add noise
-        noised = stacked + rand_noise
-        noised_labs = noised >= 0
-        # filter
-        filtered = phi(noised)
-        mask = (noised_labs).eq(targ)
-        nll = (filtered * mask * logistic.log_prob(rand_noise)).sum(0) / ((filtered * mask).sum(0) + eps)
-        const = (filtered * logistic.log_prob(rand_noise)).sum(0) / (filtered.sum(0) + eps)
-        ctx.save_for_backward(mask, filtered, rand_noise)
-        ctx.eps = eps
+        sampler = sampler if sampler is not None else RejectionSampler(num_samples)
+        samples = sampler(pred, phi, logistic)
+        # samples whose noised labels match the targets
+        match = lambda noise, pred, targ: (pred[None, ...] + noise >= 0).eq(targ)
+        match_weight = samples.weighted_sum(lambda noise, pred, targ: match(noise, pred, targ).float(), pred, targ) + eps
+        total_weight = samples.total_weight + eps
+        nll = samples.weighted_sum(lambda noise, pred, targ: match(noise, pred, targ) * logistic.log_prob(noise), pred, targ) / match_weight
+        const = samples.weighted_sum(lambda noise: logistic.log_prob(noise)) / total_weight
+        # the gradient is reduced over the samples here, so that they don't have to be kept for the backward pass
+        avg = 2 * samples.weighted_sum(lambda noise, pred, targ: sig(noise) * match(noise, pred, targ), pred, targ) / match_weight
+        norm_const = 2 * samples.weighted_sum(lambda noise: sig(noise)) / total_weight
+        ctx.save_for_backward(-(avg - norm_const) / pred.size(0))
         return -(nll - const) / pred.size(0)
 
     @staticmethod
     def backward(ctx, grad_output):
-        mask, filtered, rand_noise = ctx.saved_tensors
-
-        avg = 2*(sig(rand_noise) * mask * filtered).sum(0) / ((mask * filtered).sum(0) + ctx.eps) 
-        norm_const = (2 * sig(rand_noise) * filtered).sum(0) / (filtered.sum(0) + ctx.eps)
-        return -(avg - norm_const) / rand_noise.size(1), None, None, None, None
+        grad, = ctx.saved_tensors
+        return grad, None, None, None, None, None
 
 
 class TruncatedProbitMLE(ch.autograd.Function): 
     @staticmethod
-    def forward(ctx, pred, targ, phi, num_samples=10, eps=1e-5): 
+    def forward(ctx, pred, targ, phi, num_samples=10, eps=1e-5, sampler=None): 
         """
         Args: 
             pred (torch.Tensor): size (batch_size, 1) matrix for regression model predictions
@@ -305,27 +312,25 @@ class TruncatedProbitMLE(ch.autograd.Function):
             phi (oracle.oracle): dependent variable membership oracle
             num_samples (int): number of samples to generate per sample in batch in rejection sampling procedure
             eps (float): denominator error constant to avoid divide by zero errors
+            sampler (delphi.samplers.RejectionSampler): sampler for the conditional noise distribution; default rejection sampling with num_samples samples
         """
         M = MultivariateNormal(ch.zeros(1,), ch.eye(1, 1))
-        stacked = pred[None,...].repeat(num_samples, 1, 1)
-        rand_noise = ch.randn(stacked.size())
-        noised = stacked + rand_noise 
-        noised_labs = noised >= 0
-        mask = noised_labs.eq(targ)
-        filtered = phi(noised)
-        pdf = M.log_prob(rand_noise)[...,None]
-        nll = (pdf * filtered * mask).sum(0) / ((filtered * mask).sum(0) + eps)
-        const = (filtered * pdf).sum(0) / (filtered.sum(0) + eps)
-        ctx.save_for_backward(rand_noise, filtered, mask)
-        ctx.eps = eps
+        sampler = sampler if sampler is not None else RejectionSampler(num_samples)
+        samples = sampler(pred, phi, Normal(ch.zeros(1), ch.ones(1)))
+        match = lambda noise, pred, targ: (pred[None, ...] + noise >= 0).eq(targ)
+        match_weight = samples.weighted_sum(lambda noise, pred, targ: match(noise, pred, targ).float(), pred, targ) + eps
+        total_weight = samples.total_weight + eps
+        nll = samples.weighted_sum(lambda noise, pred, targ: M.log_prob(noise)[...,None] * match(noise, pred, targ), pred, targ) / match_weight
+        const = samples.weighted_sum(lambda noise: M.log_prob(noise)[...,None]) / total_weight
+        avg = samples.weighted_sum(lambda noise, pred, targ: noise * match(noise, pred, targ), pred, targ) / match_weight
+        norm_const = samples.weighted_sum(lambda noise: noise) / total_weight
+        ctx.save_for_backward(-(avg - norm_const) / pred.size(0))
         return -(nll - const) / pred.size(0)
 
     @staticmethod
     def backward(ctx, grad_output): 
-        rand_noise, filtered, mask = ctx.saved_tensors
-        nll = (mask * filtered * rand_noise).sum(dim=0) / ((mask * filtered).sum(dim=0) + ctx.eps)
-        const = (rand_noise * filtered).sum(dim=0) / (filtered.sum(dim=0) + ctx.eps)
-        return -(nll - const) / rand_noise.size(1), None, None, None, None
+        grad, = ctx.saved_tensors
+        return grad, None, None, None, None, None
 
 
 class GumbelCE(ch.autograd.Function):
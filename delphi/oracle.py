@@ -6,6 +6,7 @@ from abc import ABC
 from decimal import Decimal
 from orthnet import Hermite
 import math
+import functools
 from scipy.linalg import sqrtm
 
 from .utils.helpers import Bounds, cov
@@ -23,6 +24,47 @@ class oracle(ABC):
         """
         pass
 
+    def intervals(self):
+        """
+        Truncation set as a list of disjoint (lower, upper) intervals, for oracles 
+        that are a union of intervals over a univariate output. Gradients use 
+        closed-form truncated normal moments for oracles that return intervals, and 
+        fall back to rejection sampling when the oracle returns None (default).
+        """
+        return None
+
+    def __and__(self, other): 
+        return And(self, other)
+
+    def __or__(self, other): 
+        return Or(self, other)
+
+    def __invert__(self): 
+        return Not(self)
+
+
+def _is_scalar(bound): 
+    return ch.as_tensor(bound).numel() == 1
+
+
+def _mask(oracle_, x): 
+    """
+    Evaluates an oracle, and returns its membership as a boolean mask with size (..., 1), 
+    over the leading dimensions of x.
+    """
+    return ch.as_tensor(oracle_(x)).bool().reshape(x.size()[:-1] + (-1,)).all(-1, keepdim=True)
+
+
+def _intervals(phi, pred): 
+    """
+    Returns the truncation set's intervals, when the oracle declares itself analytically 
+    tractable for the univariate predictions, otherwise None.
+    """
+    intervals = getattr(phi, 'intervals', None)
+    if intervals is None or pred.size(-1) != 1: 
+        return None
+    return intervals()
+
 
 class Interval(oracle):
     """
@@ -35,6 +77,10 @@ class Interval(oracle):
     def __call__(self, x):
         return ((self.bounds.lower < x).prod(-1) * (x < self.bounds.upper).prod(-1))[...,None]
 
+    def intervals(self): 
+        if _is_scalar(self.bounds.lower) and _is_scalar(self.bounds.upper): 
+            return [(self.bounds.lower, self.bounds.upper)]
+
 
 class KIntervalUnion(oracle):
     """
@@ -43,12 +89,29 @@ class KIntervalUnion(oracle):
 
     def __init__(self, intervals):
         self.oracles = [Interval(int_[0], int_[1]) for int_ in intervals]
+        # stacked bounds with size (num_intervals, k), so that all intervals are checked at once; 
+        # the bounds keep their (promoted) dtype, and comparisons promote the input to it
+        bounds = [(ch.as_tensor(o.bounds.lower), ch.as_tensor(o.bounds.upper)) for o in self.oracles]
+        dtype = functools.reduce(ch.promote_types, [b.dtype for pair in bounds for b in pair])
+        bounds = [ch.broadcast_tensors(lower.to(dtype), upper.to(dtype)) for lower, upper in bounds]
+        bounds = ch.broadcast_tensors(*[ch.stack(b) for b in bounds])
+        self.lower, self.upper = ch.stack([b[0].reshape(-1) for b in bounds]), ch.stack([b[1].reshape(-1) for b in bounds])
 
     def __call__(self, x):
-        result = Tensor([])
-        for oracle_ in self.oracles:
-            result = ch.logical_or(result, oracle_(x)) if result.nelement() > 0 else oracle_(x)
-        return result[..., None]
+        x = x[...,None,:]
+        return ((self.lower < x) & (x < self.upper)).all(-1).any(-1, keepdim=True)
+
+    def intervals(self): 
+        if not all(_is_scalar(o.bounds.lower) and _is_scalar(o.bounds.upper) for o in self.oracles): 
+            return None
+        # merge overlapping intervals, so that the union is a list of disjoint intervals
+        merged = []
+        for lower, upper in sorted((float(o.bounds.lower), float(o.bounds.upper)) for o in self.oracles): 
+            if merged and lower <= merged[-1][1]: 
+                merged[-1] = (merged[-1][0], max(merged[-1][1], upper))
+            else: 
+                merged.append((lower, upper))
+        return merged
 
     def __str__(self): 
         return 'k-interval union'
@@ -82,6 +145,10 @@ class Left_Regression(oracle):
     def __call__(self, x): 
         return x > self.left
 
+    def intervals(self): 
+        if _is_scalar(self.left): 
+            return [(self.left, float('inf'))]
+
     def __str__(self): 
         return 'left regression'
 
@@ -162,6 +229,10 @@ class Right_Regression(oracle):
     def __call__(self, x): 
         return x < self.right
 
+    def intervals(self): 
+        if _is_scalar(self.right): 
+            return [(float('-inf'), self.right)]
+
     def __str__(self): 
         return 'right'
 
@@ -187,15 +258,174 @@ class Right_Distribution(oracle):
         return 'right'
 
 
+class HalfSpace(oracle): 
+    """
+    Half-space truncation. Accepts the samples x with x @ normal <= offset.
+    """
+    def __init__(self, normal, offset): 
+        """
+        Args: 
+            normal (torch.Tensor): size (k,) - normal vector of the half-space
+            offset (float): offset of the half-space
+        """
+        self.normal = ch.as_tensor(normal)
+        self.offset = offset
+
+    def __call__(self, x): 
+        return (x @ self.normal.to(x.dtype) <= self.offset)[...,None]
+
+    def __str__(self): 
+        return 'half-space'
+
+
+class Ball(oracle): 
+    """
+    Norm ball truncation. Accepts the samples x with ||x - center||_ord <= radius.
+    """
+    def __init__(self, center, radius, ord=2): 
+        """
+        Args: 
+            center (torch.Tensor): size (k,) - center of the ball
+            radius (float): radius of the ball
+            ord (int, float): order of the norm; ie. 1, 2, float('inf')
+        """
+        self.center = ch.as_tensor(center)
+        self.radius = radius
+        self.ord = ord
+
+    def __call__(self, x): 
+        return LA.vector_norm(x - self.center.to(x.dtype), ord=self.ord, dim=-1, keepdim=True) <= self.radius
+
+    def __str__(self): 
+        return 'ball'
+
+
+def _flatten(x): 
+    # samples with size (num_samples, k), over the leading dimensions of x
+    return x.reshape(-1, x.size(-1))
+
+
+class And(oracle): 
+    """
+    Intersection of oracles. Oracles can also be combined with the & operator. 
+    Each oracle is only evaluated on the samples that all previous oracles accepted.
+    """
+    def __init__(self, *oracles): 
+        self.oracles = oracles
+
+    def __call__(self, x): 
+        samples = _flatten(x)
+        result = _mask(self.oracles[0], samples)[:,0]
+        for oracle_ in self.oracles[1:]: 
+            active = result.nonzero(as_tuple=True)[0]
+            if active.numel() == 0: break
+            result[active] = _mask(oracle_, samples[active])[:,0]
+        return result.view(x.size()[:-1] + (1,))
+
+    def __str__(self): 
+        return '(' + ' & '.join(str(oracle_) for oracle_ in self.oracles) + ')'
+
+
+class Or(oracle): 
+    """
+    Union of oracles. Oracles can also be combined with the | operator. 
+    Each oracle is only evaluated on the samples that all previous oracles rejected.
+    """
+    def __init__(self, *oracles): 
+        self.oracles = oracles
+
+    def __call__(self, x): 
+        samples = _flatten(x)
+        result = _mask(self.oracles[0], samples)[:,0]
+        for oracle_ in self.oracles[1:]: 
+            active = (~result).nonzero(as_tuple=True)[0]
+            if active.numel() == 0: break
+            result[active] = _mask(oracle_, samples[active])[:,0]
+        return result.view(x.size()[:-1] + (1,))
+
+    def __str__(self): 
+        return '(' + ' | '.join(str(oracle_) for oracle_ in self.oracles) + ')'
+
+
+class Not(oracle): 
+    """
+    Complement of an oracle. Oracles can also be complemented with the ~ operator.
+    """
+    def __init__(self, oracle_): 
+        self.oracle = oracle_
+
+    def __call__(self, x): 
+        return ~_mask(self.oracle, x)
+
+    def __str__(self): 
+        return '~' + str(self.oracle)
+
+
+class KOfN(oracle): 
+    """
+    Accepts the samples that at least k of the oracles accept. Each oracle is only 
+    evaluated on the samples that are not decided yet.
+    """
+    def __init__(self, k, *oracles): 
+        """
+        Args: 
+            k (int): number of oracles that need to accept a sample
+            oracles (delphi.oracle.oracle): oracles to combine
+        """
+        assert 0 < k <= len(oracles), "k is: {}. expecting 0 < k <= {}.".format(k, len(oracles))
+        self.k = k
+        self.oracles = oracles
+
+    def __call__(self, x): 
+        samples = _flatten(x)
+        counts = ch.zeros(samples.size(0), dtype=ch.long)
+        active = ch.arange(samples.size(0))
+        for i, oracle_ in enumerate(self.oracles): 
+            counts[active] += _mask(oracle_, samples[active])[:,0]
+            remaining = len(self.oracles) - i - 1
+            # samples are decided once they have k accepts, or can no longer reach k
+            active = active[(counts[active] < self.k) & (counts[active] + remaining >= self.k)]
+            if active.numel() == 0: break
+        return (counts >= self.k).view(x.size()[:-1] + (1,))
+
+    def __str__(self): 
+        return '{}-of-{}('.format(self.k, len(self.oracles)) + ', '.join(str(oracle_) for oracle_ in self.oracles) + ')'
+
+
+# set algebra aliases
+Union, Intersection, Complement = Or, And, Not
+
+
 class Lambda(oracle):   
     """
-    Lambda function oracle. Takes in a lambda function/callable that can be applied to one [n,] sized sample as pytorch tensor
+    Lambda function oracle. Takes in a lambda function/callable that can be applied to one [n,] sized sample as pytorch tensor. 
+    The lambda is applied to every sample over the leading dimensions of the input. When the lambda can be vectorized with torch.vmap 
+    (ie. uses tensor ops, and &, |, ~ instead of python control flow), all samples are evaluated in one batched call; otherwise 
+    the oracle falls back to a python loop over the samples.
     """
-    def __init__(self, lambda_): 
+    def __init__(self, lambda_, vmap=True): 
+        """
+        Args: 
+            lambda_ (Callable): membership function for one sample
+            vmap (bool): try to vectorize the lambda with torch.vmap
+        """
         self.lambda_ = lambda_
+        # whether the lambda can be vectorized; checked on the first call
+        self._vmappable = None if vmap else False
     
     def __call__(self, x):
-        return ch.cat([self.lambda_(x[i]).unsqueeze(0) for i in range(x.size(0))])
+        samples = x.reshape(-1, x.size(-1))
+        if self._vmappable is not False: 
+            try: 
+                result = ch.vmap(self.lambda_)(samples)
+                self._vmappable = True
+            except RuntimeError: 
+                # data-dependent python control flow can't be vectorized
+                if self._vmappable: raise
+                self._vmappable = False
+        if not self._vmappable: 
+            result = ch.stack([ch.as_tensor(self.lambda_(sample)) for sample in samples])
+        return result.view(x.size()[:-1] + result.size()[1:])
 
     def __str__(self): 
         return 'lambda'
@@ -220,14 +450,15 @@ class Sphere(oracle):
 
 
 # LAMBDA FUNCTIONS TRIED
+# written with tensor ops, so that they can be applied to batches of samples and vectorized within oracle.Lambda
 #  2D DIMENSIONAL GAUSSIAN LAMBDA FUNCTIONS
-set_two_d = lambda x: (x[1].pow(2) + x[0].pow(2) > .5)
-horseshoe = lambda x: x[0] > 0 and x[0] ** 2 + x[1] ** 2 > 1 and x[0] ** 2 + x[1] ** 2 < 2
-horseshoe_dot = lambda x: x[0] > 0 and 1 < x.pow(2).sum() < 2 or ((x[0] - .5).pow(2) + x[1].pow(2)) < (1 / 6)
-triangle = lambda x: x[1] >= 0 and x[1] <= +x[0] + 1 and x[1] <= 1 - x[0] and not (
-            (x[0] / 2) ** 2 + (x[1] - 0.52) ** 2 <= 0.02)
+set_two_d = lambda x: (x[...,1].pow(2) + x[...,0].pow(2) > .5)
+horseshoe = lambda x: (x[...,0] > 0) & (x.pow(2).sum(-1) > 1) & (x.pow(2).sum(-1) < 2)
+horseshoe_dot = lambda x: (x[...,0] > 0) & (1 < x.pow(2).sum(-1)) & (x.pow(2).sum(-1) < 2) | (((x[...,0] - .5).pow(2) + x[...,1].pow(2)) < (1 / 6))
+triangle = lambda x: (x[...,1] >= 0) & (x[...,1] <= +x[...,0] + 1) & (x[...,1] <= 1 - x[...,0]) & ~(
+            (x[...,0] / 2) ** 2 + (x[...,1] - 0.52) ** 2 <= 0.02)
 # 3D DIMENSIONAL GAUSSIAN LAMBDA FUNCTIONS
-three_d_union_check = lambda x: x[0] > 0 and x[2] > 0 or x.pow(2).sum() < 1.0
+three_d_union_check = lambda x: (x[...,0] > 0) & (x[...,2] > 0) | (x.pow(2).sum(-1) < 1.0)
 
 
 class UnknownGaussian(oracle):
@@ -313,6 +544,9 @@ class Identity(oracle):
     def __call__(self, x): 
         return ch.ones(x.size()).prod(-1, keepdim=True)
 
+    def intervals(self): 
+        return [(float('-inf'), float('inf'))]
+
     def __str__(self): 
         return 'identity'
 
@@ -0,0 +1,287 @@
+"""
+Samplers for the conditional noise distributions used in the truncated gradients.
+"""
+
+import torch as ch
+from torch import Tensor
+from torch.distributions import Normal
+from abc import ABC, abstractmethod
+from typing import Callable, NamedTuple, Tuple
+
+from .oracle import _intervals
+from .utils.helpers import logistic
+
+
+class Samples(NamedTuple):
+    """
+    Noise samples drawn for a batch of predictions. Samplers that draw extra rounds for
+    some of the rows keep them in `rounds`, instead of padding every row to the same
+    number of draws; reduce the samples with weighted_sum to include them.
+    Args:
+        noise (torch.Tensor): size (num_draws, batch_size, k) - noise samples drawn for every row
+        weights (torch.Tensor): size (num_draws, batch_size, 1) - weight of each sample, zero for rejected samples
+        counts (torch.Tensor): size (batch_size, 1) - number of accepted samples for each row in the batch
+        draws (torch.Tensor): size (batch_size, 1) - number of samples drawn for each row in the batch
+        rounds (tuple): (rows, noise, weights) for each extra round, where rows indexes the resampled rows of the batch
+    """
+    noise: Tensor
+    weights: Tensor
+    counts: Tensor
+    draws: Tensor
+    rounds: Tuple = ()
+
+    def weighted_sum(self,
+                    fn: Callable,
+                    *tensors: Tensor) -> Tensor:
+        """
+        Sums fn(noise) times the weights over the draws for each row, with one
+        reduction per round.
+        Args:
+            fn (Callable): receives noise with size (num_draws, rows, k) and the rows of tensors, and returns values with size (num_draws, rows, m)
+            tensors (torch.Tensor): size (batch_size, ...) - per-row inputs to fn, ie. predictions and targets
+        Returns:
+            size (batch_size, m)
+        """
+        out = (self.weights * fn(self.noise, *tensors)).sum(0)
+        for rows, noise, weights in self.rounds:
+            out = out.index_add(0, rows, (weights * fn(noise, *[tensor[rows] for tensor in tensors])).sum(0))
+        return out
+
+    @property
+    def total_weight(self) -> Tensor:
+        """
+        Sum of the weights for each row, with size (batch_size, 1).
+        """
+        return self.weighted_sum(lambda noise: 1.0)
+
+
+def sample_noise(dist, size: ch.Size) -> Tensor:
+    """
+    Draws noise of size `size` from a torch distribution. The distribution's batch and
+    event shape cover the trailing dimensions of `size`.
+    """
+    shape = dist.batch_shape + dist.event_shape
+    return dist.sample(size[:len(size) - len(shape)])
+
+
+def _log_prob(dist, x: Tensor) -> Tensor:
+    # log density of each sample, with a trailing singleton dimension
+    log_prob = dist.log_prob(x)
+    if len(dist.event_shape) > 0:
+        return log_prob[...,None]
+    return log_prob.sum(-1, keepdim=True)
+
+
+class Sampler(ABC):
+    """
+    Sampler for the conditional noise distribution, given that the noised
+    prediction falls within the truncation set. Gradients average functions of the
+    noise with the returned weights.
+    """
+    def __init__(self,
+                num_samples: int=10):
+        """
+        Args:
+            num_samples (int): number of samples to draw per row
+        """
+        self.num_samples = num_samples
+        # per-row acceptance counts from the last call
+        self.counts, self.draws = None, None
+
+    @abstractmethod
+    def __call__(self,
+                pred: Tensor,
+                phi: Callable,
+                dist) -> Samples:
+        """
+        Args:
+            pred (torch.Tensor): size (batch_size, k) - predictions to add noise to
+            phi (delphi.oracle.oracle): membership oracle for the truncation set
+            dist (torch.distributions.Distribution): noise distribution
+        Returns:
+            Samples with noise and weights
+        """
+        pass
+
+
+class RejectionSampler(Sampler):
+    """
+    Rejection sampler for the conditional noise distribution. Each round draws
+    num_samples samples for each prediction, and filters them with the membership oracle.
+    When min_accepted is provided, the sampler keeps drawing rounds only for the rows
+    that have fewer than min_accepted accepted samples, until max_samples samples
+    have been drawn for a row. Compute scales with how hard each row is, instead of
+    with the hardest row.
+    """
+    def __init__(self,
+                num_samples: int=10,
+                min_accepted: int=None,
+                max_samples: int=None):
+        """
+        Args:
+            num_samples (int): number of samples to draw per row in each round
+            min_accepted (int): target number of accepted samples per row; by default only one round is drawn
+            max_samples (int): maximum number of samples to draw per row; default 10 * num_samples
+        """
+        super().__init__(num_samples)
+        self.min_accepted = min_accepted
+        self.max_samples = max_samples if max_samples is not None else 10 * num_samples
+
+    def __call__(self,
+                pred: Tensor,
+                phi: Callable,
+                dist) -> Samples:
+        size = (self.num_samples,) + pred.size()
+        noise = sample_noise(dist, size)
+        weights = phi(pred[None,...] + noise).float().view(self.num_samples, pred.size(0), -1)
+        counts = weights.sum(0)
+        draws = ch.full((pred.size(0), 1), float(self.num_samples))
+
+        rounds = []
+        if self.min_accepted is not None:
+            active = (counts.amin(-1) < self.min_accepted).nonzero(as_tuple=True)[0]
+            num_draws = self.num_samples
+            while active.numel() > 0 and num_draws < self.max_samples:
+                # only draw for rows that have not reached the target number of accepted samples
+                noise_ = sample_noise(dist, (self.num_samples,) + pred[active].size())
+                weights_ = phi(pred[active][None,...] + noise_).float().view(self.num_samples, active.numel(), -1)
+                counts[active] += weights_.sum(0)
+                draws[active] += self.num_samples
+                # the extra rounds only hold the resampled rows
+                rounds.append((active, noise_, weights_))
+                num_draws += self.num_samples
+                active = active[counts[active].amin(-1) < self.min_accepted]
+
+        self.counts, self.draws = counts.amin(-1, keepdim=True), draws
+        return Samples(noise, weights, self.counts, self.draws, tuple(rounds))
+
+
+class InverseCDFSampler(Sampler):
+    """
+    Exact sampler for univariate Gaussian and logistic noise, when the oracle is a union
+    of intervals (ie. one-sided or interval truncation). Picks an interval in
+    proportion to its mass, and then samples within it with the inverse CDF, so that
+    every draw falls within the truncation set. Intervals to the right of the mean are
+    sampled in the mirrored lower tail, which keeps the inverse CDF accurate far into
+    the tails. Falls back to another sampler for other oracles and noise distributions.
+    """
+    def __init__(self,
+                num_samples: int=10,
+                fallback: Sampler=None):
+        """
+        Args:
+            num_samples (int): number of samples to draw per row
+            fallback (delphi.samplers.Sampler): sampler to use when the oracle or noise distribution is not supported; default rejection sampling
+        """
+        super().__init__(num_samples)
+        self.fallback = fallback if fallback is not None else RejectionSampler(num_samples)
+
+    @staticmethod
+    def _standard_form(dist):
+        """
+        Returns the location, scale, cdf and inverse cdf of the standardized noise distribution,
+        or None if the distribution is not supported.
+        """
+        if isinstance(dist, Normal):
+            # ndtr underflows in the lower tail, so we use log_ndtr instead
+            return dist.loc.double(), dist.scale.double(), lambda x: ch.special.log_ndtr(x).exp(), ch.special.ndtri
+        if dist is logistic:
+            return 0.0, 1.0, ch.sigmoid, ch.logit
+        return None
+
+    def __call__(self,
+                pred: Tensor,
+                phi: Callable,
+                dist) -> Samples:
+        intervals, standard_form = _intervals(phi, pred), self._standard_form(dist)
+        if intervals is None or standard_form is None:
+            samples = self.fallback(pred, phi, dist)
+            self.counts, self.draws = samples.counts, samples.draws
+            return samples
+
+        loc, scale, cdf, icdf = standard_form
+        # standardized noise bounds for each interval, size (batch_size, num_intervals)
+        lower = ch.cat([(ch.as_tensor(lower, dtype=ch.float64) - pred.double() - loc) / scale for lower, _ in intervals], dim=1)
+        upper = ch.cat([(ch.as_tensor(upper, dtype=ch.float64) - pred.double() - loc) / scale for _, upper in intervals], dim=1)
+        # mirror intervals in the upper tail, so that we always sample from the lower tail
+        flip = lower > 0
+        lower, upper = ch.where(flip, -upper, lower), ch.where(flip, -lower, upper)
+        cdf_lower, cdf_upper = cdf(lower), cdf(upper)
+        mass = (cdf_upper - cdf_lower).clamp(min=ch.finfo(ch.float64).tiny)
+
+        # pick an interval for each draw, in proportion to its mass
+        if len(intervals) > 1:
+            idx = ch.multinomial(mass, self.num_samples, replacement=True)
+        else:
+            idx = ch.zeros(pred.size(0), self.num_samples, dtype=ch.long)
+        lower, upper, flip = lower.gather(1, idx), upper.gather(1, idx), flip.gather(1, idx)
+        cdf_lower, cdf_upper = cdf_lower.gather(1, idx), cdf_upper.gather(1, idx)
+
+        u = ch.rand(idx.size(), dtype=ch.float64)
+        p = (cdf_lower + u * (cdf_upper - cdf_lower)).clamp(min=ch.finfo(ch.float64).tiny)
+        t = ch.clamp(icdf(p), lower, upper)
+        noise = (loc + scale * ch.where(flip, -t, t)).to(pred.dtype).T[...,None]
+
+        weights = ch.ones(noise.size()[:-1] + (1,))
+        self.counts = self.draws = ch.full((pred.size(0), 1), float(self.num_samples))
+        return Samples(noise, weights, self.counts, self.draws)
+
+
+class ImportanceSampler(Sampler):
+    """
+    Self-normalized importance sampler, with a proposal distribution that translates
+    the noise distribution towards the truncation set. The shift is the distance from
+    the prediction to the closest point of the truncation set for interval oracles, the
+    provided shift function, or the mean accepted noise of a pilot rejection sampling
+    round for all other oracles. Samples are weighted by their likelihood ratio, so rows in
+    the tail of the noise distribution still get accepted samples.
+    """
+    def __init__(self,
+                num_samples: int=10,
+                shift: Callable=None,
+                pilot_samples: int=None):
+        """
+        Args:
+            num_samples (int): number of samples to draw per row
+            shift (Callable): callable that receives the predictions with size (batch_size, k), and returns the proposal's translation with size (batch_size, k)
+            pilot_samples (int): number of pilot samples per row, used to tune the proposal when the oracle is not a union of intervals; default num_samples
+        """
+        super().__init__(num_samples)
+        self.shift = shift
+        self.pilot = RejectionSampler(pilot_samples if pilot_samples is not None else num_samples)
+
+    def _shift(self,
+                pred: Tensor,
+                phi: Callable,
+                dist) -> Tensor:
+        if self.shift is not None:
+            return self.shift(pred)
+        intervals = _intervals(phi, pred)
+        if intervals is not None:
+            # closest point within the truncation set
+            candidates = ch.cat([ch.clamp(pred, ch.as_tensor(lower, dtype=pred.dtype), ch.as_tensor(upper, dtype=pred.dtype))
+                                for lower, upper in intervals], dim=1)
+            closest = (candidates - pred).abs().argmin(dim=1, keepdim=True)
+            return candidates.gather(1, closest) - pred
+        pilot = self.pilot(pred, phi, dist)
+        return pilot.weighted_sum(lambda noise: noise) / pilot.total_weight.clamp(min=1.0)
+
+    def __call__(self,
+                pred: Tensor,
+                phi: Callable,
+                dist) -> Samples:
+        shift = self._shift(pred, phi, dist)
+        eps = sample_noise(dist, (self.num_samples,) + pred.size())
+        noise = shift[None,...] + eps
+        filtered = phi(pred[None,...] + noise).float().view(self.num_samples, pred.size(0), -1).amin(-1, keepdim=True)
+        # likelihood ratio between the noise distribution and the shifted proposal
+        log_ratio = _log_prob(dist, noise) - _log_prob(dist, eps)
+        log_ratio = log_ratio.masked_fill(filtered == 0, float('-inf'))
+        max_ = log_ratio.amax(0, keepdim=True).nan_to_num(neginf=0.0)
+        weights = (log_ratio - max_).exp()
+
+        # rescale the weights so that they sum to the number of accepted samples per row
+        self.counts = filtered.sum(0)
+        weights = weights * self.counts / weights.sum(0).clamp(min=ch.finfo(weights.dtype).tiny)
+        self.draws = ch.full((pred.size(0), 1), float(self.num_samples))
+        return Samples(noise, weights, self.counts, self.draws)
@@ -1,4 +1,5 @@
 from .truncated_linear_regression import TruncatedLinearRegression
+from .batched_truncated_linear_regression import BatchedTruncatedLinearRegression
 from . import truncated_lqr
 # from .truncated_logistic_regression import TruncatedLogisticRegression
 # from .truncated_elastic_net_regression import TruncatedElasticNetRegression
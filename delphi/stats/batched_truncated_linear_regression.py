@@ -0,0 +1,305 @@
+"""
+Batched truncated linear regression, for fitting many independent truncated regressions at once.
+"""
+
+import torch as ch
+from torch import Tensor
+import torch.linalg as LA
+from torch.nn import Parameter
+from torch.distributions import Normal
+import math
+import warnings
+from typing import Callable, List, Union
+
+from .linear_model import LinearModel
+from ..samplers import RejectionSampler
+from ..utils.helpers import Parameters, Bounds, truncated_normal_moments
+from ..utils.defaults import TRUNC_REG_DEFAULTS, TRAINER_DEFAULTS, check_and_fill_args
+
+
+# hyperparameters of TruncatedLinearRegression's Trainer that the lockstep procedure doesn't 
+# implement, and the only value that they can take; a single trial, without early stopping, 
+# convergence checks, iterate averaging or checkpoints
+UNSUPPORTED_ARGS = {name: {**TRUNC_REG_DEFAULTS, **TRAINER_DEFAULTS}[name][1] for name in 
+                    ('rate', 'l1', 'solver', 'max_iter', 'early_stopping', 'n_iter_no_change', 'tol', 
+                    'convergence_window', 'grad_tol', 'param_tol', 'average', 'average_tail', 'adopt_best', 
+                    'trial_workers', 'checkpoint_dir', 'checkpoint_iters')}
+UNSUPPORTED_ARGS['trials'] = 1
+
+
+class BatchedTruncatedLinearRegression(LinearModel):
+    """
+    Fits B independent truncated linear regressions in lockstep. Each problem runs the
+    same projected SGD procedure as delphi.stats.TruncatedLinearRegression, but the
+    OLS initialization, gradients and optimizer steps are computed with batched tensor
+    ops over all of the problems, instead of a python loop over the fits. Since the loss
+    is a sum over the problems, SGD on the stacked parameters is equivalent to running SGD
+    for each problem separately. Problems can have a different number of samples (ragged),
+    and share one oracle, or have one oracle each. The procedure runs a single trial,
+    and returns the final iterate for each problem; hyperparameters of the Trainer's other 
+    features (see UNSUPPORTED_ARGS) raise a ValueError.
+    """
+    def __init__(self,
+                phi: Union[Callable, List[Callable]],
+                args: Parameters,
+                noise_var: ch.Tensor=None,
+                rand_seed: int=0):
+        """
+        Args:
+            phi (delphi.oracle.oracle, List[delphi.oracle.oracle]) : oracle shared by all of the problems, or a list with an oracle for each problem
+            args (delphi.utils.helpers.Parameters) : hyperparameters; see delphi.stats.TruncatedLinearRegression
+            noise_var (torch.Tensor) : noise variance shared by all of the problems, or size (B,) noise variance for each problem; None if unknown
+            rand_seed (int) : random seed for the procedure
+        """
+        unsupported = sorted(name for name, value in UNSUPPORTED_ARGS.items() if name in args.as_dict() and args.as_dict()[name] != value)
+        if unsupported: 
+            raise ValueError('args: {} are not supported by BatchedTruncatedLinearRegression, which runs a single trial, without early stopping, convergence checks, iterate averaging or checkpoints. use TruncatedLinearRegression for each problem instead.'.format(unsupported))
+        # copy the hyperparameters, so that filling in the defaults doesn't change the caller's args
+        super().__init__(Parameters(dict(args.as_dict())), False, defaults=TRUNC_REG_DEFAULTS)
+        self.args = check_and_fill_args(self.args, TRAINER_DEFAULTS)
+        self.phi = phi
+        self.noise_var = noise_var
+        self.rand_seed = rand_seed
+        self.sampler = self.args.sampler if self.args.sampler is not None else RejectionSampler(self.args.num_samples, self.args.min_accepted, self.args.max_samples)
+
+        # property instance variables
+        self.coef, self.intercept, self.variance = None, None, None
+
+    def _stack(self,
+                X: Union[Tensor, List[Tensor]]):
+        """
+        Stacks a (B, n, d) tensor or a ragged list of (n_b, d) tensors into a zero-padded
+        (B, n, d) tensor, and a (B, n) mask for the rows that hold samples.
+        """
+        if isinstance(X, Tensor):
+            assert X.dim() == 3, "X is size: {}. expecting X to have size (B, n, d).".format(X.size())
+            return X, ch.ones(X.size()[:2], dtype=ch.bool)
+        lengths = ch.LongTensor([x.size(0) for x in X])
+        stacked = ch.zeros((len(X), int(lengths.max())) + X[0].size()[1:])
+        for i, x in enumerate(X):
+            stacked[i,:x.size(0)] = x
+        return stacked, ch.arange(stacked.size(1))[None,...] < lengths[...,None]
+
+    def _intervals(self):
+        """
+        Intervals of the truncation set for each problem, stacked into (B, 1, 1) bounds for
+        per-problem oracles. None if the gradients need to sample.
+        """
+        if not isinstance(self.phi, (list, tuple)):
+            intervals = getattr(self.phi, 'intervals', None)
+            return intervals() if intervals is not None else None
+        intervals = [getattr(phi, 'intervals', lambda: None)() for phi in self.phi]
+        if any(int_ is None for int_ in intervals) or len(set(len(int_) for int_ in intervals)) > 1:
+            return None
+        return [(ch.as_tensor([float(int_[i][0]) for int_ in intervals]).view(-1, 1, 1),
+                ch.as_tensor([float(int_[i][1]) for int_ in intervals]).view(-1, 1, 1)) for i in range(len(intervals[0]))]
+
+    def _moments(self,
+                pred: Tensor,
+                scale: Tensor,
+                order: int):
+        """
+        Conditional moments of the noised predictions, given that they fall within each
+        problem's truncation set.
+        Args:
+            pred (torch.Tensor): size (B, batch_size, 1) - predictions
+            scale (torch.Tensor): size (B, 1, 1) - noise standard deviation for each problem
+            order (int): highest moment to compute
+        """
+        if self.intervals is not None:
+            return truncated_normal_moments(pred, scale, self.intervals, order=order)
+        if isinstance(self.phi, (list, tuple)):
+            # arbitrary oracles are evaluated separately for each problem
+            moments = [self._sample_moments(pred[i], scale[i], phi, order) for i, phi in enumerate(self.phi)]
+            return [ch.stack(moment) for moment in zip(*moments)]
+        moments = self._sample_moments(pred.reshape(-1, 1), scale.expand(pred.size()).reshape(-1, 1), self.phi, order)
+        return [moment.view(pred.size()) for moment in moments]
+
+    def _sample_moments(self,
+                        pred: Tensor,
+                        scale: Tensor,
+                        phi: Callable,
+                        order: int):
+        samples = self.sampler(pred, phi, Normal(ch.zeros(1), scale))
+        norm = samples.total_weight + self.args.eps
+        return [samples.weighted_sum(lambda noise, pred: (pred[None,...] + noise).pow(k), pred) / norm for k in range(1, order + 1)]
+
+    def _loss(self,
+                X: Tensor,
+                y: Tensor,
+                mask: Tensor):
+        """
+        Truncated negative log likelihood for each problem, averaged over each problem's
+        rows in the batch, and a surrogate loss whose gradient is the truncated
+        log likelihood's gradient (see delphi.grad.TruncatedMSE and
+        delphi.grad.TruncatedUnknownVarianceMSE).
+        """
+        pred = self(X)
+        mask = mask[...,None].float()
+        counts = mask.sum(1, keepdim=True).clamp(min=1.0)
+        if self.noise_var is not None:
+            with ch.no_grad():
+                z, = self._moments(pred, self.noise_var.sqrt(), order=1)
+            nll = -.5 * y.pow(2) + y * pred + .5 * (z.pow(2) + z * pred)
+            surrogate = (z - y) * pred
+        else:
+            lambda_ = self.lambda_
+            with ch.no_grad():
+                z, z_2 = self._moments(pred, lambda_.inverse().sqrt(), order=2)
+            nll = lambda_ * (-.5 * y.pow(2) + y * pred) - lambda_ * (-.5 * z_2 + z * pred)
+            surrogate = lambda_.detach() * (z - y) * pred + .5 * (y.pow(2) - z_2) * lambda_
+        nll = (mask * nll).sum(1, keepdim=True) / counts
+        surrogate = ((mask * surrogate).sum(1, keepdim=True) / counts).sum()
+        return nll.detach().flatten(), surrogate
+
+    def calc_emp_model(self,
+                        X: Tensor,
+                        y: Tensor,
+                        mask: Tensor) -> None:
+        '''
+        Calculates the OLS estimates for each problem with a batched least squares solve.
+        '''
+        mask = mask[...,None].float()
+        coef_ = LA.lstsq(X * mask, y * mask).solution
+        resid = (X@coef_ - y) * mask
+        n = mask.sum(1, keepdim=True)
+        emp_noise_var = (resid - mask * resid.sum(1, keepdim=True) / n).pow(2).sum(1, keepdim=True) / (n - 1)
+        self.register_buffer('emp_weight', coef_)
+        self.register_buffer('emp_noise_var', emp_noise_var)
+
+    def fit(self,
+            X: Union[Tensor, List[Tensor]],
+            y: Union[Tensor, List[Tensor]]):
+        """
+        Train the truncated linear regressions by running PSGD on the truncated negative
+        population log likelihood of each problem, in lockstep.
+        Args:
+            X (torch.Tensor, List[torch.Tensor]): input feature covariates, size (B, n, d) or a list of B (n_b, d) tensors
+            y (torch.Tensor, List[torch.Tensor]): dependent variable, size (B, n, 1) or a list of B (n_b, 1) tensors
+        """
+        X, mask = self._stack(X)
+        y, _ = self._stack(y)
+        assert y.size()[:2] == X.size()[:2] and y.size(2) == 1, "y is size: {}. expecting y to have size: {}.".format(y.size(), X.size()[:2] + (1,))
+        if isinstance(self.phi, (list, tuple)):
+            assert len(self.phi) == X.size(0), "number of oracles is: {}. expecting one oracle for each of the {} problems.".format(len(self.phi), X.size(0))
+        if self.noise_var is not None:
+            self.noise_var = ch.as_tensor(self.noise_var, dtype=X.dtype).flatten().expand(X.size(0)).reshape(-1, 1, 1)
+        ch.manual_seed(self.rand_seed)
+        B = X.size(0)
+
+        # add one feature to x when fitting intercept
+        if self.args.fit_intercept:
+            X = ch.cat([X, mask[...,None].float()], dim=2)
+
+        # normalize features so that the maximum l_2 norm for each problem is 1
+        l_inf = LA.norm(X, dim=-1, ord=float('inf')).amax(1)
+        self.beta = ch.where(LA.norm(X, dim=-1).amax(1) > 1, l_inf * (X.size(2) ** .5), ch.ones(B)).view(-1, 1, 1)
+        X = X / self.beta
+
+        # separate into training and validation set, as in delphi.utils.datasets.make_train_and_val
+        val = (self.args.val * mask.sum(1)).long()
+        pos = ch.arange(X.size(1))[None,...]
+        train_mask, val_mask = mask & (pos >= val[...,None]), mask & (pos < val[...,None])
+
+        self.calc_emp_model(X, y, train_mask)
+        self.intervals = self._intervals()
+        if self.noise_var is None:
+            assert self.args.alpha is not None, "alpha required, when the noise variance is unknown"
+            self.var_bounds = Bounds(self.emp_noise_var / self.args.r, self.emp_noise_var / self.args.alpha ** 2)
+            lambda_ = self.emp_noise_var.clone().inverse()
+            self.register_parameter('v', Parameter(self.emp_weight.clone() * lambda_))
+            self.register_parameter('lambda_', Parameter(lambda_))
+            params = [{'params': [self.v]}, {'params': [self.lambda_], 'lr': self.args.var_lr}]
+        else:
+            self.register_parameter('weight', Parameter(self.emp_weight.clone()))
+            params = [self.weight]
+        self.optimizer, self.schedule = self.make_optimizer_and_schedule(params)
+
+        self.val_history = []
+        num_batches = math.ceil(int(train_mask.sum(1).max()) / self.args.batch_size)
+        for epoch in range(1, self.args.epochs + 1):
+            # each problem iterates through its own training rows; padded rows are sorted last
+            keys = ch.rand(train_mask.size()) if self.args.shuffle else pos.expand(train_mask.size()).float()
+            order = keys.masked_fill(~train_mask, float('inf')).argsort(dim=1)
+            for i in range(num_batches):
+                idx = order[:,i*self.args.batch_size:(i+1)*self.args.batch_size]
+                X_, y_ = X.gather(1, idx[...,None].expand(-1, -1, X.size(2))), y.gather(1, idx[...,None])
+                self.optimizer.zero_grad()
+                _, surrogate = self._loss(X_, y_, train_mask.gather(1, idx))
+                surrogate.backward()
+                self.optimizer.step()
+                if self.schedule is not None: self.schedule.step()
+                self.iteration_hook()
+
+            if val_mask.any():
+                with ch.no_grad():
+                    self.val_history.append(self._loss(X, y, val_mask)[0])
+        self.val_history = ch.stack(self.val_history) if len(self.val_history) > 0 else None
+
+        # reparameterize the regression's parameters
+        if self.noise_var is None:
+            self.variance = self.lambda_.data.inverse()
+            weight = self.v.data * self.variance
+        else:
+            weight = self.weight.data.clone()
+        # re-scale coefficients
+        weight /= self.beta
+        self.emp_weight /= self.beta
+
+        # assign results from procedure to instance variables
+        if self.args.fit_intercept:
+            self.coef = weight[:,:-1]
+            self.intercept = weight[:,-1]
+        else:
+            self.coef = weight
+        return self
+
+    def iteration_hook(self) -> None:
+        if self.noise_var is None:
+            # project the noise variance back to each problem's domain
+            var = ch.clamp(self.lambda_.data.inverse(), self.var_bounds.lower, self.var_bounds.upper)
+            self.lambda_.data = var.inverse()
+
+    def __call__(self,
+                X: Tensor) -> Tensor:
+        if self.noise_var is None:
+            return X@self.v * self.lambda_.inverse()
+        return X@self.weight
+
+    def predict(self,
+                X: Union[Tensor, List[Tensor]]):
+        """
+        Make predictions for each problem with the regression estimates.
+        """
+        assert self.coef is not None, "must fit model before using predict method"
+        if not isinstance(X, Tensor):
+            return [x@self.coef[i] + self.intercept[i] if self.args.fit_intercept else x@self.coef[i] for i, x in enumerate(X)]
+        if self.args.fit_intercept:
+            return X@self.coef + self.intercept[...,None]
+        return X@self.coef
+
+    @property
+    def coef_(self):
+        """
+        Regression coefficient weights for each problem, size (B, d, 1).
+        """
+        return self.coef.clone()
+
+    @property
+    def intercept_(self):
+        """
+        Regression intercept for each problem, size (B, 1).
+        """
+        if self.intercept is not None:
+            return self.intercept.clone()
+        warnings.warn("intercept not fit, check args input.")
+
+    @property
+    def variance_(self):
+        """
+        Noise variance prediction for each problem, size (B, 1, 1), for
+        linear regression with unknown noise variance algorithm.
+        """
+        if self.noise_var is None:
+            return self.variance.clone()
+        warnings.warn("no variance prediction because regression with known variance was run")
@@ -10,17 +10,23 @@ from cox.store import Store
 import warnings
 import collections
 from torch.nn import Parameter
+from torch.optim import LBFGS
+from torch.distributions import Normal
 from scipy.linalg import lstsq
 from typing import List, Callable
 
 from .linear_model import LinearModel
 from ..grad import TruncatedMSE, TruncatedUnknownVarianceMSE, SwitchGrad
+from ..oracle import _intervals
+from ..samplers import RejectionSampler
 from ..utils.datasets import make_train_and_val
 from ..utils.helpers import Parameters
 from .linear_model import LinearModel
 from ..trainer import Trainer
-from ..utils.helpers import Bounds
-from ..utils.defaults import TRUNC_REG_DEFAULTS, TRUNC_LDS_DEFAULTS
+from ..utils.helpers import Bounds, truncated_normal_moments, truncated_normal_log_mass, tensor_digest, tensor_identity, same_tensors
+from ..utils.streaming import EmpiricalEstimates, SufficientStatistics, iter_chunks
+from ..utils.loaders import ArrayDataset, BlockShuffleLoader
+from ..utils.defaults import TRUNC_REG_DEFAULTS, TRUNC_LDS_DEFAULTS, TRAINER_DEFAULTS, check_and_fill_args
 
 
 class TruncatedLinearRegression(LinearModel):
@@ -51,6 +57,11 @@ class TruncatedLinearRegression(LinearModel):
             r (float) : size for projection set radius 
             rate (float): rate at which to increase the size of the projection set, when procedure does not converge - input as a decimal percentage
             num_samples (int) : number of samples to sample in gradient 
+            min_accepted (int) : if given, keep sampling rows in the gradient until they have min_accepted samples within the truncation set
+            max_samples (int) : maximum number of samples to sample per row in the gradient, when min_accepted is given
+            sampler (delphi.samplers.Sampler) : sampler for the truncated noise in the gradient (ie. InverseCDFSampler, ImportanceSampler); default rejection sampling
+            solver (str) : "sgd" (minibatch PSGD), "lbfgs" (full-batch L-BFGS), "newton" (full-batch Fisher scoring); default "sgd"
+            max_iter (int) : maximum number of iterations for the full-batch solvers
             batch_size (int) : batch size
             lr (float) : initial learning rate for regression weight parameters 
             var_lr (float) : initial learning rate to use for variance parameter in the settign where the variance is unknown 
@@ -72,6 +83,7 @@ class TruncatedLinearRegression(LinearModel):
         self.noise_var = noise_var
         self.rand_seed = rand_seed
         if self.dependent: assert self.noise_var is not None, "if linear dynamical system, noise variance must be known"
+        self.sampler = self.args.sampler if self.args.sampler is not None else RejectionSampler(self.args.num_samples, self.args.min_accepted, self.args.max_samples)
 
         del self.criterion
         del self.criterion_params 
@@ -83,10 +95,17 @@ class TruncatedLinearRegression(LinearModel):
             self.criterion = TruncatedMSE.apply
             self.criterion_params = [ 
                 self.phi, self.noise_var,
-                self.args.num_samples, self.args.eps]
+                self.args.num_samples, self.args.eps, 
+                self.sampler]
 
         # property instance variables 
         self.coef, self.intercept = None, None
+        # (training set key, empirical estimates) from the last call to calc_emp_model
+        self._emp_cache = None
+        # unscaled OLS statistics of the training set, accumulated by fit_out_of_core
+        self._stream_stats = None
+        # state kept between calls to partial_fit
+        self._online_stats, self._online_optimizer, self._online_schedule = None, None, None
 
     def fit(self, 
             X: Tensor, 
@@ -105,13 +124,7 @@ class TruncatedLinearRegression(LinearModel):
         if self.noise_var is not None:
             assert self.noise_var.size(0) == y.size(1), "noise var size is: {}. y size is: {}. expecting noise_var.size(0) == y.size(1)".format(self.noise_var.size(0), y.size(1))
 
-        # add number of samples to args 
-        self.args.__setattr__('T', X.size(0))
-        if self.dependent:
-            self.criterion_params = [ 
-                self.phi, self.args.c_gamma, self.args.alpha, self.args.T, 
-                self.noise_var, self.args.num_samples, self.args.eps,
-            ]
+        self._set_num_samples(X.size(0))
 
         # add one feature to x when fitting intercept
         if self.args.fit_intercept:
@@ -124,12 +137,77 @@ class TruncatedLinearRegression(LinearModel):
             self.beta = l_inf * (X.size(1) ** .5)
 
         self.train_loader, self.val_loader = make_train_and_val(self.args, X / self.beta, y)
-        self.trainer = Trainer(self)
-        best_params, self.history, best_loss = self.trainer.train_model(self.args,
-                                                                        self.train_loader, 
-                                                                        self.val_loader, 
-                                                                        rand_seed=self.rand_seed,
-                                                                        store=self.store)
+        return self._fit_loaders()
+
+    def fit_out_of_core(self, 
+                        X, 
+                        y): 
+        """
+        Train truncated linear regression model on arrays that don't fit in memory, ie. numpy 
+        memory maps (np.load(..., mmap_mode='r')) or PyTables arrays. The covariate scaling and 
+        the training set's OLS statistics are computed in one streaming pass, and PSGD then reads 
+        shuffled minibatches in blocks of args.block_size rows, with the intercept and scaling 
+        applied to each batch. As in fit, the first args.val fraction of the rows is the 
+        validation set. Only supports the sgd solver.
+        Args: 
+            X: input feature covariates num_samples by dims
+            y: dependent variable predictions num_samples by 1
+        """
+        assert self.args.solver == 'sgd', "solver is: {}. out-of-core fits only support the sgd solver.".format(self.args.solver)
+        assert len(X) == len(y), "X has {} rows and y has {} rows. expecting the same number of rows.".format(len(X), len(y))
+        assert len(X) > X.shape[1], "number of dimensions, larger than number of samples. procedure expects matrix with size num samples by num feature dimensions." 
+        assert len(y.shape) == 2 and y.shape[1] <= X.shape[1], "y is size: {}. expecting y array to have y.shape[1] < X.shape[1].".format(y.shape) 
+        if self.noise_var is not None:
+            assert self.noise_var.size(0) == y.shape[1], "noise var size is: {}. y size is: {}. expecting noise_var.size(0) == y.shape[1]".format(self.noise_var.size(0), y.shape[1])
+        self._set_num_samples(len(X))
+
+        # one streaming pass accumulates the training set's unscaled OLS statistics, and the 
+        # maximum row norms of all the rows for the covariate scaling
+        val = int(self.args.val * len(X))
+        self._stream_stats = SufficientStatistics.from_chunks(iter_chunks(X, y, self.args.block_size, start=val), self.args.fit_intercept)
+        self.beta = ch.ones(1, 1)
+        if not self.dependent: 
+            for X_, _ in iter_chunks(X, y, self.args.block_size, stop=val): 
+                self._stream_stats.update_norms(X_)
+            self.beta = self._stream_stats.beta
+
+        def transform(X_, y_): 
+            X_, y_ = X_.to(ch.get_default_dtype()), y_.to(ch.get_default_dtype())
+            if self.args.fit_intercept: 
+                X_ = ch.cat([X_, ch.ones(X_.size(0), 1)], axis=1)
+            return X_ / self.beta, y_
+
+        self.train_loader = BlockShuffleLoader(ArrayDataset(X, y, start=val), batch_size=self.args.batch_size, 
+                                                block_size=self.args.block_size, shuffle=self.args.shuffle, transform=transform)
+        self.val_loader = BlockShuffleLoader(ArrayDataset(X, y, stop=val), batch_size=self.args.batch_size, 
+                                                block_size=self.args.block_size, transform=transform)
+        return self._fit_loaders()
+
+    def _set_num_samples(self, 
+                            T: int): 
+        # add number of samples to args 
+        self.args.__setattr__('T', T)
+        if self.dependent:
+            self.criterion_params = [ 
+                self.phi, self.args.c_gamma, self.args.alpha, self.args.T, 
+                self.noise_var, self.args.num_samples, self.args.eps, 
+                self.sampler,
+            ]
+
+    def _fit_loaders(self): 
+        """
+        Runs the procedure on self.train_loader and self.val_loader, and assigns the estimates.
+        """
+        self._online_stats, self._online_optimizer, self._online_schedule = None, None, None
+        if self.args.solver == 'sgd':
+            self.trainer = Trainer(self)
+            best_params, self.history, best_loss = self.trainer.train_model(self.args,
+                                                                            self.train_loader, 
+                                                                            self.val_loader, 
+                                                                            rand_seed=self.rand_seed,
+                                                                            store=self.store)
+        else: 
+            self.history = self.fit_full_batch(self.train_loader)
 
         # reparameterize the regression's parameters
         if self.noise_var is None: 
@@ -154,13 +232,19 @@ class TruncatedLinearRegression(LinearModel):
     def pretrain_hook(self, 
                       train_loader: ch.utils.data.DataLoader):
         self.calc_emp_model(train_loader)
+        self._init_projection_set()
+        self._init_parameters()
+
+    def _init_projection_set(self): 
         # use OLS as empirical estimate to define projection set
         self.radius = self.args.r * self.base_radius
         # empirical estimates for projection set
         # generate noise variance radius bounds if unknown 
         if self.noise_var is None:
             self.var_bounds = Bounds(float(self.emp_noise_var.flatten() / self.args.r), float(self.emp_noise_var.flatten() / Tensor([self.args.alpha]).pow(2))) 
-        
+
+    def _init_parameters(self): 
+        # initialize the regression's parameters at the empirical estimates
         if self.noise_var is None:
             lambda_ = self.emp_noise_var.clone().inverse()
             self._parameters = [{"params": [Parameter(self.emp_weight.clone() * lambda_)]},
@@ -168,33 +252,260 @@ class TruncatedLinearRegression(LinearModel):
 
             self.criterion_params = [ 
                 self._parameters[1]["params"], self.phi,
-                self.args.num_samples, self.args.eps,
+                self.args.num_samples, self.args.eps, 
+                self.sampler,
             ]
         else:
             self.register_parameter("weight", Parameter(self.emp_weight.clone()))
 
+    def partial_fit(self, 
+                    X: Tensor, 
+                    y: Tensor): 
+        """
+        Online update of the regression's estimates with a new batch of data. Takes projected 
+        SGD steps, in minibatches of args.batch_size, on only the new data. The optimizer and 
+        learning rate schedule, the parameters, and the running OLS sufficient statistics are 
+        kept between calls; the empirical estimates and the variance projection set are 
+        updated from the sufficient statistics after each batch. The first call initializes the 
+        parameters at the batch's OLS estimates, and fixes the covariate scaling, so it 
+        must have more samples than features. Calling fit discards the online state.
+        Args: 
+            X (torch.Tensor): input feature covariates batch_size by dims
+            y (torch.Tensor): dependent variable predictions batch_size by 1
+        """
+        assert isinstance(X, Tensor), "X is type: {}. expected type torch.Tensor.".format(type(X))
+        assert isinstance(y, Tensor), "y is type: {}. expected type torch.Tensor.".format(type(y))
+        assert y.dim() == 2 and y.size(0) == X.size(0), "y is size: {}. expecting y tensor to have size ({}, 1).".format(y.size(), X.size(0)) 
+        assert not self.dependent, "partial_fit is not supported for linear dynamical systems"
+        if self.args.fit_intercept:
+            X = ch.cat([X, ch.ones(X.size(0), 1)], axis=1)
+
+        if self._online_stats is None: 
+            # the first batch fixes the covariate scaling, and the parameters' OLS initialization
+            assert X.size(0) > X.size(1), "first batch has {} samples. expecting more samples than the {} features (including the intercept), to initialize the parameters at the batch's OLS estimates.".format(X.size(0), X.size(1))
+            self._set_num_samples(X.size(0))
+            # normalize features so that the maximum l_2 norm is 1
+            self.beta = ch.ones(1, 1)
+            if X.norm(dim=1, p=2).max() > 1:  
+                l_inf = LA.norm(X, dim=-1, ord=float('inf')).max()
+                self.beta = l_inf * (X.size(1) ** .5)
+            self._online_stats = SufficientStatistics()
+        X = X / self.beta
+        self._online_stats.update(X, y)
+        self._assign_emp_estimates(self._online_stats.estimates())
+        self._init_projection_set()
+
+        if self._online_optimizer is None: 
+            ch.manual_seed(self.rand_seed)
+            self._init_parameters()
+            params = self._parameters if self.noise_var is None else [self.weight]
+            self._online_optimizer, self._online_schedule = self.make_optimizer_and_schedule(params)
+        else: 
+            self.args.__setattr__('T', self.args.T + X.size(0))
+
+        if self.args.shuffle: 
+            perm = ch.randperm(X.size(0))
+            X, y = X[perm], y[perm]
+        for i in range(0, X.size(0), self.args.batch_size): 
+            batch = (X[i:i + self.args.batch_size], y[i:i + self.args.batch_size])
+            self._online_optimizer.zero_grad()
+            pred = self(*batch)
+            loss = self.criterion(pred, batch[1], *self.criterion_params).sum() + self.regularize(batch)
+            loss.backward()
+            self.pre_step_hook(batch[0])
+            self._online_optimizer.step()
+            if self._online_schedule is not None: self._online_schedule.step()
+            self.iteration_hook(i, True, loss, batch)
+
+        # assign estimates without detaching the parameters, so that later calls continue from them
+        if self.noise_var is None: 
+            self.variance = self._parameters[1]['params'][0].data.inverse()
+            weight = self._parameters[0]['params'][0].data * self.variance
+        else: 
+            weight = self.weight.data.clone()
+        weight = weight / self.beta
+        if self.args.fit_intercept: 
+            self.coef, self.intercept = weight[:-1], weight[-1]
+        else: 
+            self.coef = weight
+        return self
+
+    def fit_full_batch(self, 
+                        train_loader: ch.utils.data.DataLoader) -> Tensor: 
+        """
+        Deterministic full-batch procedure, that runs L-BFGS or Fisher scoring (Newton's method) on the 
+        whole training set. When the oracle has closed-form intervals, L-BFGS uses a strong Wolfe 
+        line search on the exact truncated negative log likelihood; otherwise, it takes lr sized 
+        steps along the sampled gradients from delphi.grad. Fisher scoring takes Newton steps in 
+        the natural parameters, where the Hessian is the covariance of the truncated normal's 
+        sufficient statistics. The variance projection set is applied after each iteration.
+        Args: 
+            train_loader (ch.utils.data.DataLoader): training set loader
+        Returns: 
+            size (num_iter, d, 1) history of the regression weight iterates
+        """
+        assert not self.dependent, "full-batch solvers are not supported for linear dynamical systems"
+        self.args = check_and_fill_args(self.args, TRAINER_DEFAULTS)
+        X, y = train_loader.dataset.tensors
+        assert y.size(1) == 1, "y is size: {}. full-batch solvers expect y.size(1) == 1.".format(y.size())
+        ch.manual_seed(self.rand_seed)
+        self.pretrain_hook(train_loader)
+        self.intervals = _intervals(self.phi, y)
+        if self.noise_var is None: 
+            # wrap the variance parameter in a list, as the torch optimizers do for the sgd procedure
+            self._parameters[1]['params'] = [self._parameters[1]['params']]
+        params = [self.weight] if self.noise_var is not None else [self._parameters[0]['params'][0], self._parameters[1]['params'][0]]
+
+        history = []
+        if self.args.solver == 'lbfgs': 
+            exact = self.intervals is not None
+            # one iteration per step, so that the projection set is applied after each iteration
+            optimizer = LBFGS(params, lr=1.0 if exact else self.args.lr, max_iter=1, max_eval=25, 
+                                line_search_fn='strong_wolfe' if exact else None)
+            def closure(): 
+                optimizer.zero_grad()
+                pred = self(X, y)
+                loss = self.full_batch_nll(pred, y) if exact else self.criterion(pred, y, *self.criterion_params).sum()
+                loss.backward()
+                if self.noise_var is not None: return loss
+                # freeze the variance at the projection set's boundary, when its gradient points outside of the set
+                lambda_ = params[1]
+                var = float(lambda_.data.inverse())
+                if (var <= self.var_bounds.lower * (1 + 1e-6) and lambda_.grad < 0) or (var >= self.var_bounds.upper * (1 - 1e-6) and lambda_.grad > 0): 
+                    lambda_.grad.zero_()
+                return loss
+        
+        for i in range(self.args.max_iter): 
+            prev = ch.cat([param.data.flatten() for param in params])
+            if self.args.solver == 'lbfgs': 
+                loss = optimizer.step(closure)
+            else: 
+                loss = self.newton_step(X, y)
+            self.iteration_hook(i, True, loss, None)
+            history.append(params[0].data.clone()[None,...])
+            # the first l-bfgs step is scaled down, before there is curvature information
+            if (i > 0 or self.args.solver == 'newton') and ch.norm(ch.cat([param.data.flatten() for param in params]) - prev) < self.args.tol: 
+                if self.args.verbose: print(f'Convergence after {i + 1} iterations')
+                break
+
+        self.post_training_hook()
+        return ch.cat(history)
+
+    def full_batch_nll(self, 
+                        pred: Tensor, 
+                        targ: Tensor) -> Tensor: 
+        """
+        Exact truncated negative log likelihood (up to a constant), for oracles with 
+        closed-form intervals.
+        """
+        if self.noise_var is not None: 
+            return (.5 * (targ - pred).pow(2) / self.noise_var + truncated_normal_log_mass(pred, self.noise_var.sqrt(), self.intervals)).mean()
+        lambda_ = self._parameters[1]['params'][0]
+        return (.5 * lambda_ * (targ - pred).pow(2) - .5 * ch.log(lambda_) + truncated_normal_log_mass(pred, lambda_.inverse().sqrt(), self.intervals)).mean()
+
+    def _moments(self, 
+                pred: Tensor, 
+                scale: Tensor, 
+                order: int): 
+        # conditional moments of the noised predictions, closed-form when possible
+        if self.intervals is not None: 
+            return truncated_normal_moments(pred, scale, self.intervals, order=order)
+        samples = self.sampler(pred, self.phi, Normal(ch.zeros(1), scale.flatten()))
+        norm = samples.total_weight + self.args.eps
+        return [samples.weighted_sum(lambda noise, pred: (pred[None,...] + noise).pow(k), pred) / norm for k in range(1, order + 1)]
+
+    def newton_step(self, 
+                    X: Tensor, 
+                    y: Tensor) -> Tensor: 
+        """
+        Fisher scoring step in the truncated normal's natural parameters. Since the truncated normal 
+        is an exponential family, the Hessian of the negative log likelihood is the covariance of 
+        the sufficient statistics (z * x, -z^2 / 2) under the truncated distribution. Backtracks on 
+        the exact negative log likelihood when the oracle has closed-form intervals.
+        """
+        with ch.no_grad(): 
+            n = X.size(0)
+            if self.noise_var is not None: 
+                params = [self.weight]
+                z, z_2 = self._moments(X@self.weight, self.noise_var.sqrt(), order=2)
+                grad = X.T@(z - y) / (n * self.noise_var)
+                hess = X.T@(X * (z_2 - z.pow(2))) / (n * self.noise_var.pow(2))
+            else: 
+                params = [self._parameters[0]['params'][0], self._parameters[1]['params'][0]]
+                v, lambda_ = params
+                z, z_2, z_3, z_4 = self._moments(X@v * lambda_.inverse(), lambda_.inverse().sqrt(), order=4)
+                grad = ch.cat([X.T@(z - y), (.5 * (y.pow(2) - z_2)).sum(0, keepdim=True)]) / n
+                cov = -.5 * (z_3 - z * z_2)
+                hess = ch.cat([ch.cat([X.T@(X * (z_2 - z.pow(2))), X.T@cov], dim=1), 
+                                ch.cat([cov.T@X, (.25 * (z_4 - z_2.pow(2))).sum(0, keepdim=True)], dim=1)]) / n
+            step = LA.solve(hess + self.args.eps * ch.eye(hess.size(0)), grad)
+
+            theta = ch.cat([param.data.flatten() for param in params])
+            loss, t = None, 1.0
+            if self.intervals is not None: 
+                loss = self.full_batch_nll(self(X, y), y)
+            while True: 
+                new_theta = theta - t * step.flatten()
+                params[0].data = new_theta[:params[0].numel()].view(params[0].size())
+                if len(params) > 1: params[1].data = new_theta[params[0].numel():].view(params[1].size())
+                if self.intervals is None: break
+                self.iteration_hook(0, True, None, None)
+                new_loss = self.full_batch_nll(self(X, y), y)
+                # halve the step until the negative log likelihood decreases
+                if new_loss <= loss or t < 1e-4: 
+                    loss = new_loss
+                    break
+                t /= 2
+            return loss
+
     def calc_emp_model(self, 
                         train_loader: ch.utils.data.DataLoader) -> None: 
         '''
         Calculates empirical estimates for a truncated linear model. Assigns 
         estimates to a Linear layer. By default calculates OLS for truncated linear regression.
+        The estimates are cached by the training tensors' identity, so later trials on the same 
+        training set don't recompute them; with cache_by_content, the cache is keyed on a hash 
+        of the training set's contents instead, so that it also carries across fits. Out-of-core 
+        fits solve OLS from the sufficient statistics accumulated by fit_out_of_core, and other 
+        datasets that aren't held in memory are streamed through the loader once.
         '''
-        X, y = train_loader.dataset.tensors
-        coef_, _, self.rank_, self.singular_ = lstsq(X, y)
-        self.ols_coef_ = Tensor(coef_)
-        self.register_buffer('emp_noise_var', ch.var(Tensor(X@coef_) - y, dim=0)[..., None])
+        if not hasattr(train_loader.dataset, 'tensors'): 
+            if self._stream_stats is not None and train_loader is self.train_loader: 
+                estimates = self._stream_stats.estimates(beta=self.beta, s=float(self.s) if self.dependent else None)
+            else: 
+                estimates = SufficientStatistics.from_chunks(train_loader).estimates(s=float(self.s) if self.dependent else None)
+            if self.dependent: 
+                assert ch.det(estimates.Sigma_0) != 0, 'Sigma_0 is singular and non-invertible'
+            self._emp_cache = (None, estimates)
+        else: 
+            X, y = train_loader.dataset.tensors
+            if self.args.cache_by_content: 
+                key = tensor_digest(X, y)
+                hit = self._emp_cache is not None and self._emp_cache[0] == key
+            else: 
+                key = tensor_identity(X, y)
+                hit = self._emp_cache is not None and isinstance(self._emp_cache[0], tuple) and same_tensors(self._emp_cache[0], X, y)
+            if not hit: 
+                coef_, _, rank_, singular_ = lstsq(X, y)
+                emp_noise_var = ch.var(Tensor(X@coef_) - y, dim=0)[..., None]
+                Sigma_0 = None
+                if self.dependent: 
+                    Sigma_0 = (1 / (self.s * len(X))) * (X.T@X)
+                    assert ch.det(Sigma_0) != 0, 'Sigma_0 is singular and non-invertible'
+                self._emp_cache = (key, EmpiricalEstimates(Tensor(coef_), emp_noise_var, rank_, singular_, Sigma_0))
+        self._assign_emp_estimates(self._emp_cache[1])
+
+    def _assign_emp_estimates(self, 
+                                estimates: EmpiricalEstimates) -> None: 
+        self.ols_coef_, self.rank_, self.singular_ = estimates.coef.clone(), estimates.rank, estimates.singular
+        self.register_buffer('emp_noise_var', estimates.noise_var.clone())
         if self._emp_weight is None: 
-            self.register_buffer('emp_weight', Tensor(coef_))
+            self.register_buffer('emp_weight', estimates.coef.clone())
         else: 
             self.register_buffer('emp_weight', self._emp_weight)
         
         if self.dependent:
-            calc_sigma_0 = lambda X: ch.bmm(X.view(X.size(0), X.size(1), 1), \
-                        X.view(X.size(0), 1, X.size(1))).sum(0)
-            XXT_sum = calc_sigma_0(X)
-            Sigma_0 = ((1 / (self.s * len(X))) * XXT_sum)
-            self.register_buffer('Sigma_0', Sigma_0)
-            assert ch.det(self.Sigma_0) != 0, 'Sigma_0 is singular and non-invertible'
+            self.register_buffer('Sigma_0', estimates.Sigma_0.clone())
             self.register_buffer('Sigma', self.Sigma_0.clone())
 
     def post_training_hook(self): 
@@ -318,7 +629,7 @@ class TruncatedLinearRegression(LinearModel):
     def parameters(self) -> List: 
         if self._parameters is None: 
             raise "model parameters are not set"
-        elif isinstance(self._parameters, collections.OrderedDict):
+        elif isinstance(self._parameters, dict):
             return self._parameters.values()
         return self._parameters
 
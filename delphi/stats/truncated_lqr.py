@@ -1,17 +1,127 @@
 import torch.linalg as LA
 import torch as ch
 import numpy as np
+from torch import Tensor
 from typing import Callable
 import logging
+import os
+import dill
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from cox.store import Store
 
 from .truncated_linear_regression import TruncatedLinearRegression
-from ..utils.helpers import Parameters, calc_spectral_norm, calc_thickness
+from ..utils.helpers import Parameters, ThicknessMonitor, TrajectoryBuffer, calc_spectral_norm, get_rng_state, load_checkpoint, save_checkpoint, set_rng_state
 from ..utils.defaults import TRUNCATED_LQR_DEFAULTS, check_and_fill_args
 
 logger = logging.getLogger('truncated-lqr')
 logger.setLevel(logging.INFO)
 
+LQR_CKPT_NAME = 'lqr_checkpoint.pt'
+# largest sample bound to preallocate trajectory buffers for; otherwise the buffers grow
+MAX_PREALLOC = 100000
+
+
+def _buffer_capacity(T: int) -> int: 
+  return T if T <= MAX_PREALLOC else 1024
+
+
+class LinearController: 
+  """
+  Controls of the warm start phase, for fixed estimates (A_hat, B_hat) of an LQR system 
+  x_{t+1} = x_t A + u_t B + w_t. The gains are computed once per phase from the 
+  pseudo-inverse of B_hat (B^+ = (B^T B)^{-1} B^T for B with full column rank, computed with 
+  an SVD), and applied to a batch of states with a single matmul.
+  """
+  def __init__(self, 
+                A: Tensor, 
+                B: Tensor): 
+    """
+    Args: 
+      A (torch.Tensor): size (d, d) - estimate of A
+      B (torch.Tensor): size (m, d) - estimate of B
+    """
+    # size (d, m)
+    self.B_pinv = LA.pinv(B)
+    # stabilizing gain, that cancels the dynamics of the estimates
+    self.K = -A@self.B_pinv
+
+  def stabilize(self, x: Tensor) -> Tensor: 
+    """
+    Controls that steer the states x, with size (n, d), to the origin.
+    """
+    return x@self.K
+
+  def excite(self, e: Tensor) -> Tensor: 
+    """
+    Controls that move the origin to the states e, with size (n, d).
+    """
+    return e@self.B_pinv
+
+
+class LockstepEnvs: 
+  """
+  State of num_envs copies of an LQR system that are simulated in lockstep, for batched 
+  sample collection. Each environment runs one trajectory at a time, with its own state, 
+  phase of the controller (ie. exploration or stabilization) and exploration index. When 
+  a trajectory is truncated, the environment is refilled with a new trajectory from the 
+  origin, until num_traj trajectories have been started. Samples are recorded with the id 
+  of their trajectory, so that they can be grouped by trajectory after collection.
+  """
+  def __init__(self, 
+                num_envs: int, 
+                d: int, 
+                num_traj: int, 
+                buffer: TrajectoryBuffer): 
+    """
+    Args: 
+      num_envs (int): number of environments
+      d (int): dimension of the state
+      num_traj (int): total number of trajectories to run
+      buffer (TrajectoryBuffer): buffer to record the samples (x_t, u_t, y_t) to
+    """
+    num_envs = max(1, min(num_envs, num_traj))
+    self.x = ch.zeros(num_envs, d)
+    self.phase = ch.zeros(num_envs, dtype=ch.long)
+    self.index = ch.arange(num_envs)
+    self.traj = ch.arange(num_envs)
+    self.active = ch.ones(num_envs, dtype=ch.bool)
+    self.num_traj, self.started = num_traj, num_envs
+    self.buffer, self.ids = buffer, TrajectoryBuffer(1, capacity=buffer.buffers[0].size(0), dtype=ch.long)
+
+  def record(self, 
+              envs: Tensor, 
+              x: Tensor, 
+              u: Tensor, 
+              y: Tensor) -> None: 
+    """
+    Records the samples of the environments envs.
+    """
+    self.buffer.append(x, u, y)
+    self.ids.append(self.traj[envs][:, None])
+
+  def end(self, 
+          envs: Tensor) -> None: 
+    """
+    Ends the trajectories of the environments envs, and refills them with new trajectories.
+    """
+    refill = envs[:min(envs.size(0), max(0, self.num_traj - self.started))]
+    self.active[envs[refill.size(0):]] = False
+    self.x[refill], self.phase[refill] = 0, 0
+    self.traj[refill] = self.started + ch.arange(refill.size(0))
+    self.started += refill.size(0)
+
+  def trajectories(self) -> tuple: 
+    """
+    The recorded samples, grouped by trajectory, and the start index of each trajectory 
+    followed by the number of samples.
+    """
+    ids = self.ids.tensors[0].flatten()
+    order = ids.argsort(stable=True)
+    counts = ch.unique_consecutive(ids[order], return_counts=True)[1]
+    offsets = ch.cat([ch.zeros(1, dtype=ch.long), counts.cumsum(0)])
+    return tuple(tensor[order] for tensor in self.buffer.tensors), offsets
+
 
 class TruncatedLQR:
   def __init__(self, 
@@ -28,6 +138,8 @@ class TruncatedLQR:
       gen_data: (Callable) - callable that takes () as inputs, and returns ()
       d: (int) - dimension of matrix A 
       m: (int) - second dimension for matrix B (m >= d)
+    If args.checkpoint_dir is given, the collected data and the estimates are checkpointed after each 
+    stage of each phase, and fit resumes from the last checkpointed stage.
     """
     
     self.args = check_and_fill_args(args, TRUNCATED_LQR_DEFAULTS)
@@ -44,10 +156,60 @@ class TruncatedLQR:
     self.c = (self.args.R - 3 * (self.m ** .5)) / self.args.U_B
     logger.info(f'c: {self.c}')
 
+    self.checkpoint_path = os.path.join(self.args.checkpoint_dir, LQR_CKPT_NAME) if self.args.checkpoint_dir is not None else None
+    # completed stages, from an earlier run
+    self.checkpoint = load_checkpoint(self.checkpoint_path) or {}
+
+  def _sample(self, 
+              x_t: Tensor, 
+              u_t: Tensor) -> tuple: 
+    """
+    Simulates one step for a batch of states. Uses gen_data.batch(x_t, u_t), which returns 
+    (y_t, u_t, accepted) with a boolean mask of the samples that weren't truncated, if the 
+    simulator provides it; otherwise, calls gen_data once per state.
+    """
+    if hasattr(self.gen_data, 'batch'): 
+      y_t, u_t, accepted = self.gen_data.batch(x_t, u_t)
+      return y_t, u_t, accepted.flatten().bool()
+    y_t, u_out, accepted = ch.zeros_like(x_t), u_t.clone(), ch.zeros(x_t.size(0), dtype=ch.bool)
+    for i in range(x_t.size(0)): 
+      sample = self.gen_data(x_t[i:i+1], u_t=u_t[i:i+1])
+      if sample is not None: 
+        y_t[i], u_out[i], accepted[i] = sample[0][0], sample[1][0], True
+    return y_t, u_out, accepted
+
   def fit(self): 
     self.run_phase_one()
     self.run_phase_two()
     self.run_warm_phase()
+    # the run is complete, so later runs start from scratch
+    if self.checkpoint_path is not None and os.path.isfile(self.checkpoint_path): 
+      os.remove(self.checkpoint_path)
+
+  def _save_stage(self, 
+                  stage: str, 
+                  **state) -> None: 
+    '''
+    Checkpoints a completed stage, with the RNG state and the projection set radius after the stage.
+    '''
+    if self.checkpoint_path is None: 
+      return
+    state.update({'rng': get_rng_state(), 'r': self.args.r})
+    self.checkpoint[stage] = state
+    save_checkpoint(self.checkpoint, self.checkpoint_path)
+
+  def _resume_stage(self, 
+                    stage: str) -> dict: 
+    '''
+    Returns the state of a checkpointed stage, and restores the RNG state and projection set radius 
+    after the stage, or returns None if the stage hasn't been checkpointed.
+    '''
+    state = self.checkpoint.get(stage)
+    if state is not None: 
+      logger.info(f'resuming from checkpointed stage: {stage}')
+      set_rng_state(state['rng'])
+      self.args.r = state['r']
+    return state
 
   def run_phase_one(self, 
                     store: Store = None):
@@ -59,52 +221,126 @@ class TruncatedLQR:
         number of trajectories taken
       '''
       # assert self.args.target_thickness != float('inf') or self.args.num_traj_phase_one != float('inf') or self.T_phase_one != float('inf'), f"all stopping conditions are {float('inf')}, need to provide at least one stopping variable: (T, num_traj, target_thickness), that isn't infinity"
+      state = self._resume_stage('phase_one')
+      if state is not None: 
+        self.A_hat_ = state['A_hat_']
+        return
+
       logger.info(f'begin cold start phase one...')
+      data = self._resume_stage('phase_one_data')
+      if data is not None: 
+        X, U, Y, self.offsets_phase_one_ = data['X'], data['U'], data['Y'], data['offsets']
+      else: 
+        X, U, Y = self._collect_phase_one()
+        self._save_stage('phase_one_data', X=X, U=U, Y=Y, offsets=self.offsets_phase_one_)
+
+      self.trunc_lds_phase_one = TruncatedLinearRegression(
+                                            self.args.phi,
+                                            self.args,
+                                            self.gen_data.noise_var, 
+                                            dependent=True, 
+                                            store=store, 
+                                            rand_seed=self.rand_seed)
+      self.trunc_lds_phase_one.fit(X, Y)
+      self.A_hat_ = self.trunc_lds_phase_one.coef_
+      self._save_stage('phase_one', A_hat_=self.A_hat_)
+
+  def _collect_phase_one(self): 
+      '''
+      Collects the phase one trajectories, with no control input. The start index of each 
+      trajectory is kept in offsets_phase_one_.
+      '''
+      if self.args.num_envs > 1: 
+        return self._collect_phase_one_batched()
       num_trajectories = 1
       total_samples = 0
       x_t = ch.zeros((1, self.d))
-      X, Y, U = ch.Tensor([]), ch.Tensor([]), ch.Tensor([])
-      covariate_matrix = ch.zeros([self.d,self.d])
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_phase_one))
+      thickness = ThicknessMonitor(self.d, self.args.target_thickness)
 
-      while (num_trajectories < self.args.num_traj_phase_one and X.size(0) < self.args.T_phase_one 
-          and calc_thickness(covariate_matrix) < self.args.target_thickness):
+      while (num_trajectories < self.args.num_traj_phase_one and len(buffer) < self.args.T_phase_one 
+          and not thickness.reached()):
           sample = self.gen_data(x_t, u_t=ch.zeros((1, self.m)))
           total_samples += 1
           if sample is not None:
               y_t, u_t = sample
-              X, Y, U = ch.cat((X,x_t)), ch.cat((Y,y_t)), ch.cat((U, u_t))
-              covariate_matrix += x_t.T@x_t
+              buffer.append(x_t, u_t, y_t)
+              thickness.update(x_t)
               x_t = y_t
           else:
               x_t = ch.zeros((1, self.d))
               num_trajectories += 1
+              buffer.end_trajectory()
 
-          if X.size(0) % 100 == 0:
-              logger.info(f'total number of samples: {X.size(0)}')
+          if len(buffer) % 100 == 0:
+              logger.info(f'total number of samples: {len(buffer)}')
+      self.offsets_phase_one_ = buffer.offsets
+      return buffer.tensors
 
-      self.trunc_lds_phase_one = TruncatedLinearRegression(
-                                            self.args.phi,
-                                            self.args,
-                                            self.gen_data.noise_var, 
-                                            dependent=True, 
-                                            store=store, 
-                                            rand_seed=self.rand_seed)
-      self.trunc_lds_phase_one.fit(X, Y)
-      self.A_hat_ = self.trunc_lds_phase_one.coef_
+  def _collect_phase_one_batched(self): 
+      '''
+      Collects the phase one trajectories in args.num_envs environments in lockstep.
+      '''
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_phase_one))
+      thickness = ThicknessMonitor(self.d, self.args.target_thickness)
+      # the sequential collection stops after num_traj_phase_one - 1 trajectories
+      envs = LockstepEnvs(self.args.num_envs, self.d, self.args.num_traj_phase_one - 1, buffer)
+
+      while envs.active.any() and len(buffer) < self.args.T_phase_one and not thickness.reached(): 
+          active = envs.active.nonzero()[:,0]
+          x_t = envs.x[active]
+          y_t, u_t, accepted = self._sample(x_t, ch.zeros(active.size(0), self.m))
+          envs.record(active[accepted], x_t[accepted], u_t[accepted], y_t[accepted])
+          thickness.update(x_t[accepted])
+          envs.x[active[accepted]] = y_t[accepted]
+          envs.end(active[~accepted])
+          logger.info(f'total number of samples: {len(buffer)}')
+
+      (X, U, Y), self.offsets_phase_one_ = envs.trajectories()
+      return X, U, Y
 
   def run_phase_two(self, 
                     store: Store=None): 
       '''
       Cold start phase 2. Initial estimation for B.
       '''
+      state = self._resume_stage('phase_two')
+      if state is not None: 
+        self.B_hat_ = state['B_hat_']
+        return
+
       logger.info(f'begin cold start phase two...')
+      data = self._resume_stage('phase_two_data')
+      if data is not None: 
+        U, Y = data['U'], data['Y']
+      else: 
+        U, Y = self._collect_phase_two()
+        self._save_stage('phase_two_data', U=U, Y=Y)
+
+      self.trunc_lds_phase_two = TruncatedLinearRegression(
+                                            self.args.phi,
+                                            self.args, 
+                                            self.gen_data.noise_var,
+                                            dependent=True, 
+                                            store=store, 
+                                            rand_seed=self.rand_seed)
+      self.trunc_lds_phase_two.fit(U, Y)
+      self.B_hat_ = self.trunc_lds_phase_two.coef_
+      self._save_stage('phase_two', B_hat_=self.B_hat_)
+
+  def _collect_phase_two(self): 
+      '''
+      Collects the phase two samples, with the control inputs c * e_i.
+      '''
+      if self.args.num_envs > 1: 
+        return self._collect_phase_two_batched()
       total_samples, index = 0, 0
       xt, id_ = ch.zeros([1, self.d]), ch.eye(self.m)
-      U, Y = ch.Tensor([]), ch.Tensor([])
-      covariate_matrix = ch.zeros([self.m, self.m])
+      buffer = TrajectoryBuffer(self.m, self.d, capacity=_buffer_capacity(self.args.T_phase_two))
+      thickness = ThicknessMonitor(self.m, self.args.target_thickness)
 
-      while (total_samples < self.args.num_traj_phase_two and U.size(0) < self.args.T_phase_two 
-          and calc_thickness(covariate_matrix) < self.args.target_thickness):
+      while (total_samples < self.args.num_traj_phase_two and len(buffer) < self.args.T_phase_two 
+          and not thickness.reached()):
           u = (self.c*id_[index])[None,...]
           sample = self.gen_data(xt, u_t=u)
         
@@ -112,21 +348,36 @@ class TruncatedLQR:
           if sample is not None: 
               y, u = sample
               index = (index+1)%self.m
-              U, Y = ch.cat([U, u]), ch.cat([Y, y])
-              covariate_matrix += u.T@u
+              # every sample starts from the zero state, so is a trajectory of its own
+              buffer.append(u, y)
+              buffer.end_trajectory()
+              thickness.update(u)
           
-          if U.size(0) % 100 == 0: 
-              logger.info(f'total number of samples: {U.size(0)}')
+          if len(buffer) % 100 == 0: 
+              logger.info(f'total number of samples: {len(buffer)}')
+      return buffer.tensors
 
-      self.trunc_lds_phase_two = TruncatedLinearRegression(
-                                            self.args.phi,
-                                            self.args, 
-                                            self.gen_data.noise_var,
-                                            dependent=True, 
-                                            store=store, 
-                                            rand_seed=self.rand_seed)
-      self.trunc_lds_phase_two.fit(U, Y)
-      self.B_hat_ = self.trunc_lds_phase_two.coef_
+  def _collect_phase_two_batched(self): 
+      '''
+      Collects the phase two samples args.num_envs at a time. Each environment cycles through 
+      the control inputs c * e_i, and moves on to the next input once a sample is accepted.
+      '''
+      buffer = TrajectoryBuffer(self.m, self.d, capacity=_buffer_capacity(self.args.T_phase_two))
+      thickness = ThicknessMonitor(self.m, self.args.target_thickness)
+      id_ = ch.eye(self.m)
+      index = ch.arange(self.args.num_envs) % self.m
+      total_samples = 0
+
+      while (total_samples < self.args.num_traj_phase_two and len(buffer) < self.args.T_phase_two 
+          and not thickness.reached()):
+          n = min(self.args.num_envs, self.args.num_traj_phase_two - total_samples)
+          y, u, accepted = self._sample(ch.zeros(n, self.d), self.c * id_[index[:n]])
+          total_samples += n
+          buffer.append(u[accepted], y[accepted])
+          thickness.update(u[accepted])
+          index[:n] = (index[:n] + accepted.long()) % self.m
+          logger.info(f'total number of samples: {len(buffer)}')
+      return buffer.tensors
 
   def find_max(self, 
                 L, 
@@ -148,16 +399,19 @@ class TruncatedLQR:
     return output
 
   @staticmethod
-  def calculate_u_t_one(a, b, x): 
-    return (-b@LA.inv(b.T@b)@a.T@x.T).T
+  def calculate_u_t_one(controller, x): 
+    return controller.stabilize(x)
 
   def generate_samples_B(self):
       logger.info('begin b focused part...')
+      if self.args.num_envs > 1: 
+        return self._generate_samples_B_batched()
       traj, total_samples = 0, 0
-      X, Y, U = ch.zeros([1, self.d]), ch.zeros([1, self.d]), ch.zeros([1, self.m])
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_gen_samples_B))
       index = 0
       id_ = ch.eye(self.m)
-      covariate_matrix = ch.zeros([self.d+self.m,self.d+self.m])
+      thickness = ThicknessMonitor(self.d+self.m, self.args.target_thickness)
+      controller = LinearController(self.A_hat_, self.B_hat_)
 
       xt = ch.zeros((1, self.d))
       target = (1/(self.args.eps2**2)-1/(self.args.eps1**2))*4
@@ -167,8 +421,8 @@ class TruncatedLQR:
       '''
       TODO: figure out a way to do better stopping criteria
       ''' 
-      while (traj < self.args.num_traj_gen_samples_B and X.size(0) < self.args.T_gen_samples_B 
-          and calc_thickness(covariate_matrix) < self.args.target_thickness):
+      while (traj < self.args.num_traj_gen_samples_B and len(buffer) < self.args.T_gen_samples_B 
+          and not thickness.reached()):
           traj += 1
           xt = ch.zeros((1, self.d))
           responsive = True
@@ -178,57 +432,95 @@ class TruncatedLQR:
             total_samples += 1
             if sample is not None:
               yt, ut = sample
-              X, Y, U = ch.cat((X,xt)), ch.cat((Y,yt)), ch.cat((U,ut))
+              buffer.append(xt, ut, yt)
               xu = ch.cat([xt, ut], dim=1) 
-              covariate_matrix += xu.T@xu
+              thickness.update(xu)
               xt = yt
               index = (index+1)%self.m
             else: 
               break
             while True:
-              ut = self.calculate_u_t_one(self.A_hat_, self.B_hat_, xt)
+              ut = self.calculate_u_t_one(controller, xt)
               sample = self.gen_data(xt, u_t=ut)
               total_samples += 1
               if sample is not None:
                 yt, ut = sample
-                X, Y, U = ch.cat((X,xt)), ch.cat((Y,yt)), ch.cat((U,ut))
+                buffer.append(xt, ut, yt)
                 xu = ch.cat([xt, ut], dim=1) 
-                covariate_matrix += xu.T@xu
+                thickness.update(xu)
                 xt = yt
                 if sample[0].norm() <= 2*np.sqrt(self.d):
                   break
               else: 
                 responsive = False
                 break
-          logger.info(f'number of trajectories: {traj}; number of samples collected: {X.size(0)}')
-      return X[1:], U[1:], Y[1:]
+          buffer.end_trajectory()
+          logger.info(f'number of trajectories: {traj}; number of samples collected: {len(buffer)}')
+      return buffer.tensors
+
+  def _generate_samples_B_batched(self): 
+      '''
+      Collects the B focused trajectories in args.num_envs environments in lockstep. Each 
+      environment alternates between exploration steps with control gamma * e_i (phase 0), and 
+      stabilizing steps (phase 1), until the state is back in the ball 
+      of radius 2 sqrt(d).
+      '''
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_gen_samples_B))
+      thickness = ThicknessMonitor(self.d+self.m, self.args.target_thickness)
+      envs = LockstepEnvs(self.args.num_envs, self.d, self.args.num_traj_gen_samples_B, buffer)
+      envs.index %= self.m
+      id_ = ch.eye(self.m)
+      controller = LinearController(self.A_hat_, self.B_hat_)
+
+      while envs.active.any() and len(buffer) < self.args.T_gen_samples_B and not thickness.reached(): 
+          active = envs.active.nonzero()[:,0]
+          x_t, explore = envs.x[active], envs.phase[active] == 0
+          u_t = ch.where(explore[:,None], self.args.gamma*id_[envs.index[active]], 
+                          controller.stabilize(x_t))
+          y_t, u_t, accepted = self._sample(x_t, u_t)
+          envs.record(active[accepted], x_t[accepted], u_t[accepted], y_t[accepted])
+          thickness.update(ch.cat([x_t, u_t], dim=1)[accepted])
+
+          # exploration steps are followed by stabilizing steps, until the state is back in the ball
+          stable = y_t.norm(dim=1) <= 2*np.sqrt(self.d)
+          envs.index[active[accepted & explore]] = (envs.index[active[accepted & explore]] + 1) % self.m
+          envs.phase[active[accepted]] = ch.where(explore | ~stable, 1, 0)[accepted]
+          envs.x[active[accepted]] = y_t[accepted]
+          envs.end(active[~accepted])
+          logger.info(f'number of trajectories: {envs.started}; number of samples collected: {len(buffer)}')
+
+      (X, U, Y), _ = envs.trajectories()
+      return X, U, Y
 
   @staticmethod
-  def calculate_u_t_two(a, b, gamma_e_i): 
-    return (b@LA.inv(b.T@b)@gamma_e_i)[None,...]
+  def calculate_u_t_two(controller, gamma_e_i): 
+    return controller.excite(gamma_e_i[None,...])
 
   @staticmethod
-  def calculate_u_t_three(a, b, x): 
-    return (-b@LA.inv(b.T@b)@a.T@x.T).T 
+  def calculate_u_t_three(controller, x): 
+    return controller.stabilize(x)
 
   def generate_samples_A(self):
       logger.info('begin a focused part...')
-      covariate_matrix = ch.zeros([self.d+self.m,self.d+self.m])
+      if self.args.num_envs > 1: 
+        return self._generate_samples_A_batched()
+      thickness = ThicknessMonitor(self.d+self.m, self.args.target_thickness)
 
       traj, total_samples = 0, 0
-      X, Y, U = ch.zeros([1, self.d]), ch.zeros([1, self.d]), ch.zeros([1, self.m])
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_gen_samples_A))
       index = 0
       id_ = ch.eye(self.d)
+      controller = LinearController(self.A_hat_, self.B_hat_)
 
       # break based off of the number of samples collected or number of trajectories
-      while (traj < self.args.num_traj_gen_samples_A and X.size(0) < self.args.T_gen_samples_A
-          and calc_thickness(covariate_matrix) < self.args.target_thickness):
+      while (traj < self.args.num_traj_gen_samples_A and len(buffer) < self.args.T_gen_samples_A
+          and not thickness.reached()):
           xt = ch.zeros(1, self.d)
           traj += 1
           # while the system is responsive 
           responsive = True
           while responsive: 
-            ut = self.calculate_u_t_two(self.A_hat_, self.B_hat_, self.args.gamma*id_[index]) 
+            ut = self.calculate_u_t_two(controller, self.args.gamma*id_[index])
             sample = self.gen_data(xt, u_t=ut)
             if sample is not None:
               yt, ut = sample
@@ -237,9 +529,9 @@ class TruncatedLQR:
               total_samples += 1
               if sample is not None:
                   yt, ut = sample
-                  X, Y, U = ch.cat((X,xt)), ch.cat((Y, yt)), ch.cat((U, ut))
+                  buffer.append(xt, ut, yt)
                   xu = ch.cat([xt, ut], dim=1)
-                  covariate_matrix += xu.T@xu
+                  thickness.update(xu)
                   xt = yt
                   index = (index+1)%self.d
               else: 
@@ -247,59 +539,199 @@ class TruncatedLQR:
             else: 
               break
             while True: 
-                ut = self.calculate_u_t_three(self.A_hat_, self.B_hat_, xt)
+                ut = self.calculate_u_t_three(controller, xt)
                 sample = self.gen_data(xt, u_t=ut)
                 total_samples += 1
                 if sample is not None:
                   yt, ut = sample
-                  X, Y, U = ch.cat((X,xt)), ch.cat((Y,yt)), ch.cat((U,ut))
+                  buffer.append(xt, ut, yt)
                   xu = ch.cat([xt, ut], dim=1) 
-                  covariate_matrix += xu.T@xu 
+                  thickness.update(xu)
                   xt = yt
                   if sample[0].norm() <= self.args.R + 3*np.sqrt(self.d):
                     break
                 else:
                   responsive = False
                   break
-          logger.info(f'number of trajectories: {traj}; number of samples collected: {X.size(0)}')
-      return X[1:], U[1:], Y[1:]
+          buffer.end_trajectory()
+          logger.info(f'number of trajectories: {traj}; number of samples collected: {len(buffer)}')
+      return buffer.tensors
+
+  def _generate_samples_A_batched(self): 
+      '''
+      Collects the A focused trajectories in args.num_envs environments in lockstep. Each 
+      environment cycles through an unrecorded excitation step (phase 0), a recorded step with 
+      no control (phase 1), and stabilizing steps (phase 2), until the state is back in the ball of radius R + 3 sqrt(d).
+      '''
+      buffer = TrajectoryBuffer(self.d, self.m, self.d, capacity=_buffer_capacity(self.args.T_gen_samples_A))
+      thickness = ThicknessMonitor(self.d+self.m, self.args.target_thickness)
+      envs = LockstepEnvs(self.args.num_envs, self.d, self.args.num_traj_gen_samples_A, buffer)
+      envs.index %= self.d
+      id_ = ch.eye(self.d)
+      controller = LinearController(self.A_hat_, self.B_hat_)
+
+      while envs.active.any() and len(buffer) < self.args.T_gen_samples_A and not thickness.reached(): 
+          active = envs.active.nonzero()[:,0]
+          x_t, phase = envs.x[active], envs.phase[active]
+          excite = controller.excite(self.args.gamma*id_[envs.index[active]])
+          u_t = ch.where((phase == 0)[:,None], excite, 
+                          ch.where((phase == 1)[:,None], ch.zeros_like(excite), controller.stabilize(x_t)))
+          y_t, u_t, accepted = self._sample(x_t, u_t)
+          recorded = accepted & (phase > 0)
+          envs.record(active[recorded], x_t[recorded], u_t[recorded], y_t[recorded])
+          thickness.update(ch.cat([x_t, u_t], dim=1)[recorded])
+
+          stable = y_t.norm(dim=1) <= self.args.R + 3*np.sqrt(self.d)
+          free = accepted & (phase == 1)
+          envs.index[active[free]] = (envs.index[active[free]] + 1) % self.d
+          next_phase = ch.where(phase == 0, 1, ch.where(phase == 1, 2, ch.where(stable, 0, 2)))
+          envs.phase[active[accepted]] = next_phase[accepted]
+          envs.x[active[accepted]] = y_t[accepted]
+          envs.end(active[~accepted])
+          logger.info(f'number of trajectories: {envs.started}; number of samples collected: {len(buffer)}')
+
+      (X, U, Y), _ = envs.trajectories()
+      return X, U, Y
 
   def run_warm_phase(self, 
                     store: Store=None) -> None:
+      '''
+      Warm start phase. Runs repeat independent rounds of sample collection and estimation 
+      of (A, B), from the same cold start estimates, and keeps the estimates that are closest 
+      to the others. Round i is seeded with rand_seed + i, and starts from the projection set 
+      radius at the start of the phase, so that the rounds are independent of their order. 
+      With args.warm_workers > 1, the rounds run concurrently in a pool of processes; gen_data 
+      must then be serializable with dill, and draw its randomness from torch's (or numpy's) 
+      global generator, or implement seed(seed). The pool uses the spawn start method, so 
+      scripts need to guard their entry point with ``if __name__ == '__main__'``.
+      '''
       logger.info(f'begin warm start...')
       repeat = int(-2*np.log2(self.args.delta)) if self.args.repeat is None else self.args.repeat
 
       assert repeat >= 1, f"repeat must be greater than or equal to 1; repeat: {repeat}"
 
-      A_results, B_results = ch.Tensor([]), ch.Tensor([])
-
-      coef_concat = ch.cat([self.A_hat_, self.B_hat_])
-      for _ in range(repeat):
+      r_0, results, pending = self.args.r, {}, []
+      for i in range(repeat):
+        state = self._resume_stage(f'warm_{i}')
+        if state is not None: 
+          results[i] = state['A_'], state['B_']
+        else: 
+          pending.append(i)
+
+      if self.args.warm_workers > 1 and len(pending) > 1: 
+        results.update(self._run_repeats_parallel(pending, r_0))
+      else: 
+        for i in pending: 
+          results[i] = self._run_repeat(i, r_0, store=store)
+         
+      self.A_results_ = ch.stack([results[i][0] for i in range(repeat)])
+      self.B_results_ = ch.stack([results[i][1] for i in range(repeat)])
+      self.A_ = self.find_max(self.A_results_, self.args.eps2)
+      self.B_ = self.find_max(self.B_results_, self.args.eps2)
+
+  def _seed(self, 
+            seed: int) -> None: 
+      ch.manual_seed(seed)
+      np.random.seed(seed)
+      if hasattr(self.gen_data, 'seed'): 
+        self.gen_data.seed(seed)
+
+  def _run_repeat(self, 
+                  i: int, 
+                  r_0: float, 
+                  store: Store=None) -> tuple: 
+      '''
+      Runs round i of the warm start phase, and returns its estimates (A_, B_).
+      '''
+      self.args.r = r_0
+      self._seed(self.rand_seed + i)
+      data = self._resume_stage(f'warm_{i}_data')
+      if data is not None: 
+        Xu, Uu, Yu, Xx, Ux, Yx = data['Xu'], data['Uu'], data['Yu'], data['Xx'], data['Ux'], data['Yx']
+      else: 
         Xu, Uu, Yu = self.generate_samples_B()
         Xx, Ux, Yx = self.generate_samples_A()
+        self._save_stage(f'warm_{i}_data', Xu=Xu, Uu=Uu, Yu=Yu, Xx=Xx, Ux=Ux, Yx=Yx)
 
-        XU_concat, XX_concat = ch.cat([Xu, Uu], axis=1), ch.cat([Xx, Ux], axis=1)
-        feat_concat = ch.cat([XU_concat, XX_concat])
-        y_concat = ch.cat([Yu, Yx])
-
-        self.trunc_lds_phase_three = TruncatedLinearRegression(
-                                                                self.args.phi,
-                                                                self.args, 
-                                                                self.gen_data.noise_var,
-                                                                emp_weight=coef_concat,
-                                                                dependent=True, 
-                                                                store=store, 
-                                                                rand_seed=self.rand_seed)
-        self.trunc_lds_phase_three.fit(feat_concat.detach(), y_concat.detach())
-        
-        AB = self.trunc_lds_phase_three.coef_
-        A_, B_ = AB[:self.d], AB[self.d:]
+      XU_concat, XX_concat = ch.cat([Xu, Uu], axis=1), ch.cat([Xx, Ux], axis=1)
+      feat_concat = ch.cat([XU_concat, XX_concat])
+      y_concat = ch.cat([Yu, Yx])
 
-        A_results = ch.cat([A_results, A_[None,...]])
-        B_results = ch.cat([B_results, B_[None,...]])
-         
-      self.A_ = self.find_max(A_results, self.args.eps2)
-      self.B_ = self.find_max(B_results, self.args.eps2)
+      AB = self._fit_warm(feat_concat.detach(), y_concat.detach(), store=store)
+      A_, B_ = AB[:self.d], AB[self.d:]
+      self._save_stage(f'warm_{i}', A_=A_, B_=B_)
+      return A_, B_
+
+  def _fit_warm(self, 
+                feat: Tensor, 
+                y: Tensor, 
+                store: Store=None) -> Tensor: 
+      '''
+      Estimates (A, B) stacked, from the states and controls feat, and next states y.
+      '''
+      self.trunc_lds_phase_three = TruncatedLinearRegression(
+                                                              self.args.phi,
+                                                              self.args, 
+                                                              self.gen_data.noise_var,
+                                                              emp_weight=ch.cat([self.A_hat_, self.B_hat_]),
+                                                              dependent=True, 
+                                                              store=store, 
+                                                              rand_seed=self.rand_seed)
+      self.trunc_lds_phase_three.fit(feat, y)
+      return self.trunc_lds_phase_three.coef_
+
+  def _run_repeats_parallel(self, 
+                            repeats: list, 
+                            r_0: float) -> dict: 
+      '''
+      Runs the rounds repeats of the warm start phase in a pool of args.warm_workers processes, 
+      and returns their estimates. The rounds are checkpointed once they are gathered.
+      '''
+      # the state that the rounds depend on is sent once to each worker, and the tasks are 
+      # only the round indices; the workers don't write checkpoints, the main process does
+      state = dill.dumps({
+        'cls': type(self), 
+        'args': self.args, 
+        'gen_data': self.gen_data, 
+        'd': self.d, 
+        'm': self.m, 
+        'rand_seed': self.rand_seed, 
+        'A_hat_': self.A_hat_, 
+        'B_hat_': self.B_hat_, 
+        'r_0': r_0, 
+        # collected data of the rounds, from an earlier run
+        'checkpoint': {f'warm_{i}_data': self.checkpoint[f'warm_{i}_data'] for i in repeats if f'warm_{i}_data' in self.checkpoint}, 
+        # only the last round's regression is sent back
+        'keep': repeats[-1], 
+      })
+      with ProcessPoolExecutor(max_workers=min(self.args.warm_workers, len(repeats)), 
+                                mp_context=mp.get_context('spawn'), 
+                                initializer=_init_warm_worker, 
+                                initargs=(state,)) as executor: 
+        results = [dill.loads(result) for result in executor.map(_run_repeat_worker, repeats)]
+
+      estimates = {}
+      for i, (A_, B_, r, model) in zip(repeats, results): 
+        self.args.r = r
+        self._save_stage(f'warm_{i}', A_=A_, B_=B_)
+        estimates[i] = A_, B_
+      # keep the last round's regression, like the sequential rounds
+      self.trunc_lds_phase_three = results[-1][3]
+      return estimates
+
+  @classmethod
+  def _from_warm_state(cls, 
+                        state: dict): 
+      '''
+      Rebuilds the estimator for the warm start rounds in a worker process, without checkpointing.
+      '''
+      trunc_lqr = cls.__new__(cls)
+      trunc_lqr.args, trunc_lqr.gen_data = state['args'], state['gen_data']
+      trunc_lqr.d, trunc_lqr.m, trunc_lqr.rand_seed = state['d'], state['m'], state['rand_seed']
+      trunc_lqr.c = (trunc_lqr.args.R - 3 * (trunc_lqr.m ** .5)) / trunc_lqr.args.U_B
+      trunc_lqr.checkpoint_path, trunc_lqr.checkpoint = None, state['checkpoint']
+      trunc_lqr.A_hat_, trunc_lqr.B_hat_ = state['A_hat_'], state['B_hat_']
+      return trunc_lqr
 
   @property
   def A_hat_(self): 
@@ -332,3 +764,26 @@ class TruncatedLQR:
   @B_.setter
   def B_(self, value): 
     self._B_ = value
+
+
+# warm start state of the worker process, set by _init_warm_worker
+_warm_state = None
+
+
+def _init_warm_worker(state: bytes) -> None: 
+  """
+  Loads the warm start state in a worker process, once per worker. The state and results are 
+  serialized with dill, so that simulators and oracles with lambdas can be sent between processes.
+  """
+  global _warm_state
+  _warm_state = dill.loads(state)
+
+
+def _run_repeat_worker(i: int) -> bytes: 
+  """
+  Runs round i of the warm start phase in a worker process.
+  """
+  trunc_lqr = _warm_state['cls']._from_warm_state(_warm_state)
+  A_, B_ = trunc_lqr._run_repeat(i, _warm_state['r_0'])
+  model = getattr(trunc_lqr, 'trunc_lds_phase_three', None) if i == _warm_state['keep'] else None
+  return dill.dumps((A_, B_, trunc_lqr.args.r, model))
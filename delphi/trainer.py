@@ -8,20 +8,56 @@ from torch.utils.data import DataLoader
 from time import time
 from tqdm import tqdm
 import copy
+import os
+import dill
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from typing import Iterable
 from cox.store import Store
 
 from .delphi import delphi
 from .utils import constants as consts
-from .utils.helpers import AverageMeter, setup_store_with_metadata, Parameters
+from .utils.helpers import (AverageMeter, ConvergenceMonitor, HistoryRecorder, IterateAverage, setup_store_with_metadata, Parameters, 
+                            get_rng_state, load_checkpoint, save_checkpoint, set_rng_state, tensor_digest)
 from .utils.defaults import TRAINER_DEFAULTS, check_and_fill_args
+from .utils.loaders import TensorLoader
 
 
 class Trainer:
     def __init__(self, 
                 model: delphi): 
         self.model = model        
-        self.train_costs, self.val_costs = ch.Tensor([]), ch.Tensor([])
+        self.make_recorders()
+        # running average of the iterates, when args.average is set
+        self.iterate_average = None
+        # convergence monitor, when args.convergence_window is set
+        self.convergence_monitor = None
+
+    def make_recorders(self, 
+                        args: Parameters=None): 
+        """
+        Creates the recorders for the model's iterates, and the train and validation losses.
+        """
+        kwargs = {} if args is None else {'interval': args.history_interval, 
+                                          'size': args.history_size, 
+                                          'disable': not args.record_history}
+        self.history_recorder = HistoryRecorder(**kwargs)
+        self.train_costs_recorder, self.val_costs_recorder = HistoryRecorder(**kwargs), HistoryRecorder(**kwargs)
+
+    @property
+    def train_costs(self): 
+        return self.train_costs_recorder.history
+
+    @property
+    def val_costs(self): 
+        return self.val_costs_recorder.history
+
+    @property
+    def history(self): 
+        """
+        Model iterates after each training step, with size (num_records, ...).
+        """
+        return self.history_recorder.history
 
     def model_loop_(self,
                     args: Parameters, 
@@ -41,10 +77,10 @@ class Trainer:
             epoch (int) : which epoch we are currently on
             writer : tensorboardX writer (optional)
         Returns:
-            The average top1 accuracy and the average loss across the epoch.
+            The average loss, top1 and top5 accuracy across the epoch, and the model iterates recorded during the epoch.
         """
-        history_ = ch.Tensor([])
         loop_msg = 'Train' if is_train else 'Val'
+        epoch_start = self.history_recorder.count
         loss_, prec1_, prec5_ = AverageMeter(), AverageMeter(), AverageMeter()
         iterator = tqdm(enumerate(loader), total=len(loader), leave=False, 
                         bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}') if args.verbose else enumerate(loader) 
@@ -65,10 +101,11 @@ class Trainer:
             if args.cuda:
                 reg_term = reg_term.cuda()
             loss = loss + reg_term
+            # record scalars, so that the costs have size (num_steps,)
             if is_train:
-                self.train_costs = ch.cat([self.train_costs, loss])
+                self.train_costs_recorder.record(loss.detach().reshape(()))
             else: 
-                self.val_costs = ch.cat([self.val_costs, loss])
+                self.val_costs_recorder.record(loss.detach().reshape(()))
 
             if is_train:
                 loss.backward()
@@ -81,15 +118,22 @@ class Trainer:
                 iterator.set_description(desc)
  
             self.model.iteration_hook(i, is_train, loss, batch)
+            if is_train and self.iterate_average is not None: 
+                self.iterate_average.update()
             if is_train: 
+                # models with parameter groups keep the previous trial's weight attribute, so check the groups first
                 try: 
-                    history_ = ch.cat([history_, self.model.weight.data[None,...]])
+                    self.history_recorder.record(self.model._parameters[0]['params'][0].data)
                 except: 
-                    history_ = ch.cat([history_, self.model._parameters[0]['params'][0].data[None,...]])
+                    self.history_recorder.record(self.model.weight.data)
+            if is_train and self.convergence_monitor is not None and self.convergence_monitor.update(): 
+                break
 
         self.model.epoch_hook(epoch, is_train, loss)
 
-        return loss_.avg, prec1_.avg, prec5_.avg, history_
+        # the records from this epoch, as the cumulative history is only exposed by the history property
+        history = self.history
+        return loss_.avg, prec1_.avg, prec5_.avg, history[max(len(history) - (self.history_recorder.count - epoch_start), 0):]
 
 
     def eval_model(self, 
@@ -140,6 +184,10 @@ class Trainer:
             raise Exception('No Datapoints in Train Loader')
 
         args = check_and_fill_args(args, TRAINER_DEFAULTS)
+        if args.fast_loader: 
+            # iterate through in-memory tensor datasets without the DataLoader's collation overhead
+            train_loader = TensorLoader.from_loader(train_loader)
+            val_loader = TensorLoader.from_loader(val_loader)
     
         if store is not None: 
             store.add_table('logs', {
@@ -154,53 +202,143 @@ class Trainer:
             setup_store_with_metadata(args, store)
 
         # stores model estimates after each gradient step
-        history = ch.Tensor([])
-        best_loss, best_params = float('inf'), None
-        for trial in range(args.trials):
-            ch.manual_seed(rand_seed)
-            if args.verbose: print(f'trial: {trial + 1}')
-
-            t_start = time()
-            no_improvement_count = 0
-        
-            self.model.pretrain_hook(train_loader)
-            optimizer, schedule = self.model.make_optimizer_and_schedule(self.model.parameters()) 
-   
-            if checkpoint:
-                epoch = checkpoint['epoch']
-                best_prec1 = checkpoint['prec1'] if 'prec1' in checkpoint else self.model_loop_(args, val_loader, epoch, False)[0]
-        
-            for epoch in range(1, args.epochs + 1):
-                train_loss, train_prec1, train_prec5, history_ = self.model_loop_(args, train_loader, epoch, True, optimizer, schedule)
-                history = ch.cat([history, history_])
-
-                if val_loader is not None:
-                    with ch.no_grad():
-                        val_loss, val_prec1, val_prec5, _ = self.model_loop_(args, val_loader, epoch, False)
-                    if args.verbose: print(f'Epoch {epoch} - Loss: {val_loss}')
-            
-                if store is not None:
-                    store['logs'].append_row({
-                        'trial': trial,
-                        'epoch': epoch,
-                        'train_loss': train_loss, 
-                        'train_prec1': train_prec1,
-                        'train_prec5': train_prec5,
-                        'val_loss': val_loss,
-                        'val_prec1': val_prec1, 
-                        'val_prec5': val_prec5})
+        self.make_recorders(args)
+        # copy of the parameters with the lowest validation loss, only kept when they are adopted
+        self.best_snapshot = [] if args.adopt_best else None
+        if args.trial_workers > 1 and args.trials > 1: 
+            assert args.checkpoint_dir is None and checkpoint is None, "checkpointing is only supported for sequential trials. expecting trial_workers=1."
+            return self._train_parallel(args, train_loader, val_loader, rand_seed=rand_seed, store=store)
+
+        checkpoint_path, digest = None, None
+        if args.checkpoint_dir is not None: 
+            checkpoint_path = os.path.join(args.checkpoint_dir, consts.CKPT_NAME)
+            digest = self._data_digest(train_loader)
+            if checkpoint is None: 
+                checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is not None and digest is not None and checkpoint['digest'] not in {None, digest}: 
+            raise ValueError('checkpoint was written for a different training set')
+
+        best_loss, best_params, start_trial = float('inf'), None, 0
+        if checkpoint is not None: 
+            # resume from the end of the checkpointed epoch
+            start_trial, best_params, best_loss = checkpoint['trial'], checkpoint['best_params'], checkpoint['best_loss']
+            self.history_recorder, self.train_costs_recorder, self.val_costs_recorder = checkpoint['recorders']
+            if self.best_snapshot is not None: 
+                self.best_snapshot = checkpoint.get('best_snapshot') or []
+            if args.verbose: print(f"resuming trial: {start_trial + 1}, epoch: {checkpoint['epoch'] + 1}")
+
+        for trial in range(start_trial, args.trials):
+            best_params, best_loss, _ = self._run_trial(args, train_loader, val_loader, trial, 
+                                                        rand_seed=rand_seed, 
+                                                        best_params=best_params, 
+                                                        best_loss=best_loss, 
+                                                        store=store, 
+                                                        checkpoint=checkpoint if trial == start_trial else None, 
+                                                        checkpoint_path=checkpoint_path, 
+                                                        digest=digest)
+
+        # the run is complete, so later runs start from scratch
+        if checkpoint_path is not None and os.path.isfile(checkpoint_path): 
+            os.remove(checkpoint_path)
+        if args.adopt_best: 
+            self._adopt_best(self.best_snapshot)
+        return best_params, self.history, copy.copy(self.model.parameters)
+
+    def _data_digest(self, 
+                        loader): 
+        """
+        *Internal method* Content hash of an in-memory training set, used to check that a checkpoint 
+        belongs to the training set; None for streamed datasets.
+        """
+        tensors = getattr(loader, 'tensors', None) or getattr(getattr(loader, 'dataset', None), 'tensors', None)
+        return tensor_digest(*tensors) if tensors is not None else None
+
+    def _run_trial(self, 
+                    args: Parameters, 
+                    train_loader: ch.utils.data.DataLoader, 
+                    val_loader: ch.utils.data.DataLoader, 
+                    trial: int, 
+                    rand_seed: int=0, 
+                    best_params=None, 
+                    best_loss: float=float('inf'), 
+                    store: Store=None, 
+                    checkpoint: dict=None, 
+                    checkpoint_path: str=None, 
+                    digest: str=None):
+        """
+        *Internal method* Runs a single trial of the training procedure.
+        Args: 
+            trial (int) : trial number
+            rand_seed (int) : seed for the trial
+            best_params : best parameters from the previous trials
+            best_loss (float) : validation loss of best_params
+            checkpoint (dict) : checkpoint from an earlier epoch of the trial to resume from
+            checkpoint_path (str) : path to checkpoint the trial to, every args.checkpoint_iters epochs
+            digest (str) : content hash of the training set, saved with the checkpoints
+        Returns: 
+            Tuple(best_params, best_loss, logs) with the best parameters after the trial, and the trial's log rows
+        """
+        ch.manual_seed(rand_seed)
+        if args.verbose: print(f'trial: {trial + 1}')
+
+        t_start = time()
+        no_improvement_count = 0
+        logs = []
+        if checkpoint is not None and checkpoint['r'] is not None: 
+            # radius of the checkpointed trial
+            args.r = checkpoint['r']
+    
+        self.model.pretrain_hook(train_loader)
+        optimizer, schedule = self.model.make_optimizer_and_schedule(self.model.parameters()) 
+        params = [param for group in optimizer.param_groups for param in group['params']]
+        self.iterate_average, self.convergence_monitor = None, None
+        if args.average: 
+            # average the last average_tail fraction of the trial's gradient steps (after projection)
+            num_steps = args.epochs * len(train_loader)
+            self.iterate_average = IterateAverage(params, start=int((1 - args.average_tail) * num_steps))
+        if args.convergence_window is not None: 
+            self.convergence_monitor = ConvergenceMonitor(params, window=args.convergence_window, 
+                                                            grad_tol=args.grad_tol, param_tol=args.param_tol)
+        # otherwise, the validation set is only evaluated at the end of the trial
+        val_every_epoch = args.val_every_epoch and not args.average
+
+        start_epoch, stop = 1, False
+        if checkpoint is not None: 
+            self._load_checkpoint(checkpoint, params, optimizer, schedule)
+            no_improvement_count, stop = checkpoint['no_improvement_count'], checkpoint['stop']
+            start_epoch = checkpoint['epoch'] + 1
+    
+        epoch = start_epoch - 1
+        for epoch in range(start_epoch, args.epochs + 1):
+            if stop: 
+                break
+            train_loss, train_prec1, train_prec5, _ = self.model_loop_(args, train_loader, epoch, True, optimizer, schedule)
+
+            val_loss = val_prec1 = val_prec5 = float('nan')
+            if val_loader is not None and val_every_epoch:
+                with ch.no_grad():
+                    val_loss, val_prec1, val_prec5, _ = self.model_loop_(args, val_loader, epoch, False)
+                if args.verbose: print(f'Epoch {epoch} - Loss: {val_loss}')
 
+            logs.append({
+                'trial': trial,
+                'epoch': epoch,
+                'train_loss': train_loss, 
+                'train_prec1': train_prec1,
+                'train_prec5': train_prec5,
+                'val_loss': val_loss,
+                'val_prec1': val_prec1, 
+                'val_prec5': val_prec5})
+            if store is not None:
+                store['logs'].append_row(logs[-1])
+
+            if val_every_epoch: 
                 """
                 NOTE: Check for training procedure convergence. If 
                 no improvement in loss for args.n_iter_no_change epochs, 
                 then procedure has converged.
                 """
-                if best_params is None or val_loss < best_loss: 
-                    try: 
-                        best_params, best_loss = copy.copy(list(self.model.parameters())[0]), val_loss
-                        best_params.requires_grad = False
-                    except: 
-                        best_params, best_loss = copy.copy(list(self.model._parameters)), val_loss
+                best_params, best_loss = self._update_best(best_params, best_loss, val_loss)
                 if args.early_stopping: 
                     if ch.abs(val_loss - best_loss) <= args.tol:
                         no_improvement_count += 1
@@ -209,11 +347,219 @@ class Trainer:
                     if no_improvement_count >= args.n_iter_no_change:
                         if args.verbose: 
                             print("Convergence after %d epochs took %.2f seconds" % (epoch, time() - t_start))
-                        break
+                        stop = True
+
+            if not stop and self.convergence_monitor is not None and self.convergence_monitor.converged: 
+                if args.verbose: 
+                    print("Convergence after %d epochs took %.2f seconds - mean gradient norm: %.2e, relative parameter change: %.2e" % 
+                            (epoch, time() - t_start, self.convergence_monitor.grad_norm, self.convergence_monitor.param_change))
+                stop = True
 
-            self.model.post_training_hook()
-        
-        if args.early_stopping and args.verbose and no_improvement_count < args.n_iter_no_change: 
+            if checkpoint_path is not None and (stop or epoch % args.checkpoint_iters == 0 or epoch == args.epochs): 
+                self._save_checkpoint(checkpoint_path, args, trial, epoch, stop, params, optimizer, schedule, 
+                                        best_params, best_loss, no_improvement_count, digest)
+            if stop: 
+                break
+
+        if not val_every_epoch: 
+            if args.average: 
+                self.iterate_average.copy_to()
+            val_loss = float('nan')
+            if val_loader is not None: 
+                with ch.no_grad():
+                    val_loss = self.model_loop_(args, val_loader, epoch, False)[0]
+                if args.verbose: print(f'Trial {trial + 1} - Loss: {val_loss}')
+            best_params, best_loss = self._update_best(best_params, best_loss, val_loss)
+
+        self.model.post_training_hook()
+    
+        if args.early_stopping and val_every_epoch and args.verbose and no_improvement_count < args.n_iter_no_change: 
             print('Procedure did not converge after %d epochs and %.2f seconds' % (epoch, time() - t_start))
 
-        return best_params, history, copy.copy(self.model.parameters)
+        return best_params, best_loss, logs
+
+    def _save_checkpoint(self, 
+                            path: str, 
+                            args: Parameters, 
+                            trial: int, 
+                            epoch: int, 
+                            stop: bool, 
+                            params: Iterable, 
+                            optimizer: ch.optim.Optimizer, 
+                            schedule, 
+                            best_params, 
+                            best_loss: float, 
+                            no_improvement_count: int, 
+                            digest: str): 
+        """
+        *Internal method* Checkpoints the trial at the end of an epoch; everything that the next 
+        epochs depend on is saved, so that resumed trials continue bit-for-bit.
+        """
+        save_checkpoint({
+            'trial': trial, 
+            'epoch': epoch, 
+            'stop': stop, 
+            'r': args.r, 
+            'params': [param.detach().clone() for param in params], 
+            'optimizer': optimizer.state_dict(), 
+            'schedule': schedule.state_dict() if schedule is not None else None, 
+            'iterate_average': self.iterate_average.state_dict() if self.iterate_average is not None else None, 
+            'convergence_monitor': self.convergence_monitor.state_dict() if self.convergence_monitor is not None else None, 
+            'best_params': best_params, 
+            'best_snapshot': self.best_snapshot, 
+            'best_loss': best_loss, 
+            'no_improvement_count': no_improvement_count, 
+            'recorders': (self.history_recorder, self.train_costs_recorder, self.val_costs_recorder), 
+            'rng': get_rng_state(), 
+            'digest': digest, 
+        }, path)
+
+    def _load_checkpoint(self, 
+                            checkpoint: dict, 
+                            params: Iterable, 
+                            optimizer: ch.optim.Optimizer, 
+                            schedule): 
+        """
+        *Internal method* Restores the state of a trial from a checkpoint written by _save_checkpoint.
+        """
+        with ch.no_grad(): 
+            for param, value in zip(params, checkpoint['params']): 
+                param.copy_(value)
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if schedule is not None and checkpoint['schedule'] is not None: 
+            schedule.load_state_dict(checkpoint['schedule'])
+        if self.iterate_average is not None and checkpoint['iterate_average'] is not None: 
+            self.iterate_average.load_state_dict(checkpoint['iterate_average'])
+        if self.convergence_monitor is not None and checkpoint['convergence_monitor'] is not None: 
+            self.convergence_monitor.load_state_dict(checkpoint['convergence_monitor'])
+        set_rng_state(checkpoint['rng'])
+
+    def _update_best(self, 
+                        best_params, 
+                        best_loss: float, 
+                        val_loss: float): 
+        """
+        *Internal method* Returns the model's current parameters and val_loss, if val_loss improves on best_loss. 
+        With args.adopt_best, also keeps a copy of the parameters in best_snapshot.
+        """
+        if best_params is None or val_loss < best_loss: 
+            try: 
+                best_params, best_loss = copy.copy(list(self.model.parameters())[0]), val_loss
+                best_params.requires_grad = False
+            except: 
+                best_params, best_loss = copy.copy(list(self.model._parameters)), val_loss
+            if self.best_snapshot is not None: 
+                self.best_snapshot = [param.detach().clone() for param in self._model_params()]
+        return best_params, best_loss
+
+    def _model_params(self) -> list: 
+        """
+        *Internal method* The model's parameters, flattened over its parameter groups in the optimizer's order.
+        """
+        params = []
+        for group in self.model.parameters(): 
+            if isinstance(group, dict): 
+                group = group['params']
+            params += list(group) if isinstance(group, (list, tuple)) else [group]
+        return params
+
+    def _adopt_best(self, 
+                    best_snapshot: list): 
+        """
+        *Internal method* Copies the parameters that achieved the lowest validation loss, across all 
+        of the trials' epochs, into the model.
+        """
+        if not best_snapshot: 
+            return
+        with ch.no_grad(): 
+            for param, value in zip(self._model_params(), best_snapshot): 
+                param.copy_(value)
+
+    def _train_parallel(self, 
+                        args: Parameters, 
+                        train_loader: ch.utils.data.DataLoader, 
+                        val_loader: ch.utils.data.DataLoader, 
+                        rand_seed: int=0, 
+                        store: Store=None):
+        """
+        *Internal method* Runs the trials concurrently in a pool of args.trial_workers processes. 
+        Each trial is seeded with rand_seed, and trial t starts with radius args.r * args.rate ** t, 
+        so that every trial matches the corresponding sequential trial. As in the sequential 
+        loop, the model keeps the last trial's state, and the trial with the lowest validation 
+        loss gives best_params (and the adopted parameters, with args.adopt_best). The trainer and 
+        the loaders are sent to each worker once, and the tasks are only (trial, radius, seed). 
+        Note that the pool uses the spawn start method, so scripts need to guard their entry 
+        point with ``if __name__ == '__main__'``.
+        Returns: 
+            Tuple(best_params, history, params)
+        """
+        r_0 = args.r
+        # the store holds open file handles, so workers log through the main process
+        model_store, self.model.store = getattr(self.model, 'store', None), None
+        try: 
+            state = dill.dumps((self, args, train_loader, val_loader))
+        finally: 
+            self.model.store = model_store
+        tasks = [(trial, r_0 * args.rate ** trial if r_0 is not None else None, rand_seed) for trial in range(args.trials)]
+
+        with ProcessPoolExecutor(max_workers=min(args.trial_workers, args.trials), 
+                                mp_context=mp.get_context('spawn'), 
+                                initializer=_init_trial_worker, 
+                                initargs=(state,)) as executor: 
+            results = [dill.loads(result) for result in executor.map(_run_trial_worker, tasks)]
+
+        # ties go to the earliest trial, as in the sequential loop
+        best_trial = min(range(args.trials), key=lambda trial: float(results[trial][1]))
+        for trial, (_, _, logs, _, recorders, _) in enumerate(results): 
+            if store is not None: 
+                for row in logs: 
+                    store['logs'].append_row(row)
+            history_recorder, train_costs_recorder, val_costs_recorder = recorders
+            self.history_recorder.extend(history_recorder.history)
+            self.train_costs_recorder.extend(train_costs_recorder.history)
+            self.val_costs_recorder.extend(val_costs_recorder.history)
+
+        best_params = results[best_trial][0]
+        # adopt the last trial's model, and keep the caller's hyperparameters
+        model_state = results[-1][3]
+        model_state.update({'args': args, 'store': model_store})
+        self.model.__dict__.update(model_state)
+        if r_0 is not None: 
+            args.r = r_0 * args.rate ** args.trials
+        if args.adopt_best: 
+            self.best_snapshot = results[best_trial][5]
+            self._adopt_best(self.best_snapshot)
+        return best_params, self.history, copy.copy(self.model.parameters)
+
+
+# trainer, hyperparameters and loaders of the worker process, set by _init_trial_worker
+_trial_state = None
+
+
+def _init_trial_worker(state: bytes) -> None: 
+    """
+    Loads the trainer and the loaders in a worker process, once per worker. The state and 
+    results are serialized with dill, so that models with lambda oracles can be sent between processes.
+    """
+    global _trial_state
+    _trial_state = dill.loads(state)
+
+
+def _run_trial_worker(task: tuple) -> bytes: 
+    """
+    Runs a single trial, with the radius and seed in task, in a worker process. Only the last 
+    trial sends the model's state back, without the model's loaders.
+    """
+    trial, r, rand_seed = task
+    trainer, args, train_loader, val_loader = _trial_state
+    args.r = r
+    trainer.make_recorders(args)
+    if trainer.best_snapshot is not None: 
+        trainer.best_snapshot = []
+    best_params, best_loss, logs = trainer._run_trial(args, train_loader, val_loader, trial, rand_seed=rand_seed)
+    model_state = None
+    if trial == args.trials - 1: 
+        model_state = {key: val for key, val in trainer.model.__dict__.items() 
+                        if key != 'trainer' and not isinstance(val, (DataLoader, TensorLoader))}
+    recorders = (trainer.history_recorder, trainer.train_costs_recorder, trainer.val_costs_recorder)
+    return dill.dumps((best_params, best_loss, logs, model_state, recorders, trainer.best_snapshot))
@@ -21,6 +21,20 @@ TRAINER_DEFAULTS = {
     'verbose': (bool, False),
     'disable_no_grad': (bool, False), 
     'epoch_step': (bool, False),
+    'record_history': (bool, True),
+    'history_interval': (int, 1),
+    'history_size': (int, None),
+    'fast_loader': (bool, True),
+    'trial_workers': (int, 1),
+    'adopt_best': (bool, False),
+    'average': (bool, False),
+    'average_tail': (float, 1.0),
+    'convergence_window': (int, None),
+    'grad_tol': (float, 1e-3),
+    'param_tol': (float, 1e-3),
+    'val_every_epoch': (bool, True),
+    'checkpoint_dir': (str, None),
+    'checkpoint_iters': (int, 1),
 }
 
 DATASET_DEFAULTS = {
@@ -52,7 +66,14 @@ TRUNC_REG_DEFAULTS = {
         'batch_size': (int, 50),
         'workers': (int, 0),
         'num_samples': (int, 50),
-        'shuffle': (bool, True)
+        'min_accepted': (int, None),
+        'max_samples': (int, None),
+        'sampler': (Callable, None),
+        'solver': ({'sgd', 'lbfgs', 'newton'}, 'sgd'),
+        'max_iter': (int, 50),
+        'block_size': (int, 100000),
+        'shuffle': (bool, True),
+        'cache_by_content': (bool, False)
 }
 
 TRUNC_LDS_DEFAULTS = {
@@ -66,6 +87,11 @@ TRUNC_LDS_DEFAULTS = {
         'batch_size': (int, 50),
         'workers': (int, 0),
         'num_samples': (int, 50),
+        'min_accepted': (int, None),
+        'max_samples': (int, None),
+        'sampler': (Callable, None),
+        'solver': ({'sgd'}, 'sgd'),
+        'block_size': (int, 100000),
         'c_gamma': (float, 2.0),
         'shuffle': (bool, False), 
         'constant': (bool, True),
@@ -167,7 +193,10 @@ TRUNCATED_LQR_DEFAULTS =  {
         'eps2': (float, .9),
         'repeat': (int, None), 
         'gamma': (float, REQ),
-        'alpha': (float, 1.0) 
+        'alpha': (float, 1.0), 
+        'checkpoint_dir': (str, None),
+        'num_envs': (int, 1),
+        'warm_workers': (int, 1),
 }
 
 def check_and_fill_args(args, defaults): 
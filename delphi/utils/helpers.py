@@ -11,8 +11,18 @@ from torch.distributions.transformed_distribution import TransformedDistribution
 import torch.nn as nn
 import torch.linalg as LA
 import cox
-from typing import NamedTuple
+from typing import NamedTuple, Iterable
 import pprint
+import math
+import hashlib
+import collections
+import functools
+import os
+import random
+import tempfile
+import weakref
+import dill
+import numpy as np
 
 from . import constants as consts
 
@@ -150,23 +160,74 @@ def type_of_script():
 
 
 
-def calc_est_grad(func, x, y, rad, num_samples):
+def _evaluate_antithetic(func, queries, targets): 
+    """
+    func on the antithetic pairs of a chunk, without concatenating the pairs into one batch. 
+    Grad mode is thread-local, so the queries are evaluated under no_grad in the pool's workers too.
+    """
+    plus, minus = queries
+    with ch.no_grad(): 
+        return func(plus, targets) - func(minus, targets)
+
+
+def calc_est_grad(func, x, y, rad, num_samples, chunk_size=None, pool=None, max_pending=2):
+    """
+    Zeroth-order estimate of the gradient of func at x, with the spherical estimator and 
+    antithetic sampling: for num_samples // 2 directions u drawn uniformly from the unit 
+    sphere, func is queried at x + rad * u and x - rad * u. The queries are processed in 
+    chunks of chunk_size directions, and the estimate is accumulated as a running sum of 
+    (func(x + rad * u) - func(x - rad * u)) * u, so memory is bounded by the chunk size 
+    rather than num_samples.
+    Args: 
+        func (Callable): black-box function, that takes (queries, targets) with size (q * B, ...) and returns q * B losses
+        x (torch.Tensor): size (B, ...) - inputs
+        y (torch.Tensor): size (B, ...) - targets
+        rad (float): query radius
+        num_samples (int): number of queries per input
+        chunk_size (int): number of antithetic directions per chunk; by default, all of them in one chunk
+        pool (concurrent.futures.Executor): if given, the chunks are evaluated in the pool; func must be picklable for process pools
+        max_pending (int): maximum number of chunks evaluated in the pool at once
+    Returns: 
+        gradient estimate with the same size as x
+    """
     B, *_ = x.shape
     Q = num_samples//2
     N = len(x.shape) - 1
+    chunk_size = chunk_size or Q
+    extender = [1]*N
+    y_shape = [1] * (len(y.shape) - 1)
+
+    evaluate = functools.partial(_evaluate_antithetic, func)
+
+    def chunks(): 
+        for start in range(0, Q, chunk_size): 
+            q = min(chunk_size, Q - start)
+            # q * B * C * H * W
+            noise = ch.randn((q * B,) + x.shape[1:], dtype=x.dtype, device=x.device)
+            noise /= noise.view(q*B, -1).norm(dim=-1).view(q*B, *extender)
+            queries = x.repeat(q, *extender)
+            yield noise, (queries + rad * noise, queries - rad * noise), y.repeat(q, *y_shape)
+
+    grad = ch.zeros_like(x)
+    def accumulate(noise, diff): 
+        q = noise.size(0) // B
+        grad.add_((diff.view(q, B, *extender) * noise.view(q, B, *noise.shape[1:])).sum(dim=0))
+
     with ch.no_grad():
-        # Q * B * C * H * W
-        extender = [1]*N
-        queries = x.repeat(Q, *extender)
-        noise = ch.randn_like(queries)
-        norm = noise.view(B*Q, -1).norm(dim=-1).view(B*Q, *extender)
-        noise = noise / norm
-        noise = ch.cat([-noise, noise])
-        queries = ch.cat([queries, queries])
-        y_shape = [1] * (len(y.shape) - 1)
-        l = func(queries + rad * noise, y.repeat(2*Q, *y_shape)).view(-1, *extender)
-        grad = (l.view(2*Q, B, *extender) * noise.view(2*Q, B, *noise.shape[1:])).mean(dim=0)
-    return grad
+        if pool is None: 
+            for noise, queries, targets in chunks(): 
+                accumulate(noise, evaluate(queries, targets))
+        else: 
+            pending = collections.deque()
+            for noise, queries, targets in chunks(): 
+                pending.append((noise, pool.submit(evaluate, queries, targets)))
+                if len(pending) >= max_pending: 
+                    noise, future = pending.popleft()
+                    accumulate(noise, future.result())
+            while pending: 
+                noise, future = pending.popleft()
+                accumulate(noise, future.result())
+    return grad / (2*Q)
 
 
 class InputNormalize(ch.nn.Module):
@@ -192,6 +253,52 @@ def ckpt_at_epoch(num):
     return '%s_%s' % (num, consts.CKPT_NAME)
 
 
+def save_checkpoint(state: dict, path: str) -> None: 
+    """
+    Atomically writes a checkpoint with torch.save, so that a process that dies while 
+    writing never leaves a partial checkpoint behind. The checkpoint is first written to a 
+    temporary file in the same directory, and then renamed over path.
+    Args: 
+        state (dict): checkpoint contents; serialized with dill, so it may contain lambdas
+        path (str): checkpoint path
+    """
+    dir_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try: 
+        with os.fdopen(fd, 'wb') as f: 
+            ch.save(state, f, pickle_module=dill)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except: 
+        if os.path.exists(tmp_path): 
+            os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path: str) -> dict: 
+    """
+    Loads a checkpoint written by save_checkpoint, or returns None if there is no checkpoint at path.
+    """
+    if path is None or not os.path.isfile(path): 
+        return None
+    return ch.load(path, pickle_module=dill, weights_only=False)
+
+
+def get_rng_state() -> dict: 
+    """
+    State of the torch, numpy and python random number generators.
+    """
+    return {'torch': ch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+
+
+def set_rng_state(state: dict) -> None: 
+    ch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+
+
 def setup_store_with_metadata(args, store):
     '''
     Sets up a store for training according to the arguments object. See the
@@ -274,6 +381,287 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class HistoryRecorder: 
+    """
+    Records snapshots of a tensor (ie. parameter iterates or losses) into a preallocated 
+    buffer, instead of concatenating a new tensor on every step. By default the buffer 
+    doubles its capacity when full; when size is given, the recorder keeps a ring buffer 
+    with the last size records. Records every interval calls to record, and can be disabled.
+    """
+    def __init__(self, 
+                interval: int=1, 
+                size: int=None, 
+                disable: bool=False, 
+                capacity: int=1024): 
+        """
+        Args: 
+            interval (int): record every interval calls to record
+            size (int): if given, only keep the last size records 
+            disable (bool): don't record anything
+            capacity (int): initial capacity of the buffer, when size is None
+        """
+        assert interval >= 1, "interval is: {}. expecting interval >= 1.".format(interval)
+        self.interval, self.size, self.disable = interval, size, disable
+        self.capacity = size if size is not None else capacity
+        self.buffer, self.count, self.steps = None, 0, 0
+
+    def record(self, value: Tensor) -> None: 
+        self.steps += 1
+        if self.disable or (self.steps - 1) % self.interval != 0: 
+            return
+        self._append(value.detach())
+
+    def extend(self, records: Tensor) -> None: 
+        """
+        Appends records from another recorder, with size (num_records, ...), without subsampling them.
+        """
+        if self.disable: 
+            return
+        for value in records: 
+            self._append(value.detach())
+
+    def _append(self, value: Tensor) -> None: 
+        if self.buffer is None: 
+            self.buffer = ch.empty((self.capacity,) + value.size(), dtype=value.dtype, device=value.device)
+        elif self.size is None and self.count == self.buffer.size(0): 
+            # amortized doubling
+            buffer = ch.empty((2 * self.buffer.size(0),) + self.buffer.size()[1:], dtype=self.buffer.dtype, device=self.buffer.device)
+            buffer[:self.count] = self.buffer
+            self.buffer = buffer
+        self.buffer[self.count % self.buffer.size(0)] = value
+        self.count += 1
+
+    @property
+    def history(self) -> Tensor: 
+        """
+        Records in order, with size (num_records, ...). A view of the buffer, unless the 
+        ring buffer has wrapped around.
+        """
+        if self.buffer is None: 
+            return ch.Tensor([])
+        if self.size is None or self.count <= self.size: 
+            return self.buffer[:self.count]
+        start = self.count % self.size
+        return ch.cat([self.buffer[start:], self.buffer[:start]])
+
+    def __len__(self): 
+        return min(self.count, self.size) if self.size is not None else self.count
+
+    def clear(self) -> None: 
+        self.count, self.steps = 0, 0
+
+
+class TrajectoryBuffer: 
+    """
+    Growable store for trajectories of an LQR system. Each sample is a row of several 
+    tensors (ie. the state x_t, control u_t and next state y_t), that are written into 
+    preallocated buffers, which double in capacity when full, instead of concatenating a 
+    new tensor on every sample. The buffer records where each trajectory ends, and returns 
+    the samples as views of the buffers, without copying them.
+    """
+    def __init__(self, 
+                *widths: int, 
+                capacity: int=1024, 
+                dtype: ch.dtype=None): 
+        """
+        Args: 
+            widths (int): number of columns of each tensor in a sample
+            capacity (int): initial number of rows; ie. the maximum number of samples, when known
+            dtype (ch.dtype): dtype of the buffers; by default, the dtype of the first tensors appended
+        """
+        assert capacity >= 1, "capacity is: {}. expecting capacity >= 1.".format(capacity)
+        self.dtype = dtype
+        self.buffers = [ch.empty(capacity, width, dtype=dtype or ch.get_default_dtype()) for width in widths]
+        self.count = 0
+        # end index of each completed trajectory
+        self.ends = []
+
+    def append(self, *rows: Tensor) -> None: 
+        """
+        Appends a sample, with one tensor of size (1, width) (or (n, width) for n samples) per buffer.
+        """
+        n = rows[0].size(0)
+        if self.count == 0 and self.dtype is None: 
+            self.buffers = [buffer.new_empty(buffer.size(), dtype=row.dtype) if buffer.dtype != row.dtype else buffer 
+                            for buffer, row in zip(self.buffers, rows)]
+        if self.count + n > self.buffers[0].size(0): 
+            # amortized doubling
+            capacity = max(2 * self.buffers[0].size(0), self.count + n)
+            buffers = [buffer.new_empty(capacity, buffer.size(1)) for buffer in self.buffers]
+            for buffer, buffer_ in zip(self.buffers, buffers): 
+                buffer_[:self.count] = buffer[:self.count]
+            self.buffers = buffers
+        for buffer, row in zip(self.buffers, rows): 
+            buffer[self.count:self.count + n] = row
+        self.count += n
+
+    def end_trajectory(self) -> None: 
+        """
+        Marks the end of the current trajectory; empty trajectories aren't recorded.
+        """
+        if self.count > (self.ends[-1] if self.ends else 0): 
+            self.ends.append(self.count)
+
+    @property
+    def tensors(self) -> tuple: 
+        """
+        Samples, as views of the buffers with size (num_samples, width).
+        """
+        return tuple(buffer[:self.count] for buffer in self.buffers)
+
+    @property
+    def offsets(self) -> Tensor: 
+        """
+        Start index of each trajectory, followed by the number of samples, including the 
+        trajectory in progress; trajectory i is the rows offsets[i]:offsets[i+1].
+        """
+        ends = self.ends + ([self.count] if self.count > (self.ends[-1] if self.ends else 0) else [])
+        return ch.tensor([0] + ends)
+
+    def __len__(self): 
+        return self.count
+
+
+class IterateAverage: 
+    """
+    Running (Polyak-Ruppert) average of the parameter iterates, in O(d) memory. When start 
+    is given, only the iterates after the first start updates are averaged (tail averaging).
+    """
+    def __init__(self, 
+                params: Iterable, 
+                start: int=0): 
+        """
+        Args: 
+            params (Iterable): parameters to average
+            start (int): number of updates to skip before averaging
+        """
+        self.params, self.start = list(params), start
+        self.average = [param.detach().clone() for param in self.params]
+        self.steps, self.count = 0, 0
+
+    def update(self) -> None: 
+        self.steps += 1
+        if self.steps <= self.start: 
+            return
+        self.count += 1
+        for average, param in zip(self.average, self.params): 
+            average.add_(param.detach() - average, alpha=1.0 / self.count)
+
+    def state_dict(self) -> dict: 
+        return {'average': self.average, 'steps': self.steps, 'count': self.count}
+
+    def load_state_dict(self, state: dict) -> None: 
+        for average, average_ in zip(self.average, state['average']): 
+            average.copy_(average_)
+        self.steps, self.count = state['steps'], state['count']
+
+    def copy_to(self) -> None: 
+        """
+        Overwrites the parameters with their average.
+        """
+        if self.count == 0: 
+            return
+        for average, param in zip(self.average, self.params): 
+            param.data.copy_(average)
+
+
+class ConvergenceMonitor: 
+    """
+    Detects the convergence of a stochastic procedure from within the training loop, without 
+    validation passes. Over each window of gradient steps, the monitor keeps the running mean 
+    of the gradients, and the parameters at the start of the window. At the end of each window, 
+    the procedure has converged when the norm of the mean gradient is at most grad_tol, and 
+    the relative change of the parameters over the window is at most param_tol. Averaging the 
+    gradients over the window averages out the noise of Monte-Carlo gradients. Uses O(d) memory.
+    """
+    def __init__(self, 
+                params: Iterable, 
+                window: int=100, 
+                grad_tol: float=1e-3, 
+                param_tol: float=1e-3): 
+        """
+        Args: 
+            params (Iterable): parameters to monitor
+            window (int): number of gradient steps per window
+            grad_tol (float): tolerance for the norm of the mean gradient over a window; float('inf') to only check the parameters
+            param_tol (float): tolerance for the relative change of the parameters over a window; float('inf') to only check the gradients
+        """
+        assert window >= 1, "window is: {}. expecting window >= 1.".format(window)
+        self.params, self.window = list(params), window
+        self.grad_tol, self.param_tol = grad_tol, param_tol
+        self.grad_sum = [ch.zeros_like(param) for param in self.params]
+        self.start = [param.detach().clone() for param in self.params]
+        self.steps, self.converged = 0, False
+        # statistics from the last window
+        self.grad_norm, self.param_change = None, None
+
+    def update(self) -> bool: 
+        """
+        Records the gradients from the last step. Call after the optimizer's step.
+        Returns: 
+            whether the procedure has converged
+        """
+        for grad_sum, param in zip(self.grad_sum, self.params): 
+            if param.grad is not None: 
+                grad_sum.add_(param.grad.detach())
+        self.steps += 1
+        if self.steps % self.window != 0: 
+            return False
+
+        self.grad_norm = sum(float(grad_sum.pow(2).sum()) for grad_sum in self.grad_sum) ** .5 / self.window
+        change = sum(float((param.detach() - start).pow(2).sum()) for param, start in zip(self.params, self.start)) ** .5
+        norm = sum(float(start.pow(2).sum()) for start in self.start) ** .5
+        self.param_change = change / max(norm, 1e-12)
+        self.converged = self.grad_norm <= self.grad_tol and self.param_change <= self.param_tol
+        for grad_sum, start, param in zip(self.grad_sum, self.start, self.params): 
+            grad_sum.zero_()
+            start.copy_(param.detach())
+        return self.converged
+
+    def state_dict(self) -> dict: 
+        return {'grad_sum': self.grad_sum, 'start': self.start, 'steps': self.steps, 'converged': self.converged, 
+                'grad_norm': self.grad_norm, 'param_change': self.param_change}
+
+    def load_state_dict(self, state: dict) -> None: 
+        for grad_sum, start, grad_sum_, start_ in zip(self.grad_sum, self.start, state['grad_sum'], state['start']): 
+            grad_sum.copy_(grad_sum_)
+            start.copy_(start_)
+        self.steps, self.converged = state['steps'], state['converged']
+        self.grad_norm, self.param_change = state['grad_norm'], state['param_change']
+
+
+def tensor_digest(*tensors: Tensor) -> str: 
+    """
+    Content hash of a sequence of tensors, including their sizes and dtypes. Used as a key 
+    for caching estimates computed from a dataset.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for tensor in tensors: 
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(str((tuple(tensor.size()), tensor.dtype)).encode())
+        digest.update(tensor.view(-1).view(ch.uint8).numpy().data)
+    return digest.hexdigest()
+
+
+
+def tensor_identity(*tensors: Tensor) -> tuple: 
+    """
+    Cheap cache key for a sequence of tensors: their storage, layout and version counters, 
+    which in-place operations bump. Holds weak references to the tensors, so that a key 
+    never matches new tensors allocated in the memory of freed ones. Compare keys with 
+    same_tensors.
+    """
+    return tuple((weakref.ref(tensor), tensor.data_ptr(), tuple(tensor.size()), tensor.stride(), tensor._version) 
+                    for tensor in tensors)
+
+
+def same_tensors(key: tuple, *tensors: Tensor) -> bool: 
+    """
+    Whether a key made by tensor_identity still describes the given tensors, unmodified.
+    """
+    return len(key) == len(tensors) and all(ref() is tensor and tuple(rest) == tensor_identity(tensor)[0][1:] 
+                                            for (ref, *rest), tensor in zip(key, tensors))
+
 class Bounds(NamedTuple): 
     lower: Tensor
     upper: Tensor
@@ -370,4 +758,143 @@ def calc_thickness(X):
   return LA.eig(X).eigenvalues.real.min()
 
 
+class ThicknessMonitor: 
+    """
+    Checks whether the thickness (minimum eigenvalue) of a covariate matrix, that grows by 
+    rank-1 updates v^T v, has reached a target. For the eigenvectors u_j of the covariate 
+    matrix at the last exact computation, with eigenvalues lambda_j, the Rayleigh quotients 
+    lambda_j + sum (u_j . v)^2 over the rows v added since then bound the thickness from 
+    above. The O(d^3) eigendecomposition is only computed when the bound reaches the target 
+    (and warm-starts the next bound), and each update costs O(d^2); the monitor stops at the 
+    same sample as computing the thickness after every update.
+    """
+    def __init__(self, 
+                d: int, 
+                target: float=float('inf')): 
+        """
+        Args: 
+            d (int): dimension of the covariate matrix
+            target (float): target thickness
+        """
+        self.covariate_matrix = ch.zeros(d, d)
+        self.target = target
+        # eigenvectors at the last exact computation, and their Rayleigh quotients after the updates since
+        self.eigenvectors, self.quotients = ch.eye(d), ch.zeros(d)
+        # thickness at the last exact computation
+        self.thickness = 0.0
+        self.num_exact = 0
+
+    def update(self, v: Tensor) -> None: 
+        """
+        Adds v^T v to the covariate matrix, for v with size (n, d).
+        """
+        self.covariate_matrix += v.T@v
+        self.quotients += (v@self.eigenvectors).pow(2).sum(0)
+
+    @property
+    def upper(self) -> float: 
+        """
+        Upper bound on the thickness of the covariate matrix.
+        """
+        return float(self.quotients.min())
+
+    def reached(self) -> bool: 
+        """
+        Whether the thickness of the covariate matrix is at least the target.
+        """
+        if self.upper < self.target: 
+            return False
+        eigenvalues, self.eigenvectors = LA.eigh(self.covariate_matrix)
+        self.quotients = eigenvalues.clone()
+        self.thickness = float(eigenvalues[0])
+        self.num_exact += 1
+        return self.thickness >= self.target
+
+
+def _log_std_normal_pdf(x): 
+    return -.5 * x.pow(2) - .5 * math.log(2 * math.pi)
+
+
+def _log_diff_exp(a, b): 
+    # log(exp(a) - exp(b)) for b <= a
+    return a + ch.log1p(-ch.exp(b - a))
+
+
+def _std_normal_log_mass(alpha, beta): 
+    """
+    log P(alpha < t < beta) for a standard normal t. Intervals to the right of the mean 
+    are mirrored to the left to avoid catastrophic cancellation in the upper tail. Bounds 
+    are clamped to +-1e3, which does not change the mass in double precision, so that 
+    the gradients with respect to infinite bounds remain finite.
+    """
+    upper = alpha > 0
+    alpha, beta = ch.where(upper, -beta, alpha).clamp(-1e3, 1e3), ch.where(upper, -alpha, beta).clamp(-1e3, 1e3)
+    return _log_diff_exp(ch.special.log_ndtr(beta), ch.special.log_ndtr(alpha))
+
+
+def _standardize_bound(bound, mu, sigma): 
+    # infinite bounds stay infinite, without passing nan gradients back to mu and sigma
+    bound = ch.as_tensor(bound, dtype=ch.float64)
+    inf = ch.isinf(bound)
+    return ch.where(inf, bound, (bound.masked_fill(inf, 0.0) - mu) / sigma)
+
 
+def _standardize(loc, scale, intervals): 
+    # standardized interval bounds, computed in double precision so that the tails remain stable
+    mu, sigma = loc.double(), ch.as_tensor(scale, dtype=ch.float64)
+    bounds = [(_standardize_bound(lower, mu, sigma), _standardize_bound(upper, mu, sigma)) for lower, upper in intervals]
+    return mu, sigma, bounds
+
+
+def truncated_normal_log_mass(loc, scale, intervals: Iterable):
+    """
+    Log probability that a sample from N(loc, scale^2) falls within a union of 
+    disjoint intervals.
+    Args: 
+        loc (torch.Tensor): mean of the normal distribution 
+        scale (torch.Tensor): standard deviation of the normal distribution, broadcastable with loc
+        intervals (Iterable): (lower, upper) bounds of the disjoint intervals; bounds can be infinite
+    Returns: 
+        log mass of the truncation set, with loc's dtype
+    """
+    _, _, bounds = _standardize(loc, scale, intervals)
+    log_mass = ch.logsumexp(ch.stack(ch.broadcast_tensors(*[_std_normal_log_mass(alpha, beta) for alpha, beta in bounds])), 0)
+    return log_mass.to(loc.dtype)
+
+
+def truncated_normal_moments(loc, scale, intervals: Iterable, order: int=2):
+    """
+    Closed-form raw moments of a normal distribution conditioned on a union of 
+    disjoint intervals. Uses the recursion for the standard truncated normal 
+    moments m_k = (k - 1) m_{k-2} + sum_i (a_i^{k-1} pdf(a_i) - b_i^{k-1} pdf(b_i)) / Z.
+    Args: 
+        loc (torch.Tensor): mean of the normal distribution 
+        scale (torch.Tensor): standard deviation of the normal distribution, broadcastable with loc
+        intervals (Iterable): (lower, upper) bounds of the disjoint intervals; bounds can be infinite
+        order (int): highest raw moment to compute
+    Returns: 
+        list [E[x | x in S], ..., E[x^order | x in S]], with loc's size and dtype
+    """
+    mu, sigma, bounds = _standardize(loc, scale, intervals)
+    log_mass = truncated_normal_log_mass(mu, sigma, intervals)
+    terms = [ch.zeros_like(mu) for _ in range(order)]
+    for alpha, beta in bounds: 
+        # pdf(bound) / Z; infinite bounds have zero density, so zero them before taking powers
+        pdf_alpha = ch.exp(_log_std_normal_pdf(alpha) - log_mass)
+        pdf_beta = ch.exp(_log_std_normal_pdf(beta) - log_mass)
+        alpha_, beta_ = alpha.nan_to_num(posinf=0.0, neginf=0.0), beta.nan_to_num(posinf=0.0, neginf=0.0)
+        for j in range(order): 
+            terms[j] = terms[j] + alpha_.pow(j) * pdf_alpha - beta_.pow(j) * pdf_beta
+
+    # standardized moments
+    std_moments = [ch.ones_like(mu)]
+    for k in range(1, order + 1): 
+        prev = (k - 1) * std_moments[k - 2] if k > 1 else 0.0
+        std_moments.append(prev + terms[k - 1])
+
+    # raw moments of x = loc + scale * t
+    moments = []
+    for k in range(1, order + 1): 
+        moment = sum(math.comb(k, j) * mu.pow(k - j) * sigma.pow(j) * std_moments[j] for j in range(k + 1))
+        moments.append(moment.to(loc.dtype))
+    return moments
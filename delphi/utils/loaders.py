@@ -15,6 +15,135 @@ else:
     from tqdm import tqdm
 
 
+class TensorLoader:
+    '''
+    Zero-copy batch iterator for in-memory tensor datasets, that bypasses the DataLoader's 
+    per-sample indexing and collation. When shuffling, the tensors are permuted with 
+    one randperm and index_select per epoch; batches are then contiguous slices (views) 
+    of the permuted tensors.
+    '''
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False):
+        '''
+        Args:
+            dataset (torch.utils.data.TensorDataset): in-memory dataset
+            batch_size (int): number of samples per batch
+            shuffle (bool): reshuffle the dataset at the start of every epoch
+            drop_last (bool): drop the last incomplete batch
+        '''
+        self.dataset = dataset
+        self.tensors = tuple(tensor.contiguous() for tensor in dataset.tensors)
+        self.batch_size, self.shuffle, self.drop_last = batch_size, shuffle, drop_last
+        self.num_workers = 0
+
+    @classmethod
+    def from_loader(cls, loader):
+        '''
+        Returns a TensorLoader with the same batching as a DataLoader over a TensorDataset, 
+        and returns any other loader unchanged.
+        '''
+        if not isinstance(loader, DataLoader) or not isinstance(loader.dataset, TensorDataset) \
+            or loader.batch_size is None or loader.collate_fn is not ch.utils.data.default_collate \
+            or type(loader.sampler) not in (ch.utils.data.RandomSampler, ch.utils.data.SequentialSampler):
+            return loader
+        return cls(loader.dataset, loader.batch_size, 
+                   shuffle=isinstance(loader.sampler, ch.utils.data.RandomSampler), drop_last=loader.drop_last)
+
+    def __len__(self):
+        n = len(self.dataset)
+        return n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            perm = ch.randperm(len(self.dataset), device=tensors[0].device)
+            tensors = tuple(tensor.index_select(0, perm) for tensor in tensors)
+        for i in range(len(self)):
+            yield tuple(tensor[i * self.batch_size:(i + 1) * self.batch_size] for tensor in tensors)
+
+
+class ArrayDataset(ch.utils.data.Dataset):
+    '''
+    Dataset over a range of rows of arrays that don't fit in memory (ie. numpy memory 
+    maps or PyTables arrays). Rows are only read when indexed.
+    '''
+    def __init__(self, X, y, start=0, stop=None):
+        '''
+        Args:
+            X: size (num_samples, d) - covariates, any array that supports slicing
+            y: size (num_samples, k) - dependent variable, any array that supports slicing
+            start (int): first row of the dataset
+            stop (int): end of the dataset's rows; default len(X)
+        '''
+        assert len(X) == len(y), "X has {} rows and y has {} rows. expecting the same number of rows.".format(len(X), len(y))
+        self.X, self.y = X, y
+        self.start, self.stop = start, stop if stop is not None else len(X)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, idx):
+        X, y = self.read(self.start + idx, self.start + idx + 1)
+        return X[0], y[0]
+
+    def read(self, start, stop):
+        '''
+        Reads the rows [start, stop) of the underlying arrays into memory, as tensors.
+        '''
+        X, y = self.X[start:stop], self.y[start:stop]
+        return (X if isinstance(X, ch.Tensor) else ch.from_numpy(np.array(X)), 
+                y if isinstance(y, ch.Tensor) else ch.from_numpy(np.array(y)))
+
+
+class BlockShuffleLoader:
+    '''
+    Minibatch iterator for arrays that don't fit in memory. Rows are read in contiguous 
+    blocks of block_size rows; when shuffling, the block order and the rows within each 
+    block are permuted every epoch, so that every block is read once per epoch with 
+    sequential reads. The transform (ie. intercept augmentation and scaling) is applied 
+    to each batch, so the dataset is never copied in full.
+    '''
+    def __init__(self, dataset, batch_size=1, block_size=10000, shuffle=False, transform=None):
+        '''
+        Args:
+            dataset (delphi.utils.loaders.ArrayDataset): out-of-core dataset
+            batch_size (int): number of samples per batch
+            block_size (int): number of rows to read into memory at a time
+            shuffle (bool): reshuffle the blocks and the rows within them at the start of every epoch
+            transform (Callable): function applied to each batch, that receives and returns (X, y)
+        '''
+        assert block_size >= batch_size, "block_size is: {}. expecting block_size >= batch_size: {}.".format(block_size, batch_size)
+        self.dataset = dataset
+        self.batch_size, self.block_size, self.shuffle = batch_size, block_size, shuffle
+        self.transform = transform
+        self.num_workers = 0
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        starts = ch.arange(self.dataset.start, self.dataset.stop, self.block_size)
+        if self.shuffle:
+            starts = starts[ch.randperm(starts.numel())]
+        X_, y_ = None, None
+        for start in starts.tolist():
+            X, y = self.dataset.read(start, min(start + self.block_size, self.dataset.stop))
+            if self.shuffle:
+                perm = ch.randperm(X.size(0))
+                X, y = X[perm], y[perm]
+            # carry the rows left over from the previous block, so that all batches are full
+            if X_ is not None:
+                X, y = ch.cat([X_, X]), ch.cat([y_, y])
+            num_batches = X.size(0) // self.batch_size
+            for i in range(num_batches):
+                yield self._batch(X[i * self.batch_size:(i + 1) * self.batch_size], y[i * self.batch_size:(i + 1) * self.batch_size])
+            X_, y_ = X[num_batches * self.batch_size:], y[num_batches * self.batch_size:]
+        if X_ is not None and X_.size(0) > 0:
+            yield self._batch(X_, y_)
+
+    def _batch(self, X, y):
+        return self.transform(X, y) if self.transform is not None else (X, y)
+
+
 ## loader wrapper (for adding custom functions to dataloader)
 class PerEpochLoader:
     '''
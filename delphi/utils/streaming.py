@@ -0,0 +1,166 @@
+"""
+Streaming estimates for datasets that don't fit in memory.
+"""
+
+import numpy as np
+import torch as ch
+from torch import Tensor
+from typing import Iterable, Iterator, NamedTuple, Tuple
+
+
+class EmpiricalEstimates(NamedTuple):
+    """
+    OLS estimates for a training set.
+    Args:
+        coef (torch.Tensor): size (d, k) - OLS coefficients
+        noise_var (torch.Tensor): size (k, 1) - variance of the OLS residuals
+        rank (int): rank of the covariate matrix
+        singular (numpy.ndarray): singular values of the covariate matrix, in descending order
+        Sigma_0 (torch.Tensor): size (d, d) - scaled empirical covariance for linear dynamical systems, otherwise None
+    """
+    coef: Tensor
+    noise_var: Tensor
+    rank: int
+    singular: np.ndarray
+    Sigma_0: Tensor
+
+
+def iter_chunks(X,
+                y,
+                chunk_size: int=10000, 
+                start: int=0, 
+                stop: int=None) -> Iterator[Tuple[Tensor, Tensor]]:
+    """
+    Iterates over a dataset in contiguous chunks of rows. X and y can be tensors, numpy
+    arrays, numpy memory maps (np.memmap, np.load(..., mmap_mode='r')) or HDF5 datasets;
+    only one chunk is read into memory at a time.
+    Args:
+        X : size (num_samples, d) - covariates
+        y : size (num_samples, k) - dependent variable
+        chunk_size (int): number of rows per chunk
+        start (int): first row to read
+        stop (int): end of the rows to read; default len(X)
+    """
+    assert len(X) == len(y), "X has {} rows and y has {} rows. expecting the same number of rows.".format(len(X), len(y))
+    stop = len(X) if stop is None else stop
+    for start_ in range(start, stop, chunk_size):
+        X_, y_ = X[start_:min(start_ + chunk_size, stop)], y[start_:min(start_ + chunk_size, stop)]
+        # copy chunks of read-only memory maps into memory
+        yield (X_ if isinstance(X_, Tensor) else ch.from_numpy(np.array(X_)), 
+                y_ if isinstance(y_, Tensor) else ch.from_numpy(np.array(y_)))
+
+
+class SufficientStatistics:
+    """
+    Sufficient statistics for OLS (X^T X, X^T y, y^T y and the column sums), and the
+    maximum row norms used to scale the covariates, accumulated over chunks of rows in
+    one pass. Statistics are accumulated in double precision.
+    """
+    def __init__(self,
+                fit_intercept: bool=False):
+        """
+        Args:
+            fit_intercept (bool): append a column of ones to the covariates, as TruncatedLinearRegression does when fitting an intercept
+        """
+        self.fit_intercept = fit_intercept
+        self.n = 0
+        self.XtX, self.Xty, self.yty, self.X_sum, self.y_sum = None, None, None, None, None
+        # maximum l_2 and l_inf norms of the rows of X
+        self.l_2, self.l_inf = 0.0, 0.0
+
+    @classmethod
+    def from_chunks(cls,
+                    chunks: Iterable[Tuple[Tensor, Tensor]],
+                    fit_intercept: bool=False):
+        """
+        Accumulates the statistics over an iterable of (X, y) chunks, ie. iter_chunks or a DataLoader.
+        """
+        stats = cls(fit_intercept)
+        for X, y in chunks:
+            stats.update(X, y)
+        return stats
+
+    def update(self,
+                X: Tensor,
+                y: Tensor):
+        """
+        Adds a chunk of rows to the statistics.
+        Args:
+            X (torch.Tensor): size (chunk_size, d) - covariates
+            y (torch.Tensor): size (chunk_size, k) - dependent variable
+        """
+        X, y = self._covariates(X), y.double()
+        if self.XtX is None:
+            self.XtX, self.Xty = X.new_zeros(X.size(1), X.size(1)), X.new_zeros(X.size(1), y.size(1))
+            self.yty, self.X_sum, self.y_sum = y.new_zeros(y.size(1), y.size(1)), X.new_zeros(X.size(1)), y.new_zeros(y.size(1))
+        self.XtX += X.T@X
+        self.Xty += X.T@y
+        self.yty += y.T@y
+        self.X_sum += X.sum(0)
+        self.y_sum += y.sum(0)
+        self.n += X.size(0)
+        self._update_norms(X)
+        return self
+
+    def update_norms(self,
+                        X: Tensor):
+        """
+        Adds a chunk of rows to the maximum row norms only; ie. rows that are scaled like the 
+        training set, but aren't part of its OLS estimates.
+        Args:
+            X (torch.Tensor): size (chunk_size, d) - covariates
+        """
+        self._update_norms(self._covariates(X))
+        return self
+
+    def _covariates(self, 
+                    X: Tensor) -> Tensor:
+        X = X.double()
+        if self.fit_intercept:
+            X = ch.cat([X, ch.ones(X.size(0), 1, dtype=X.dtype)], dim=1)
+        return X
+
+    def _update_norms(self, 
+                        X: Tensor) -> None:
+        if X.size(0) > 0:
+            self.l_2 = max(self.l_2, float(X.norm(dim=1, p=2).max()))
+            self.l_inf = max(self.l_inf, float(X.abs().max()))
+
+    @property
+    def d(self) -> int:
+        return self.XtX.size(0)
+
+    @property
+    def beta(self) -> Tensor:
+        """
+        Scaling for the covariates, so that the maximum l_2 norm of the rows is at most 1.
+        """
+        if self.l_2 > 1:
+            return ch.tensor(self.l_inf * (self.d ** .5))
+        return ch.ones(1, 1)
+
+    def estimates(self,
+                    beta: Tensor=None,
+                    s: float=None,
+                    dtype: ch.dtype=ch.float32) -> EmpiricalEstimates:
+        """
+        OLS estimates for the covariates divided by beta.
+        Args:
+            beta (torch.Tensor): covariate scaling; default no scaling
+            s (float): if given, compute Sigma_0 = X^T X / (s * n) for linear dynamical systems
+            dtype (torch.dtype): dtype of the returned tensors
+        """
+        assert self.n > 0, "no rows have been added to the sufficient statistics"
+        beta = float(beta) if beta is not None else 1.0
+        XtX, Xty = self.XtX / beta ** 2, self.Xty / beta
+        # min-norm solution of the normal equations, which is the min-norm least squares solution
+        coef = ch.linalg.lstsq(XtX, Xty, driver='gelsd').solution
+        # residual variance, from sum (Xw - y)^2 and sum (Xw - y)
+        resid_sq = (coef * (XtX@coef)).sum(0) - 2 * (coef * Xty).sum(0) + self.yty.diagonal()
+        resid_sum = (self.X_sum / beta)@coef - self.y_sum
+        noise_var = (resid_sq - resid_sum.pow(2) / self.n) / (self.n - 1)
+
+        singular = ch.linalg.eigvalsh(XtX).clamp(min=0).sqrt().flip(0)
+        tol = singular[0] * max(self.n, self.d) * ch.finfo(dtype).eps
+        Sigma_0 = (XtX / (s * self.n)).to(dtype) if s is not None else None
+        return EmpiricalEstimates(coef.to(dtype), noise_var[..., None].to(dtype), int((singular > tol).sum()), singular.to(dtype).numpy(), Sigma_0)
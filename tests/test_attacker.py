@@ -0,0 +1,72 @@
+"""
+Test suite for the adversarial attacker.
+Includes:
+    -PGD attacks on CPU
+    -Batched random restarts
+"""
+import torch as ch
+from types import SimpleNamespace
+
+from delphi.attacker import Attacker
+
+# CONSTANTS
+seed = 69
+
+
+def test_cpu_attack():
+    ch.manual_seed(seed)
+    model = ch.nn.Sequential(ch.nn.Flatten(), ch.nn.Linear(3 * 4 * 4, 5))
+    dataset = SimpleNamespace(mean=ch.zeros(3), std=ch.ones(3))
+    attacker = Attacker(model, dataset)
+    x, target = ch.rand(20, 3, 4, 4), ch.randint(5, (20,))
+    criterion = ch.nn.CrossEntropyLoss(reduction='none')
+
+    for constraint, eps in [('inf', .1), ('2', .5)]:
+        attack_kwargs = {'constraint': constraint, 'eps': eps, 'step_size': eps / 4, 'iterations': 10}
+        adv = attacker(x, target, use_best=False, **attack_kwargs)
+        best_adv = attacker(x, target, use_best=True, num_threads=1, **attack_kwargs)
+        assert adv.device == x.device and best_adv.device == x.device
+        diff = (best_adv - x).flatten(1)
+        norm = diff.abs().amax(1) if constraint == 'inf' else diff.norm(dim=1)
+        assert (norm <= eps + 1e-5).all(), f'perturbation norm: {norm.max()}, eps: {eps}'
+        with ch.no_grad():
+            loss, adv_loss, best_loss = criterion(model(x), target), criterion(model(adv), target), criterion(model(best_adv), target)
+        print(f'constraint: {constraint}, loss: {loss.mean()}, adversarial loss: {adv_loss.mean()}, best adversarial loss: {best_loss.mean()}')
+        # the best iterates are at least as adversarial as the last iterates
+        assert (best_loss >= adv_loss - 1e-6).all() and best_loss.mean() > loss.mean()
+
+    # random restarts keep the misclassified examples
+    adv = attacker(x, target, constraint='inf', eps=.1, step_size=.025, iterations=10, random_start=True, random_restarts=3)
+    assert adv.size() == x.size() and ((adv - x).abs() <= .1 + 1e-5).all()
+
+
+def test_batched_restarts():
+    ch.manual_seed(seed)
+    model = ch.nn.Sequential(ch.nn.Flatten(), ch.nn.Linear(3 * 4 * 4, 5))
+    attacker = Attacker(model, SimpleNamespace(mean=ch.zeros(3), std=ch.ones(3)))
+    x, target = ch.rand(20, 3, 4, 4), ch.randint(5, (20,))
+    criterion = ch.nn.CrossEntropyLoss(reduction='none')
+    attack_kwargs = {'constraint': '2', 'eps': .5, 'step_size': .125, 'iterations': 10}
+
+    # without random starts, every restart is the same attack
+    adv = attacker(x, target, **attack_kwargs)
+    batched_adv = attacker(x, target, random_restarts=4, batch_restarts=True, restart_batch_size=7, **attack_kwargs)
+    assert ch.allclose(adv, batched_adv, atol=1e-6)
+
+    # the batched restarts keep the worst restart per input
+    batched_adv = attacker(x, target, random_start=True, random_restarts=8, batch_restarts=True, restart_batch_size=32, **attack_kwargs)
+    assert batched_adv.size() == x.size()
+    assert ((batched_adv - x).flatten(1).norm(dim=1) <= .5 + 1e-5).all()
+    with ch.no_grad():
+        adv_loss, batched_loss = criterion(model(adv), target), criterion(model(batched_adv), target)
+    print(f'adversarial loss: {adv_loss.mean()}, batched restarts loss: {batched_loss.mean()}')
+    assert batched_loss.mean() >= adv_loss.mean() - 1e-2
+
+    # the restarts are compared with the losses from the attack, without extra forward passes
+    num_calls = []
+    model.register_forward_hook(lambda module, inp, out: num_calls.append(1))
+    for use_best in [True, False]:
+        num_calls.clear()
+        attacker(x, target, random_start=True, random_restarts=8, batch_restarts=True, restart_batch_size=32, use_best=use_best, **attack_kwargs)
+        assert len(num_calls) == 5 * (10 + 1), f'forward passes: {len(num_calls)}'
+
@@ -0,0 +1,149 @@
+"""
+Test suite for the truncated gradients.
+Includes:
+    -Closed-form truncated normal moments for interval oracles
+    -Adaptive rejection sampling
+    -Inverse-CDF and importance sampling
+"""
+import torch as ch
+from torch.distributions import Normal
+
+from delphi import oracle
+from delphi.grad import TruncatedMSE, TruncatedUnknownVarianceMSE
+from delphi.samplers import RejectionSampler, InverseCDFSampler, ImportanceSampler
+from delphi.utils.helpers import truncated_normal_moments, logistic
+
+# CONSTANTS
+seed = 69
+NUM_SAMPLES = 100000
+
+
+def mc_moments(pred, scale, phi):
+    '''
+    Monte Carlo estimate for the first two conditional moments, used as ground-truth.
+    '''
+    noised = pred[None,...] + scale * ch.randn((NUM_SAMPLES,) + pred.size())
+    filtered = phi(noised).float()
+    z = (filtered * noised).sum(0) / filtered.sum(0)
+    z_2 = (filtered * noised.pow(2)).sum(0) / filtered.sum(0)
+    return z, z_2
+
+
+def test_truncated_normal_moments():
+    ch.manual_seed(seed)
+    pred = ch.linspace(-2, 2, 5)[...,None]
+    scale = 1.5
+    oracles = [
+        oracle.Left_Regression(ch.zeros(1)),
+        oracle.Right_Regression(ch.ones(1)),
+        oracle.Interval(-ch.ones(1), 2*ch.ones(1)),
+        oracle.KIntervalUnion([(-3*ch.ones(1), -1*ch.ones(1)), (ch.zeros(1), ch.ones(1))]),
+    ]
+    for phi in oracles:
+        z, z_2 = truncated_normal_moments(pred, ch.as_tensor(scale), phi.intervals())
+        z_mc, z_2_mc = mc_moments(pred, scale, phi)
+        print(f'{phi} closed-form: {z.flatten()}, monte carlo: {z_mc.flatten()}')
+        assert ch.allclose(z, z_mc, atol=5e-2), f'{phi}: closed-form mean {z}, monte carlo mean {z_mc}'
+        assert ch.allclose(z_2, z_2_mc, atol=1e-1), f'{phi}: closed-form second moment {z_2}, monte carlo second moment {z_2_mc}'
+
+
+def test_analytic_truncated_mse():
+    ch.manual_seed(seed)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    pred = ch.randn(10, 1, requires_grad=True)
+    targ = ch.rand(10, 1)
+    noise_var = ch.ones(1, 1)
+
+    TruncatedMSE.apply(pred, targ, phi, noise_var, 10).backward()
+    analytic_grad = pred.grad.clone()
+    pred.grad = None
+    # lambda oracle with the same truncation set forces the monte carlo path
+    TruncatedMSE.apply(pred, targ, lambda x: x > 0, noise_var, NUM_SAMPLES).backward()
+    mc_grad = pred.grad.clone()
+    assert ch.allclose(analytic_grad, mc_grad, atol=1e-2), f'analytic grad: {analytic_grad}, mc grad: {mc_grad}'
+
+    lambda_ = ch.ones(1, 1, requires_grad=True)
+    pred.grad = None
+    TruncatedUnknownVarianceMSE.apply(pred, targ, lambda_, phi, 10).backward()
+    analytic_grad, analytic_lambda_grad = pred.grad.clone(), lambda_.grad.clone()
+    pred.grad, lambda_.grad = None, None
+    TruncatedUnknownVarianceMSE.apply(pred, targ, lambda_, lambda x: x > 0, NUM_SAMPLES).backward()
+    assert ch.allclose(analytic_grad, pred.grad, atol=1e-2), f'analytic grad: {analytic_grad}, mc grad: {pred.grad}'
+    assert ch.allclose(analytic_lambda_grad, lambda_.grad, atol=1e-2), f'analytic lambda grad: {analytic_lambda_grad}, mc lambda grad: {lambda_.grad}'
+
+
+def test_adaptive_rejection_sampler():
+    ch.manual_seed(seed)
+    # the first row has a survival probability around .5, the second row around .001
+    pred = ch.Tensor([[0.0], [-3.0]])
+    phi = lambda x: x > 0
+    sampler = RejectionSampler(num_samples=10, min_accepted=5, max_samples=10000)
+    samples = sampler(pred, phi, Normal(ch.zeros(1), ch.ones(1)))
+    print(f'acceptance counts: {samples.counts.flatten()}, draws: {samples.draws.flatten()}')
+
+    assert (samples.counts >= 5).all(), f'acceptance counts: {samples.counts}'
+    assert samples.draws[0] < samples.draws[1], f'draws: {samples.draws}'
+    assert ch.equal(samples.total_weight, samples.counts)
+    # extra rounds only hold the rows that had too few accepted samples
+    assert len(samples.rounds) > 0 and all(ch.equal(rows, ch.tensor([1])) for rows, _, _ in samples.rounds)
+    assert sum(noise.size(0) for _, noise, _ in samples.rounds) + samples.noise.size(0) == samples.draws[1]
+    # rejected samples have zero weight
+    for noise, weights, rows in [(samples.noise, samples.weights, slice(None))] + [(noise, weights, rows) for rows, noise, weights in samples.rounds]:
+        assert ((pred[rows][None,...] + noise)[weights.bool()] > 0).all()
+
+    z = samples.weighted_sum(lambda noise, pred: pred[None,...] + noise, pred) / samples.total_weight
+    z_, = truncated_normal_moments(pred, ch.ones(1), [(0.0, float('inf'))], order=1)
+    assert (z[1] - z_[1]).abs() < .5, f'adaptive estimate: {z}, closed-form: {z_}'
+
+
+def test_inverse_cdf_sampler():
+    ch.manual_seed(seed)
+    # the last row has a survival probability around 1e-23
+    pred = ch.Tensor([[0.0], [-3.0], [-10.0]])
+    sampler = InverseCDFSampler(num_samples=NUM_SAMPLES)
+    oracles = [
+        oracle.Left_Regression(ch.zeros(1)),
+        oracle.KIntervalUnion([(-3*ch.ones(1), -1*ch.ones(1)), (ch.zeros(1), ch.ones(1))]),
+    ]
+    for phi in oracles:
+        samples = sampler(pred, phi, Normal(ch.zeros(1), ch.ones(1)))
+        noised = pred[None,...] + samples.noise
+        # every draw falls within the truncation set
+        assert phi(noised).all(), f'{phi}: samples outside of the truncation set'
+        assert ch.equal(samples.counts, samples.draws)
+
+        z_, z_2_ = truncated_normal_moments(pred, ch.ones(1), phi.intervals())
+        z, z_2 = noised.mean(0), noised.pow(2).mean(0)
+        print(f'{phi} inverse cdf: {z.flatten()}, closed-form: {z_.flatten()}')
+        assert ch.allclose(z, z_, atol=5e-2), f'{phi}: inverse cdf mean {z}, closed-form mean {z_}'
+        assert ch.allclose(z_2, z_2_, atol=1e-1), f'{phi}: inverse cdf second moment {z_2}, closed-form second moment {z_2_}'
+
+    # logistic noise
+    phi = oracle.Left_Regression(ch.zeros(1))
+    samples = sampler(pred, phi, logistic)
+    assert phi(pred[None,...] + samples.noise).all()
+    # lambda oracles fall back to rejection sampling
+    samples = sampler(pred, lambda x: x > 0, Normal(ch.zeros(1), ch.ones(1)))
+    assert samples.counts[2] == 0, f'acceptance counts: {samples.counts}'
+
+
+def test_importance_sampler():
+    ch.manual_seed(seed)
+    pred = ch.Tensor([[0.0], [-3.0], [-6.0]])
+    z_, = truncated_normal_moments(pred, ch.ones(1), [(0.0, float('inf'))], order=1)
+    # shift towards the closest point within the truncation set, from the oracle's intervals
+    sampler = ImportanceSampler(num_samples=NUM_SAMPLES)
+    samples = sampler(pred, oracle.Left_Regression(ch.zeros(1)), Normal(ch.zeros(1), ch.ones(1)))
+    noised = pred[None,...] + samples.noise
+    z = (samples.weights * noised).sum(0) / samples.weights.sum(0)
+    print(f'importance sampling: {z.flatten()}, closed-form: {z_.flatten()}')
+    assert ch.allclose(samples.weights.sum(0), samples.counts)
+    assert (samples.counts > NUM_SAMPLES / 3).all(), f'acceptance counts: {samples.counts}'
+    assert ch.allclose(z, z_, atol=5e-2), f'importance sampling mean {z}, closed-form mean {z_}'
+
+    # shift from a pilot rejection sampling round
+    sampler = ImportanceSampler(num_samples=NUM_SAMPLES, pilot_samples=1000)
+    samples = sampler(pred[:2], lambda x: x > 0, Normal(ch.zeros(1), ch.ones(1)))
+    noised = pred[:2][None,...] + samples.noise
+    z = (samples.weights * noised).sum(0) / samples.weights.sum(0)
+    assert ch.allclose(z, z_[:2], atol=5e-2), f'importance sampling mean {z}, closed-form mean {z_[:2]}'
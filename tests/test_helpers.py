@@ -0,0 +1,265 @@
+"""
+Test suite for the helper utilities.
+Includes:
+    -History recorder
+    -Trainer history recording
+    -In-memory tensor loader
+    -Polyak-Ruppert iterate averaging
+    -Convergence monitor
+    -Chunked zeroth-order gradient estimates
+    -Trajectory buffer
+    -Thickness monitor
+"""
+import torch as ch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from delphi import stats
+from delphi import oracle
+from delphi.utils.helpers import ConvergenceMonitor, HistoryRecorder, Parameters, ThicknessMonitor, TrajectoryBuffer, calc_est_grad, calc_thickness
+from delphi.utils.loaders import TensorLoader
+from delphi.utils.datasets import make_train_and_val
+
+# CONSTANTS
+seed = 69
+
+
+def test_history_recorder():
+    values = ch.arange(3000.).view(-1, 1, 1)
+    recorder = HistoryRecorder(capacity=16)
+    for value in values:
+        recorder.record(value)
+    assert ch.equal(recorder.history, values), 'growable recorder does not match the concatenated history'
+
+    # only record every 10 steps
+    recorder = HistoryRecorder(interval=10)
+    for value in values:
+        recorder.record(value)
+    assert ch.equal(recorder.history, values[::10])
+
+    # ring buffer keeps the last records in order
+    recorder = HistoryRecorder(size=100)
+    for value in values:
+        recorder.record(value)
+    assert len(recorder) == 100 and recorder.buffer.size(0) == 100
+    assert ch.equal(recorder.history, values[-100:])
+
+    recorder = HistoryRecorder(disable=True)
+    for value in values:
+        recorder.record(value)
+    assert recorder.history.numel() == 0 and recorder.buffer is None
+
+
+def test_trainer_history():
+    ch.manual_seed(seed)
+    X = ch.randn(1000, 2)
+    y = X@ch.ones(2, 1) + ch.randn(1000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    train_kwargs = Parameters({'alpha': .5,
+                                'epochs': 2,
+                                'trials': 1,
+                                'batch_size': 10,
+                                'history_interval': 5})
+    trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+    trunc_reg.fit(X, y)
+    num_steps = 2 * len(trunc_reg.train_loader)
+    print(f'number of steps: {num_steps}, history size: {trunc_reg.history.size()}')
+    assert trunc_reg.history.size() == (len(range(0, num_steps, 5)), 3, 1), f'history size: {trunc_reg.history.size()}'
+    assert trunc_reg.trainer.train_costs.size() == (len(range(0, num_steps, 5)),)
+
+    # an epoch only returns the iterates recorded during it
+    trainer = trunc_reg.trainer
+    optimizer, schedule = trunc_reg.make_optimizer_and_schedule(trunc_reg._parameters)
+    history = trainer.history.clone()
+    epoch_history = trainer.model_loop_(trunc_reg.args, trunc_reg.train_loader, 3, True, optimizer, schedule)[3]
+    assert ch.equal(epoch_history, trainer.history[len(history):]) and len(epoch_history) == len(range(num_steps, num_steps + len(trunc_reg.train_loader), 5))
+    assert len(trainer.model_loop_(trunc_reg.args, trunc_reg.val_loader, 3, False)[3]) == 0
+
+
+def test_tensor_loader():
+    ch.manual_seed(seed)
+    X, y = ch.randn(1003, 3), ch.randn(1003, 1)
+    train_loader, val_loader = make_train_and_val(Parameters({'batch_size': 10, 'shuffle': False}), X, y)
+    loader = TensorLoader.from_loader(train_loader)
+    assert isinstance(loader, TensorLoader) and not loader.shuffle
+    assert len(loader) == len(train_loader)
+    for (inp, targ), (inp_, targ_) in zip(loader, train_loader):
+        assert ch.equal(inp, inp_) and ch.equal(targ, targ_)
+
+    # shuffled batches cover the dataset once per epoch
+    loader = TensorLoader(train_loader.dataset, batch_size=10, shuffle=True)
+    for _ in range(2):
+        inp = ch.cat([batch[0] for batch in loader])
+        assert not ch.equal(inp, train_loader.dataset.tensors[0])
+        assert ch.equal(inp.sort(0)[0], train_loader.dataset.tensors[0].sort(0)[0])
+
+    # other datasets keep their loader
+    loader = ch.utils.data.DataLoader(list(zip(X, y)), batch_size=10)
+    assert TensorLoader.from_loader(loader) is loader
+
+
+def test_iterate_average():
+    ch.manual_seed(seed)
+    X = ch.randn(1000, 2)
+    y = X@ch.ones(2, 1) + ch.randn(1000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    for average_tail in [1.0, .5]:
+        train_kwargs = Parameters({'alpha': .5,
+                                    'epochs': 2,
+                                    'trials': 1,
+                                    'batch_size': 10,
+                                    'average': True,
+                                    'average_tail': average_tail})
+        trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+        trunc_reg.fit(X, y)
+        # the estimates are the average of the (tail) iterates
+        history = trunc_reg.history
+        tail = history[int((1 - average_tail) * history.size(0)):]
+        v = trunc_reg.weight * trunc_reg.beta / trunc_reg.variance
+        print(f'averaged iterate: {v.flatten()}, last iterate: {history[-1].flatten()}')
+        assert ch.allclose(v, tail.mean(0), atol=1e-5), f'averaged iterate: {v}, mean of tail iterates: {tail.mean(0)}'
+        # the validation set is only evaluated once, with the averaged iterate
+        assert trunc_reg.trainer.val_costs.size(0) == len(trunc_reg.val_loader)
+
+
+def test_convergence_monitor():
+    # gradient descent on a quadratic
+    x = ch.nn.Parameter(10 * ch.ones(3))
+    optimizer = ch.optim.SGD([x], lr=.1)
+    monitor = ConvergenceMonitor([x], window=10, grad_tol=1e-3, param_tol=float('inf'))
+    steps = 0
+    while not monitor.converged:
+        optimizer.zero_grad()
+        x.pow(2).sum().backward()
+        optimizer.step()
+        monitor.update()
+        steps += 1
+    print(f'converged after {steps} steps, mean gradient norm: {monitor.grad_norm}')
+    assert steps % 10 == 0 and monitor.grad_norm <= 1e-3
+
+    # the trainer stops trials when the monitor detects convergence, without validation passes
+    ch.manual_seed(seed)
+    X = ch.randn(10000, 3)
+    y = X@ch.ones(3, 1) + ch.randn(10000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    train_kwargs = Parameters({'alpha': .5,
+                                'epochs': 20,
+                                'trials': 1,
+                                'batch_size': 10,
+                                'convergence_window': 100,
+                                'param_tol': 1e-2,
+                                'grad_tol': float('inf'),
+                                'val_every_epoch': False})
+    trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+    trunc_reg.fit(X, y)
+    monitor = trunc_reg.trainer.convergence_monitor
+    assert monitor.converged and monitor.param_change <= 1e-2
+    assert trunc_reg.history.size(0) == monitor.steps < 20 * len(trunc_reg.train_loader), f'steps: {monitor.steps}'
+    # the validation set is only evaluated at the end of the trial
+    assert trunc_reg.trainer.val_costs.size(0) == len(trunc_reg.val_loader)
+
+
+def squared_error(x, y): 
+    # per-example loss, defined at module level so that process pools can pickle it
+    return (x - y).pow(2).flatten(1).sum(1)
+
+
+def test_calc_est_grad():
+    ch.manual_seed(seed)
+    x, y = ch.randn(4, 3, 5, 5), ch.randn(4, 3, 5, 5)
+    # per-example loss, and its gradient
+    func = lambda x_, y_: (x_ - y_).pow(2).flatten(1).sum(1)
+    grad = 2 * (x - y)
+
+    # a single chunk matches estimating the gradient from all of the queries at once
+    ch.manual_seed(seed)
+    est_grad = calc_est_grad(func, x, y, .1, 100)
+    ch.manual_seed(seed)
+    queries = x.repeat(50, 1, 1, 1)
+    noise = ch.randn_like(queries)
+    noise = noise / noise.view(200, -1).norm(dim=-1).view(200, 1, 1, 1)
+    noise, queries = ch.cat([-noise, noise]), ch.cat([queries, queries])
+    l = func(queries + .1 * noise, y.repeat(100, 1, 1, 1)).view(-1, 1, 1, 1)
+    assert ch.allclose(est_grad, (l.view(100, 4, 1, 1, 1) * noise.view(100, 4, 3, 5, 5)).mean(0), atol=1e-5)
+
+    # chunked estimates, evaluated sequentially and in a pool
+    ch.manual_seed(seed)
+    est_grad = calc_est_grad(func, x, y, .1, 20000, chunk_size=64)
+    with ThreadPoolExecutor(2) as pool:
+        ch.manual_seed(seed)
+        pool_est_grad = calc_est_grad(func, x, y, .1, 20000, chunk_size=64, pool=pool)
+    assert ch.equal(est_grad, pool_est_grad)
+    with ProcessPoolExecutor(2) as pool:
+        ch.manual_seed(seed)
+        pool_est_grad = calc_est_grad(squared_error, x, y, .1, 20000, chunk_size=64, pool=pool)
+    assert ch.equal(est_grad, pool_est_grad)
+    # queries in the pool's threads don't build autograd graphs
+    w = ch.nn.Parameter(ch.ones(1))
+    requires_grad = []
+    def weighted(x_, y_): 
+        loss = w * func(x_, y_)
+        requires_grad.append(loss.requires_grad)
+        return loss
+    with ThreadPoolExecutor(2) as pool:
+        calc_est_grad(weighted, x, y, .1, 1000, chunk_size=64, pool=pool)
+    assert not any(requires_grad)
+    # the spherical estimator estimates the gradient divided by the dimension
+    cos = ch.nn.functional.cosine_similarity(est_grad.flatten(1), grad.flatten(1))
+    print(f'cosine similarity: {cos}')
+    assert (cos > .9).all(), f'cosine similarity: {cos}'
+
+
+def test_trajectory_buffer():
+    ch.manual_seed(seed)
+    X, U = ch.randn(1000, 3), ch.randn(1000, 2)
+    buffer = TrajectoryBuffer(3, 2, capacity=2)
+    for i in range(1000):
+        buffer.append(X[i:i+1], U[i:i+1])
+        if i % 100 == 99:
+            buffer.end_trajectory()
+    buffer.end_trajectory()
+    buffer.append(X[:5], U[:5])
+    X_, U_ = buffer.tensors
+    assert len(buffer) == 1005
+    assert ch.equal(X_, ch.cat([X, X[:5]])) and ch.equal(U_, ch.cat([U, U[:5]]))
+    # the samples are views of the buffers
+    assert X_.data_ptr() == buffer.buffers[0].data_ptr()
+    # the trajectory in progress is included in the offsets
+    assert ch.equal(buffer.offsets, ch.tensor(list(range(0, 1001, 100)) + [1005]))
+    # the buffers keep the dtype of the samples
+    buffer = TrajectoryBuffer(3, 1, capacity=2)
+    buffer.append(X[:1].double(), ch.ones(1, 1, dtype=ch.long))
+    X_, ids = buffer.tensors
+    assert X_.dtype == ch.float64 and ids.dtype == ch.long
+    assert ch.equal(X_, X[:1].double())
+
+
+def test_thickness_monitor():
+    ch.manual_seed(seed)
+    X = ch.randn(2000, 5) * ch.Tensor([1, 1, 1, 1, .1])
+    target = 5.0
+    # the first sample at which the thickness reaches the target
+    covariate_matrix, stop = ch.zeros(5, 5), None
+    for i in range(X.size(0)):
+        if calc_thickness(covariate_matrix) >= target:
+            stop = i
+            break
+        covariate_matrix += X[i:i+1].T@X[i:i+1]
+
+    monitor = ThicknessMonitor(5, target)
+    for i in range(X.size(0)):
+        if monitor.reached():
+            break
+        monitor.update(X[i:i+1])
+    print(f'stopped after {i} samples, with {monitor.num_exact} eigendecompositions')
+    assert i == stop, f'monitor stopped after {i} samples, expected {stop}'
+    assert ch.allclose(monitor.covariate_matrix, covariate_matrix)
+    assert monitor.num_exact < stop / 10
@@ -0,0 +1,92 @@
+"""
+Test suite for the membership oracles.
+Includes:
+    -Vectorized lambda oracles
+    -Oracle expressions
+    -Oracle algebra (union, intersection, complement, k-of-n)
+"""
+import torch as ch
+
+from delphi import oracle
+
+# CONSTANTS
+seed = 69
+
+
+def test_lambda_oracle():
+    ch.manual_seed(seed)
+    x = 2 * ch.randn(100, 10, 2)
+    for lambda_ in [oracle.set_two_d, oracle.horseshoe, oracle.horseshoe_dot, oracle.triangle]:
+        vmap_oracle, loop_oracle = oracle.Lambda(lambda_), oracle.Lambda(lambda_, vmap=False)
+        result = vmap_oracle(x)
+        assert vmap_oracle._vmappable, f'{lambda_} was not vectorized'
+        assert result.size() == x.size()[:-1], f'result size: {result.size()}'
+        assert ch.equal(result, loop_oracle(x))
+
+    # lambdas with python control flow fall back to a loop
+    python_horseshoe = lambda x: x[0] > 0 and x[0] ** 2 + x[1] ** 2 > 1 and x[0] ** 2 + x[1] ** 2 < 2
+    lambda_oracle = oracle.Lambda(python_horseshoe)
+    result = lambda_oracle(x)
+    assert lambda_oracle._vmappable is False
+    assert ch.equal(result, oracle.horseshoe(x))
+
+
+def test_oracle_expressions():
+    ch.manual_seed(seed)
+    x = 2 * ch.randn(100, 10, 2)
+    # horseshoe: x[0] > 0 and 1 < ||x||^2 < 2
+    expr = oracle.HalfSpace(ch.Tensor([-1.0, 0.0]), 0.0) & oracle.Ball(ch.zeros(2), 2 ** .5) & ~oracle.Ball(ch.zeros(2), 1.0)
+    result = expr(x)
+    print(f'expression: {expr}')
+    assert result.dtype == ch.bool and result.size() == x.size()[:-1] + (1,), f'result: {result.dtype}, {result.size()}'
+    # points on the boundaries have probability zero
+    assert ch.equal(result[...,0], oracle.horseshoe(x))
+
+    # l-infinity ball, combined with a non-expression oracle
+    expr = oracle.Ball(ch.zeros(2), 1.0, ord=float('inf')) | oracle.Left_Distribution(ch.ones(2))
+    expected = (x.abs() <= 1.0).all(-1) | (x > 1.0).all(-1)
+    assert ch.equal(expr(x)[...,0], expected)
+
+
+def test_oracle_algebra():
+    ch.manual_seed(seed)
+    x = ch.randn(1000, 10, 3)
+    half_spaces = [oracle.HalfSpace(-ch.eye(3)[i], 0.0) for i in range(3)]
+    positive = x >= 0
+
+    intersection = oracle.Intersection(*half_spaces)
+    assert ch.equal(intersection(x)[...,0], positive.all(-1))
+    union = oracle.Union(*half_spaces)
+    assert ch.equal(union(x)[...,0], positive.any(-1))
+    complement = oracle.Complement(union)
+    assert ch.equal(complement(x)[...,0], ~positive.any(-1))
+    for k in range(1, 4):
+        k_of_n = oracle.KOfN(k, *half_spaces)
+        result = k_of_n(x)
+        assert result.dtype == ch.bool and result.size() == x.size()[:-1] + (1,)
+        assert ch.equal(result[...,0], positive.sum(-1) >= k), f'{k_of_n} failed'
+
+    # later oracles are only evaluated on the samples that are still undecided
+    class CountingOracle(oracle.oracle):
+        def __init__(self):
+            self.num_evaluated = 0
+        def __call__(self, x):
+            self.num_evaluated += x[...,0].numel()
+            return x[...,1:2] > 0
+    counting = CountingOracle()
+    oracle.And(half_spaces[0], counting)(x)
+    assert counting.num_evaluated == positive[...,0].sum(), f'evaluated: {counting.num_evaluated}'
+
+
+def test_k_interval_union():
+    x = ch.linspace(-4, 4, 801)[...,None].repeat(1, 5)[...,None]
+    phi = oracle.KIntervalUnion([(-3*ch.ones(1), -1*ch.ones(1)), (ch.zeros(1), ch.ones(1))])
+    result = phi(x)
+    expected = ((-3 < x) & (x < -1)) | ((0 < x) & (x < 1))
+    assert result.dtype == ch.bool and result.size() == x.size(), f'result: {result.dtype}, {result.size()}'
+    assert ch.equal(result, expected)
+    # double precision bounds aren't rounded to single precision
+    eps = 1e-10
+    phi = oracle.KIntervalUnion([(ch.ones(1, dtype=ch.float64), ch.full((1,), 1 + eps, dtype=ch.float64))])
+    assert phi.lower.dtype == ch.float64
+    assert phi(ch.full((1, 1), 1 + eps / 2, dtype=ch.float64)).all() and not phi(ch.full((1, 1), 1 + 2 * eps, dtype=ch.float64)).any()
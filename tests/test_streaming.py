@@ -0,0 +1,108 @@
+"""
+Test suite for the streaming estimates.
+Includes:
+    -Sufficient statistics OLS over memory-mapped chunks
+    -Streaming empirical estimates for truncated regression
+    -Out-of-core truncated regression
+"""
+import os
+import tempfile
+import numpy as np
+import torch as ch
+from torch.utils.data import DataLoader
+
+from delphi import stats
+from delphi import oracle
+from delphi.utils.helpers import Parameters
+from delphi.utils.streaming import SufficientStatistics, iter_chunks
+from delphi.utils.loaders import ArrayDataset, BlockShuffleLoader
+
+# CONSTANTS
+seed = 69
+
+
+def test_sufficient_statistics():
+    ch.manual_seed(seed)
+    X = 3 * ch.randn(5000, 4)
+    y = X@ch.ones(4, 1) + ch.randn(5000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    trunc_reg = stats.TruncatedLinearRegression(phi, Parameters({'alpha': .5, 'epochs': 1, 'trials': 1, 'batch_size': 10}))
+    trunc_reg.fit(X, y)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        np.save(os.path.join(tmp_dir, 'X.npy'), X.numpy())
+        np.save(os.path.join(tmp_dir, 'y.npy'), y.numpy())
+        X_mmap = np.load(os.path.join(tmp_dir, 'X.npy'), mmap_mode='r')
+        y_mmap = np.load(os.path.join(tmp_dir, 'y.npy'), mmap_mode='r')
+        suff_stats = SufficientStatistics.from_chunks(iter_chunks(X_mmap, y_mmap, chunk_size=777), fit_intercept=True)
+    print(f'streaming beta: {suff_stats.beta}, beta: {trunc_reg.beta}')
+    assert ch.allclose(suff_stats.beta, trunc_reg.beta)
+
+    # OLS on the scaled training set
+    X_train, y_train = trunc_reg.train_loader.dataset.tensors
+    suff_stats = SufficientStatistics.from_chunks(iter_chunks(X_train[:,:-1] * trunc_reg.beta, y_train, chunk_size=333), fit_intercept=True)
+    estimates = suff_stats.estimates(trunc_reg.beta)
+    print(f'streaming ols: {estimates.coef.flatten()}, ols: {trunc_reg.ols_coef_.flatten()}')
+    assert ch.allclose(estimates.coef, trunc_reg.ols_coef_, rtol=1e-4)
+    assert ch.allclose(estimates.noise_var, trunc_reg.emp_noise_var, rtol=1e-4)
+    assert estimates.rank == trunc_reg.rank_
+    assert np.allclose(estimates.singular, trunc_reg.singular_, rtol=1e-4)
+
+
+def test_streaming_empirical_estimates():
+    ch.manual_seed(seed)
+    X = ch.randn(2000, 3)
+    y = X@ch.ones(3, 1) + ch.randn(2000, 1)
+    trunc_reg = stats.TruncatedLinearRegression(oracle.Left_Regression(ch.zeros(1)), Parameters({'alpha': .5}))
+    # datasets that aren't in-memory tensor datasets are streamed through the loader
+    trunc_reg.calc_emp_model(DataLoader(list(zip(X, y)), batch_size=100))
+    emp_weight, emp_noise_var = trunc_reg.emp_weight.clone(), trunc_reg.emp_noise_var.clone()
+    trunc_reg.calc_emp_model(DataLoader(ch.utils.data.TensorDataset(X, y), batch_size=100))
+    assert ch.allclose(emp_weight, trunc_reg.emp_weight, atol=1e-5), f'streaming: {emp_weight}, in-memory: {trunc_reg.emp_weight}'
+    assert ch.allclose(emp_noise_var, trunc_reg.emp_noise_var, atol=1e-5)
+
+
+def test_out_of_core_regression():
+    ch.manual_seed(seed)
+    X = ch.randn(10000, 4)
+    W, W0 = ch.ones(4, 1), ch.ones(1)
+    y = X@W + W0 + ch.randn(10000, 1)
+    phi = oracle.Left_Regression(2 * ch.ones(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        np.save(os.path.join(tmp_dir, 'X.npy'), X.double().numpy())
+        np.save(os.path.join(tmp_dir, 'y.npy'), y.double().numpy())
+        X_mmap = np.load(os.path.join(tmp_dir, 'X.npy'), mmap_mode='r')
+        y_mmap = np.load(os.path.join(tmp_dir, 'y.npy'), mmap_mode='r')
+
+        # block shuffled batches cover the rows once per epoch
+        loader = BlockShuffleLoader(ArrayDataset(X_mmap, y_mmap, start=100), batch_size=10, block_size=333, shuffle=True)
+        inp = ch.cat([batch[0] for batch in loader])
+        assert len(loader) == len(range(0, X.size(0) - 100, 10))
+        assert not ch.equal(inp, X[100:].double())
+        assert ch.equal(inp.sort(0)[0], X[100:].double().sort(0)[0])
+
+        train_kwargs = {'alpha': .5,
+                        'epochs': 3,
+                        'trials': 1,
+                        'batch_size': 10,
+                        'block_size': 1000}
+        trunc_reg = stats.TruncatedLinearRegression(phi, Parameters(train_kwargs))
+        trunc_reg.fit_out_of_core(X_mmap, y_mmap)
+        # the training set's statistics are accumulated unscaled, in the same pass as the scaling
+        assert trunc_reg._stream_stats.n == len(trunc_reg.train_loader.dataset)
+
+    in_memory_reg = stats.TruncatedLinearRegression(phi, Parameters(train_kwargs))
+    in_memory_reg.fit(X, y)
+    print(f'out-of-core: {trunc_reg.coef.flatten()}, {trunc_reg.intercept}, in-memory: {in_memory_reg.coef.flatten()}, {in_memory_reg.intercept}')
+    assert ch.allclose(trunc_reg.beta, in_memory_reg.beta)
+    assert ch.allclose(trunc_reg.emp_weight, in_memory_reg.emp_weight, atol=1e-4)
+    # the estimates only differ in the order of the minibatches
+    assert ch.allclose(trunc_reg.coef, in_memory_reg.coef, atol=1e-1), f'out-of-core coef: {trunc_reg.coef}, in-memory coef: {in_memory_reg.coef}'
+    assert ch.allclose(trunc_reg.intercept, in_memory_reg.intercept, atol=1e-1)
+    assert ch.allclose(trunc_reg.variance, in_memory_reg.variance, atol=1e-1)
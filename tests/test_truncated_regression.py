@@ -4,7 +4,17 @@ Includes:
     -Truncated regression with known variance
     -Truncated regression with unknown variance 
     -Truncated regression with known regression and temporal dependencies
+    -Full-batch L-BFGS and Newton solvers
+    -Batched truncated regressions
+    -Parallel trials
+    -Cached empirical estimates
+    -Online partial fits
+    -Checkpoint and resume
+    -Known variance parameters
 """
+import os
+import tempfile
+import pytest
 import numpy as np
 import torch as ch
 from torch import Tensor
@@ -203,4 +213,251 @@ def test_truncated_dependent_regression():
     print(f'truncated spectral norm: {trunc_spec_norm}')
     print(f'ols spectral norm: {emp_spec_norm}')
 
-    assert trunc_spec_norm <= emp_spec_norm, f"truncated spectral norm {trunc_spec_norm}, while OLS spectral norm is: {emp_spec_norm}"
\ No newline at end of file
+    assert trunc_spec_norm <= emp_spec_norm, f"truncated spectral norm {trunc_spec_norm}, while OLS spectral norm is: {emp_spec_norm}"
+
+
+def test_full_batch_truncated_regression():
+    ch.manual_seed(seed)
+    D = 10
+    w_ = Uniform(-1, 1)
+    M = Uniform(-3, 3)
+    W, W0 = w_.sample([D, 1]), w_.sample([1, 1])
+    gt_ = ch.cat([W.flatten(), W0.flatten()])
+    X = M.sample([10000, D])
+    noised = X@W + W0 + ch.randn(X.size(0), 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(noised).nonzero()[:,0]
+    x_trunc, y_trunc = X[indices], noised[indices]
+    alpha = x_trunc.size(0) / X.size(0)
+
+    for noise_var in [ch.ones(1, 1), None]:
+        estimates = []
+        for solver in ['lbfgs', 'newton']:
+            train_kwargs = Parameters({'alpha': alpha,
+                                        'solver': solver,
+                                        'max_iter': 30})
+            trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs, noise_var=noise_var)
+            trunc_reg.fit(x_trunc, y_trunc)
+            w_ = ch.cat([trunc_reg.coef_.flatten(), trunc_reg.intercept_.flatten()])
+            full_batch_mse_loss, emp_mse_loss = mse_loss(w_, gt_), mse_loss(trunc_reg.emp_weight.flatten(), gt_)
+            print(f'{solver} mse loss: {full_batch_mse_loss}, emp mse loss: {emp_mse_loss}, iterations: {trunc_reg.history.size(0)}')
+            assert full_batch_mse_loss <= emp_mse_loss, f'{solver} mse loss: {full_batch_mse_loss}, emp mse loss: {emp_mse_loss}'
+            assert trunc_reg.history.size(0) < 30, f'{solver} did not converge'
+            estimates.append(w_)
+        # both solvers converge to the maximum likelihood estimate
+        assert ch.allclose(estimates[0], estimates[1], atol=1e-2), f'lbfgs estimates: {estimates[0]}, newton estimates: {estimates[1]}'
+
+
+def test_batched_truncated_regression():
+    ch.manual_seed(seed)
+    B, D = 10, 3
+    w_ = Uniform(-1, 1)
+    M = Uniform(-5, 5)
+    W, W0 = w_.sample([B, D, 1]), w_.sample([B, 1, 1])
+    gt_ = ch.cat([W, W0], dim=1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    # ragged problems, with a different number of samples
+    X, y = [], []
+    for i in range(B):
+        x_ = M.sample([1000 + 100 * i, D])
+        noised = x_@W[i] + W0[i] + ch.randn(x_.size(0), 1)
+        indices = phi(noised).nonzero()[:,0]
+        X.append(x_[indices])
+        y.append(noised[indices])
+
+    train_kwargs = Parameters({'alpha': .5,
+                                'epochs': 5,
+                                'batch_size': 10,
+                                'constant': True})
+    for noise_var in [ch.ones(1), None]:
+        batched_reg = stats.BatchedTruncatedLinearRegression(phi, train_kwargs, noise_var=noise_var)
+        batched_reg.fit(X, y)
+        w_ = ch.cat([batched_reg.coef_, batched_reg.intercept_[...,None]], dim=1)
+        assert w_.size() == gt_.size(), f'estimates size: {w_.size()}'
+        batched_mse_loss, emp_mse_loss = (w_ - gt_).pow(2).mean(), (batched_reg.emp_weight - gt_).pow(2).mean()
+        print(f'batched mse loss: {batched_mse_loss}, emp mse loss: {emp_mse_loss}')
+        assert batched_mse_loss <= emp_mse_loss, f'batched mse loss: {batched_mse_loss}, emp mse loss: {emp_mse_loss}'
+        assert [pred.size(0) for pred in batched_reg.predict(X)] == [x_.size(0) for x_ in X]
+    assert batched_reg.variance_.size() == (B, 1, 1)
+    # the Trainer's other features aren't supported
+    for kwargs in [{'trials': 3}, {'early_stopping': True}, {'checkpoint_dir': '.'}]: 
+        with pytest.raises(ValueError, match=list(kwargs)[0]):
+            stats.BatchedTruncatedLinearRegression(phi, Parameters({'alpha': .5, **kwargs}))
+
+
+def test_parallel_trials():
+    ch.manual_seed(seed)
+    X = ch.randn(2000, 2)
+    y = X@ch.ones(2, 1) + ch.randn(2000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    for adopt_best in [False, True]: 
+        estimates = []
+        for trial_workers in [1, 3]:
+            train_kwargs = Parameters({'alpha': .5,
+                                        'epochs': 2,
+                                        'trials': 3,
+                                        'batch_size': 10,
+                                        'trial_workers': trial_workers, 
+                                        'adopt_best': adopt_best})
+            trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+            trunc_reg.fit(X, y)
+            print(f'trial workers: {trial_workers}, adopt best: {adopt_best}, coef: {trunc_reg.coef.flatten()}, variance: {trunc_reg.variance.flatten()}')
+            # the radius grows once per trial in both modes
+            assert trunc_reg.args.r == 1.5 ** 3, f'radius: {trunc_reg.args.r}'
+            estimates.append(trunc_reg)
+        # each parallel trial matches the corresponding sequential trial
+        assert ch.allclose(estimates[0].history, estimates[1].history), 'parallel trials do not match the sequential trials'
+        assert ch.allclose(estimates[0].trainer.val_costs, estimates[1].trainer.val_costs)
+        assert ch.allclose(estimates[0].coef, estimates[1].coef) and ch.allclose(estimates[0].variance, estimates[1].variance)
+        for trunc_reg in estimates: 
+            v = trunc_reg.weight * trunc_reg.beta / trunc_reg.variance
+            # by default, the last trial's final iterate; otherwise the epoch with the lowest validation loss
+            best_epoch = trunc_reg.trainer.val_costs.view(6, -1).mean(-1).argmin() if adopt_best else -1
+            assert ch.allclose(v, trunc_reg.history.view(6, -1, 3, 1)[best_epoch, -1]), f'best epoch: {best_epoch}'
+
+
+def test_empirical_estimates_cache():
+    ch.manual_seed(seed)
+    X = ch.randn(1000, 3)
+    y = X@ch.ones(3, 1) + ch.randn(1000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    train_kwargs = Parameters({'alpha': .5,
+                                'epochs': 1,
+                                'trials': 2,
+                                'batch_size': 10})
+    trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+    trunc_reg.fit(X, y)
+    key, estimates = trunc_reg._emp_cache
+    X_train, y_train = trunc_reg.train_loader.dataset.tensors
+    ols = LinearRegression(fit_intercept=False).fit(X_train, y_train)
+    assert ch.allclose(estimates.coef.flatten(), Tensor(ols.coef_).flatten(), atol=1e-4), f'cached coef: {estimates.coef}, ols coef: {ols.coef_}'
+    # later trials on the same training tensors reuse the estimates
+    trunc_reg.calc_emp_model(trunc_reg.train_loader)
+    assert trunc_reg._emp_cache[1] is estimates
+    assert ch.equal(trunc_reg.ols_coef_, estimates.coef) and trunc_reg.ols_coef_ is not estimates.coef
+    # modifying the training set in place invalidates the cache
+    y_train += 1
+    trunc_reg.calc_emp_model(trunc_reg.train_loader)
+    assert trunc_reg._emp_cache[1] is not estimates
+    # by default, refitting recomputes the estimates
+    trunc_reg.fit(X, y)
+    estimates = trunc_reg._emp_cache[1]
+    trunc_reg.fit(X, y)
+    assert trunc_reg._emp_cache[1] is not estimates
+
+    # keyed on the contents, refitting on the same data reuses the estimates
+    train_kwargs = Parameters({'alpha': .5,
+                                'epochs': 1,
+                                'trials': 2,
+                                'batch_size': 10, 
+                                'cache_by_content': True})
+    trunc_reg = stats.TruncatedLinearRegression(phi, train_kwargs)
+    trunc_reg.fit(X, y)
+    key, estimates = trunc_reg._emp_cache
+    trunc_reg.fit(X, y)
+    assert trunc_reg._emp_cache[1] is estimates
+    # new data invalidates the cache
+    trunc_reg.fit(X, y + 1)
+    assert trunc_reg._emp_cache[0] != key
+
+
+def test_partial_fit():
+    ch.manual_seed(seed)
+    X = ch.randn(20000, 4)
+    W, W0 = ch.ones(4, 1), ch.ones(1)
+    y = X@W + W0 + ch.randn(20000, 1)
+    phi = oracle.Left_Regression(2 * ch.ones(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+    gt_ = ch.cat([W, W0[...,None]]).flatten()
+
+    for noise_var in [None, ch.ones(1, 1)]:
+        trunc_reg = stats.TruncatedLinearRegression(phi, Parameters({'alpha': .5, 'batch_size': 10}), noise_var=noise_var)
+        trunc_reg.partial_fit(X[:500], y[:500])
+        optimizer = trunc_reg._online_optimizer
+        for i in range(500, X.size(0), 500):
+            trunc_reg.partial_fit(X[i:i+500], y[i:i+500])
+        # the optimizer's state is kept between calls
+        assert trunc_reg._online_optimizer is optimizer
+        assert trunc_reg._online_stats.n == X.size(0) and trunc_reg.args.T == X.size(0)
+
+        w_ = ch.cat([trunc_reg.coef, trunc_reg.intercept[...,None]]).flatten()
+        emp_ = (trunc_reg.emp_weight / trunc_reg.beta).flatten()
+        online_mse_loss, emp_mse_loss = (w_ - gt_).pow(2).mean(), (emp_ - gt_).pow(2).mean()
+        print(f'online mse loss: {online_mse_loss}, emp mse loss: {emp_mse_loss}')
+        assert online_mse_loss <= emp_mse_loss, f'online mse loss: {online_mse_loss}, emp mse loss: {emp_mse_loss}'
+
+    # the first batch must have more samples than features, to initialize the parameters
+    trunc_reg = stats.TruncatedLinearRegression(phi, Parameters({'alpha': .5, 'batch_size': 10}))
+    with pytest.raises(AssertionError, match='first batch'):
+        trunc_reg.partial_fit(X[:5], y[:5])
+    assert trunc_reg._online_stats is None
+
+
+def test_checkpoint_resume():
+    ch.manual_seed(seed)
+    X = ch.randn(2000, 2)
+    y = X@ch.ones(2, 1) + ch.randn(2000, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        train_kwargs = {'alpha': .5,
+                        'epochs': 3,
+                        'trials': 2,
+                        'batch_size': 10,
+                        'checkpoint_dir': tmp_dir}
+        # fits update their hyperparameters (ie. the radius), so each fit gets its own copy
+        ch.manual_seed(seed)
+        trunc_reg = stats.TruncatedLinearRegression(phi, Parameters(dict(train_kwargs)))
+        trunc_reg.fit(X, y)
+        # completed runs remove their checkpoint
+        assert not os.listdir(tmp_dir)
+
+        # the process dies after the second epoch of the second trial, before it is checkpointed
+        def preempt(epoch, is_train, loss):
+            if is_train and len(trunc_reg_.trainer.history_recorder) > 4 * len(trunc_reg_.train_loader) + 10:
+                raise KeyboardInterrupt
+        ch.manual_seed(seed)
+        trunc_reg_ = stats.TruncatedLinearRegression(phi, Parameters(dict(train_kwargs)))
+        trunc_reg_.epoch_hook = preempt
+        try:
+            trunc_reg_.fit(X, y)
+            assert False, 'training was not preempted'
+        except KeyboardInterrupt:
+            pass
+        assert os.listdir(tmp_dir) == ['checkpoint.pt']
+
+        ch.manual_seed(seed)
+        resumed_reg = stats.TruncatedLinearRegression(phi, Parameters(dict(train_kwargs)))
+        resumed_reg.fit(X, y)
+    print(f'coef: {trunc_reg.coef.flatten()}, resumed coef: {resumed_reg.coef.flatten()}')
+    # the resumed run continues bit-for-bit
+    assert ch.equal(trunc_reg.coef, resumed_reg.coef) and ch.equal(trunc_reg.intercept, resumed_reg.intercept)
+    assert ch.equal(trunc_reg.variance, resumed_reg.variance)
+    assert ch.equal(trunc_reg.history, resumed_reg.history)
+    assert ch.equal(trunc_reg.trainer.val_costs, resumed_reg.trainer.val_costs)
+    assert trunc_reg.args.r == resumed_reg.args.r
+
+
+def test_known_variance_parameters():
+    ch.manual_seed(seed)
+    X = ch.randn(500, 2)
+    y = X@ch.ones(2, 1) + ch.randn(500, 1)
+    phi = oracle.Left_Regression(ch.zeros(1))
+    indices = phi(y).nonzero()[:,0]
+    X, y = X[indices], y[indices]
+
+    trunc_reg = stats.TruncatedLinearRegression(phi, Parameters({'alpha': .5, 'epochs': 1, 'trials': 1, 'batch_size': 10}), noise_var=ch.ones(1, 1))
+    trunc_reg.fit(X, y)
+    # the registered parameters, and not their names, are passed to the optimizer
+    params = list(trunc_reg.parameters())
+    assert len(params) == 1 and params[0] is trunc_reg.weight, f'parameters: {params}'
+    assert trunc_reg.coef.size() == (2, 1)
@@ -24,6 +24,10 @@ class GenerateTruncatedLQRData:
         else: 
             return None
 
+    def batch(self, x_t, u_t):
+        y_t = x_t@self.A + u_t@self.B + self.M.sample((x_t.size(0),))
+        return y_t, u_t, self.phi(y_t).flatten()
+
 
 
 def calc_sarah_dean(train_kwargs: Parameters, 